@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 24 09:48:36 2026
+
+@author: Ben
+
+History of benchmark results, kept in an append-only jsonl file (one run
+per line, with a fingerprint of the machine and the git revision), and
+detection of regressions between runs.
+
+Usage: python bench_history.py run [--suites SUITE...] [--history FILE]
+       python bench_history.py compare [--threshold FRACTION] [--window N]
+                                        [--against REVISION] [--history FILE]
+       python bench_history.py show [NAME] [--history FILE]
+
+Suites: hash (hashing scripts and outputs), parse (see bench_parsing.py),
+compile (orchestration of compiles, with a compiler that does nothing) and
+merge (making blanks and merging overlays).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess as sp
+
+import benchutil
+import bench_parsing
+import cohort
+
+import mh_edit_management as mhem  # (on path via benchutil)
+import mh_hash
+import mh_script_management as mhsm
+
+# default history file
+HISTORY_FILE = os.path.join(benchutil.BENCH_DIR, "history.jsonl")
+# default fraction slower than baseline reported as a regression
+THRESHOLD = 0.10
+# default number of earlier runs making up the baseline
+WINDOW = 5
+# source files per round of the compile benchmark
+N_COMPILES = 50
+
+
+def machine_fingerprint():
+    '''
+    Returns
+    -------
+    {"id", "platform", "machine", "processor", "python", "cpus"} where "id"
+    is a short hash of the rest, identifying runs comparable with each other
+    '''
+    info = {"platform": platform.platform(), "machine": platform.machine(),
+            "processor": platform.processor(),
+            "python": platform.python_version(), "cpus": os.cpu_count()}
+    info["id"] = hashlib.sha256(json.dumps(
+        [platform.node(), info], sort_keys=True).encode()).hexdigest()[:12]
+    return info
+
+
+def git_revision():
+    '''
+    Returns
+    -------
+    str : commit of the repository (with '+dirty' if tracked files are
+    modified), or '' if it cannot be found
+    '''
+    repo = os.path.dirname(benchutil.BENCH_DIR)
+    try:
+        rev = sp.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo,
+                     stdout=sp.PIPE, stderr=sp.DEVNULL, check=True,
+                     universal_newlines=True).stdout.strip()
+        dirty = sp.run(["git", "diff", "--quiet", "HEAD"], cwd=repo,
+                       stderr=sp.DEVNULL).returncode != 0
+    except (OSError, sp.CalledProcessError):
+        return ''
+    return rev + ("+dirty" if dirty else '')
+
+
+def _result(samples, unit):
+    return dict(unit=unit, samples=samples, **benchutil.summarise(samples))
+
+
+def bench_hash(workdir, rounds):
+    '''
+    Hash the scripts of a small cohort, and their overlays ignoring volatile
+    fields, in bytes per second
+    '''
+    script_dir = os.path.join(workdir, "hash")
+    scripts = cohort.make_cohort(script_dir, 20, 1, 10, 0.2, 50, seed=1)
+    files = [f for tag in sorted(scripts) for f in scripts[tag]]
+    size = sum(os.path.getsize(os.path.join(script_dir, f)) for f in files)
+    overlays = []
+    for tag in sorted(scripts):
+        overlays.append(tag + "_m.pdf")
+        cohort.write_pdf(os.path.join(script_dir, overlays[-1]), 10,
+                         "Marked")
+    out_size = sum(os.path.getsize(os.path.join(script_dir, f))
+                   for f in overlays)
+
+    def hash_scripts():
+        for f in files:
+            mh_hash.hash_file_list([f], script_dir)
+
+    def hash_outputs():
+        for f in overlays:
+            mh_hash.hash_pdf_stable([f], script_dir)
+
+    return {"hash scripts": _result(benchutil.measure(
+                hash_scripts, size, rounds), "bytes/s"),
+            "hash outputs": _result(benchutil.measure(
+                hash_outputs, out_size, rounds), "bytes/s")}
+
+
+def bench_parse(workdir, rounds):
+    '''
+    All benchmarks of bench_parsing.py, in operations per second
+    '''
+    results = bench_parsing.run_benchmarks(list(bench_parsing.BENCHMARKS),
+                                           rounds)
+    return {"parse " + name: _result(results[name]["samples"], "ops/s")
+            for name in results}
+
+
+def bench_compile(workdir, rounds):
+    '''
+    Run mh_edit_management.batch_compile_async on N_COMPILES source files
+    with a compiler that does nothing, in files per second, so that only the
+    cost of launching and tracking compiles is measured
+    '''
+    source_dir = os.path.join(workdir, "compile")
+    os.makedirs(source_dir, exist_ok=True)
+    files = ["S{:02d}_m.tex".format(i) for i in range(N_COMPILES)]
+    for f in files:
+        with open(os.path.join(source_dir, f), 'w') as file:
+            file.write("%pages 1\n")
+    command = shutil.which("true") or sys.executable + " -c pass"
+
+    def compile_all():
+        failed = asyncio.run(mhem.batch_compile_async(
+            source_dir, files, command, os.cpu_count() or 1))
+        if failed:
+            raise RuntimeError("Compile of {} failed".format(failed[0]))
+
+    return {"compile orchestration": _result(benchutil.measure(
+        compile_all, len(files), rounds), "files/s")}
+
+
+def bench_merge(workdir, rounds):
+    '''
+    Make blanks like, and merge overlays over, the scripts of a small
+    cohort, in scripts per second
+    '''
+    script_dir = os.path.join(workdir, "merge")
+    scripts = cohort.make_cohort(script_dir, 10, 1, 8, 0.3, 20, seed=2)
+    out_dir = os.path.join(script_dir, "out")
+    os.makedirs(out_dir)
+    for tag in scripts:
+        pages = sum(cohort.pdf_page_count(os.path.join(script_dir, f))
+                    for f in scripts[tag])
+        cohort.write_pdf(os.path.join(out_dir, tag + "_m.pdf"), pages,
+                         "Marked")
+
+    # each script's page sizes are read once per session in real use, so
+    # time reading them rather than mhsm.g_page_sizes hits
+    def blanks():
+        mhsm.g_page_sizes.clear()
+        for tag in scripts:
+            for f in scripts[tag]:
+                mhsm.make_blank_pdf_like(os.path.join(script_dir, f),
+                                         os.path.join(out_dir, "blank.pdf"))
+
+    def merge():
+        mhsm.g_page_sizes.clear()
+        for tag in scripts:
+            mhsm.merge_pdfs(scripts[tag],
+                            os.path.join(out_dir, tag + "_m.pdf"),
+                            os.path.join(out_dir, tag + "_final.pdf"),
+                            script_dir)
+
+    return {"make blanks": _result(benchutil.measure(
+                blanks, len(scripts), rounds), "scripts/s"),
+            "merge": _result(benchutil.measure(
+                merge, len(scripts), rounds), "scripts/s")}
+
+
+# suite name: function(work directory, rounds) -> {benchmark: result}
+SUITES = {"hash": bench_hash, "parse": bench_parse,
+          "compile": bench_compile, "merge": bench_merge}
+
+
+def run_suites(suites, rounds=benchutil.ROUNDS):
+    '''
+    Returns
+    -------
+    history record for a run of `suites`: {"time", "revision", "machine",
+    "suites", "benchmarks": {name: {"unit", "samples", "median", "q1",
+    "q3", "iqr"}}}
+    '''
+    benchmarks = {}
+    workdir = tempfile.mkdtemp(prefix="mh_bench_")
+    try:
+        for suite in suites:
+            print("Running {} benchmarks...".format(suite))
+            benchmarks.update(SUITES[suite](workdir, rounds))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(), "machine": machine_fingerprint(),
+            "suites": list(suites), "benchmarks": benchmarks}
+
+
+def append_record(path, record):
+    '''
+    Append history `record` to jsonl file `path`
+
+    Raises
+    ------
+    OSError if file cannot be written
+    '''
+    with open(path, 'a') as file:
+        file.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def load_history(path):
+    '''
+    Returns
+    -------
+    list of history records in `path`, oldest first (lines that cannot be
+    read, e.g. from an interrupted write, are skipped). Empty if there is no
+    file
+    '''
+    records = []
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def compare(candidate, baseline_runs, threshold=THRESHOLD):
+    '''
+    Compare the benchmarks of record `candidate` with the same benchmarks in
+    records `baseline_runs`. The baseline of a benchmark is the median of
+    its medians in those runs, and its noise the larger of the median of
+    their IQRs and the candidate's IQR. A change is significant if it is
+    more than `threshold` (fraction) of the baseline and more than the noise
+
+    Returns
+    -------
+    [lines, regressions] : lines describing each benchmark, and names of
+    benchmarks significantly slower than baseline
+    '''
+    lines = []
+    regressions = []
+    for name in sorted(candidate["benchmarks"]):
+        res = candidate["benchmarks"][name]
+        earlier = [run["benchmarks"][name] for run in baseline_runs
+                   if name in run["benchmarks"]]
+        line = "{:<28} {:>12.4g} {}".format(name, res["median"], res["unit"])
+        if earlier:
+            base = benchutil.summarise([r["median"] for r in earlier])
+            noise = max(benchutil.summarise([r["iqr"] for r in earlier])
+                        ["median"], res["iqr"])
+            change = res["median"] - base["median"]
+            line += "  {:+7.1%} vs {:.4g} (n={})".format(
+                change / base["median"], base["median"], len(earlier))
+            if abs(change) > threshold * base["median"] and \
+                    abs(change) > noise:
+                if change < 0:
+                    line += "  REGRESSION"
+                    regressions.append(name)
+                else:
+                    line += "  improved"
+        else:
+            line += "  (no baseline)"
+        lines.append(line)
+    return [lines, regressions]
+
+
+def cmd_run(args):
+    record = run_suites(args.suites, args.rounds)
+    append_record(args.history, record)
+    print("Recorded {} benchmarks for revision {} in {}".format(
+        len(record["benchmarks"]), record["revision"] or "(unknown)",
+        args.history))
+    return 0
+
+
+def cmd_compare(args):
+    machine = machine_fingerprint()["id"]
+    runs = [r for r in load_history(args.history)
+            if r["machine"]["id"] == machine]
+    if not runs:
+        print("No runs on this machine in {}.".format(args.history))
+        return 2
+    candidate = runs[-1]
+    if args.against:
+        baseline_runs = [r for r in runs[:-1]
+                         if r["revision"].startswith(args.against)]
+    else:
+        baseline_runs = runs[:-1][-args.window:]
+    print("Run of {} at {} against {} earlier runs:".format(
+        candidate["revision"] or "(unknown)", candidate["time"],
+        len(baseline_runs)))
+    lines, regressions = compare(candidate, baseline_runs, args.threshold)
+    print("\n".join(lines))
+    if regressions:
+        print("{} benchmarks regressed: {}".format(len(regressions),
+                                                   ", ".join(regressions)))
+        return 1
+    return 0
+
+
+def cmd_show(args):
+    machine = machine_fingerprint()["id"]
+    runs = [r for r in load_history(args.history)
+            if r["machine"]["id"] == machine]
+    names = sorted({n for r in runs for n in r["benchmarks"]
+                    if args.name in n})
+    for name in names:
+        print(name + ":")
+        for run in runs:
+            if name in run["benchmarks"]:
+                res = run["benchmarks"][name]
+                print("  {} {:<14} {:>12.4g} {} (IQR {:.3g})".format(
+                    run["time"], run["revision"] or "(unknown)",
+                    res["median"], res["unit"], res["iqr"]))
+    if not names:
+        print("No matching runs on this machine in {}.".format(args.history))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Record benchmark results and detect regressions.")
+    parser.add_argument("--history", default=HISTORY_FILE,
+                        help="history jsonl file (default: %(default)s)")
+    sub = parser.add_subparsers(dest="command", metavar="command")
+    sub.required = True
+    cmd = sub.add_parser("run", help="run benchmarks and record results")
+    cmd.add_argument("--suites", nargs="+", choices=list(SUITES),
+                     default=list(SUITES), metavar="SUITE",
+                     help="suites to run (default: all)")
+    cmd.add_argument("--rounds", type=int, default=benchutil.ROUNDS,
+                     help="rounds per benchmark (default: %(default)s)")
+    cmd.set_defaults(run=cmd_run)
+    cmd = sub.add_parser("compare",
+                         help="compare the last run with earlier runs")
+    cmd.add_argument("--threshold", type=float, default=THRESHOLD,
+                     help="fraction slower than baseline reported as a " +
+                     "regression (default: %(default)s)")
+    cmd.add_argument("--window", type=int, default=WINDOW,
+                     help="earlier runs making up the baseline " +
+                     "(default: %(default)s)")
+    cmd.add_argument("--against", default="", metavar="REVISION",
+                     help="use earlier runs of this revision as baseline")
+    cmd.set_defaults(run=cmd_compare)
+    cmd = sub.add_parser("show", help="list results of earlier runs")
+    cmd.add_argument("name", nargs="?", default="",
+                     help="show benchmarks whose names contain this")
+    cmd.set_defaults(run=cmd_show)
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
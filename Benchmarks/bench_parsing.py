@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 14:20:44 2026
+
+@author: Ben
+
+Micro-benchmarks of the template scripting engine (mh_parsing) on fixed,
+reproducible workloads. Reports operations per second of nextToken,
+makeTokens, interpret and process_lines, and compares them with a baseline
+saved earlier on the same machine.
+
+Usage: python bench_parsing.py [--baseline FILE] [--save-baseline]
+       [--threshold FRACTION] [--only NAME...] [--rounds N] [--json FILE]
+"""
+import os
+import sys
+import json
+import argparse
+
+import benchutil
+
+import mh_parsing as mhp  # (on path via benchutil)
+
+# default baseline file
+BASELINE_FILE = os.path.join(benchutil.BENCH_DIR, "parsing_baseline.json")
+# default fraction slower than baseline reported as a regression
+THRESHOLD = 0.15
+# pages of the script the realistic template is expanded for
+TEMPLATE_PAGES = 500
+
+
+def long_literal():
+    '''
+    nextToken on one literal of 16000 characters (with escapes)
+    '''
+    string = "'" + "abc\\'def " * 2000 + "' tail"
+    return lambda: mhp.nextToken(string), 1
+
+
+def literal_heavy_line():
+    '''
+    makeTokens on a line of 300 concatenated literals
+    '''
+    string = "\\+ 'some literal text' " * 300
+    return lambda: mhp.makeTokens(string), 1
+
+
+def nested_if(depth=40):
+    '''
+    interpret `depth` nested \\if ... \\end
+    '''
+    toks = mhp.makeTokens("\\if '1' " * depth + "'x' " + "\\end " * depth)
+    variables = {"a": "1", "b": "2", "c": "3"}
+    return lambda: mhp.interpret(toks[:], 1, [], 0, [], variables), 1
+
+
+def big_repeat(count=2000):
+    '''
+    interpret a \\r repeating a variable update `count` times
+    '''
+    toks = mhp.makeTokens("\\r '{}' \\set 'v' \\+f v '1' \\end 'done'"
+                          .format(count))
+    return lambda: mhp.interpret(toks[:], 1, [], 0, [], {"v": "0"}), 1
+
+
+def many_inserts(count=500):
+    '''
+    process_lines on `count` lines each inserting a line with \\echo@
+    '''
+    lines = ["%#_init=\\echo@ \\#ol 'inserted line' _init\n"] * count
+    return lambda: mhp.process_lines(lines, {"_init": "1"}), 1
+
+
+def _template_lines():
+    with open(os.path.join(os.path.dirname(benchutil.BENCH_DIR),
+                           "template.txt")) as file:
+        return file.readlines()
+
+
+def template_init():
+    '''
+    process_lines making a source file for a TEMPLATE_PAGES page script
+    from template.txt
+    '''
+    lines = _template_lines()
+    return lambda: mhp.process_lines(lines, {
+        "_in_path": "S0001", "_#pages": str(TEMPLATE_PAGES),
+        "_init": "1"}), 1
+
+
+def template_extract():
+    '''
+    process_lines extracting a mark from a TEMPLATE_PAGES page source file
+    made from template.txt (after adding a question to it)
+    '''
+    lines = mhp.process_lines(_template_lines(), {
+        "_in_path": "S0001", "_#pages": str(TEMPLATE_PAGES), "_init": "1"})
+    lines = mhp.process_lines(lines, {"_question_reset": "1",
+                                      "_question_name": "1",
+                                      "_question_prevmark": "7"})
+    return lambda: mhp.process_lines(lines, {"_question_mark": "",
+                                             "_question_assert": "0",
+                                             "_question_name": "1"}), 1
+
+
+# name: (function benchmarked, workload factory returning [func, ops])
+BENCHMARKS = {"long literal": ("nextToken", long_literal),
+              "literal-heavy line": ("makeTokens", literal_heavy_line),
+              "nested if": ("interpret", nested_if),
+              "big repeat": ("interpret", big_repeat),
+              "many inserts": ("process_lines", many_inserts),
+              "template init": ("process_lines", template_init),
+              "template extract": ("process_lines", template_extract)}
+
+
+def run_benchmarks(names, rounds=benchutil.ROUNDS):
+    '''
+    Returns
+    -------
+    {name: {"function", "samples", "median", "q1", "q3", "iqr"}} in
+    operations per second for benchmarks `names`
+    '''
+    results = {}
+    for name in names:
+        function, workload = BENCHMARKS[name]
+        func, ops = workload()
+        samples = benchutil.measure(func, ops, rounds)
+        results[name] = dict(function=function, samples=samples,
+                             **benchutil.summarise(samples))
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''
+    Returns
+    -------
+    [lines, regressions] : lines describing `results` relative to
+    `baseline` (both from `run_benchmarks`), and the names of benchmarks
+    more than `threshold` (fraction) slower than their baseline median
+    '''
+    lines = []
+    regressions = []
+    for name in results:
+        res = results[name]
+        line = "{:<20} {:<14} {:>11.1f} ops/s (IQR {:.1f})".format(
+            name, res["function"], res["median"], res["iqr"])
+        if name in baseline:
+            ratio = res["median"] / baseline[name]["median"]
+            line += "  {:+.1%} vs baseline".format(ratio - 1)
+            if ratio < 1 - threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        lines.append(line)
+    return [lines, regressions]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the template scripting engine.")
+    parser.add_argument("--baseline", default=BASELINE_FILE,
+                        help="baseline json file (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="fraction slower than baseline reported as a " +
+                        "regression (default: %(default)s)")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS),
+                        default=list(BENCHMARKS), metavar="NAME",
+                        help="benchmarks to run (default: all)")
+    parser.add_argument("--rounds", type=int, default=benchutil.ROUNDS,
+                        help="rounds per benchmark (default: %(default)s)")
+    parser.add_argument("--json", default="",
+                        help="also write the results to this json file")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only, args.rounds)
+    baseline = {}
+    if not args.save_baseline:
+        try:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        except OSError:
+            print("No baseline at {} (use --save-baseline to make one)."
+                  .format(args.baseline))
+    lines, regressions = compare(results, baseline, args.threshold)
+    print("\n".join(lines))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1)
+        print("Saved baseline to " + args.baseline)
+    if regressions:
+        print("{} benchmarks regressed: {}".format(len(regressions),
+                                                   ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 11:25:31 2026
+
+@author: Ben
+
+End-to-end benchmark of mark_helper on a synthetic cohort (see cohort.py),
+with stub_compile.py standing in for TeX, so that it runs on any machine.
+Runs scan, prebuild, revalidate, compile, check (simulated: outputs are
+accepted without opening an editor), makemerged and a final rescan, then
+prints the throughput and latency of each stage of each step.
+
+Usage: python bench_pipeline.py [--scripts N] [--pages MIN MAX]
+       [--multi FRACTION] [--image-kb KB] [--seed SEED] [--workdir DIR]
+       [--keep] [--delay SECONDS] [--json FILE] [--verbose]
+"""
+import os
+import io
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+import cohort
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import mark_helper as mh  # noqa: E402
+import mh_edit_management as mhem  # noqa: E402
+import mh_hash  # noqa: E402
+import mh_perf  # noqa: E402
+import mh_script_management as mhsm  # noqa: E402
+import mh_state as mhst  # noqa: E402
+
+# questions marked in every script
+QUESTIONS = ["1", "2", "3"]
+
+
+def write_config(path, script_dir, delay=0.0):
+    '''
+    Write a marking config for the cohort in `script_dir` to `path`, using
+    the benchmark template and stub compiler (sleeping `delay` seconds per
+    compile)
+    '''
+    compile_command = " ".join(shlex.quote(tok) for tok in [
+        sys.executable, os.path.join(BENCH_DIR, "stub_compile.py"),
+        "--delay", str(delay)])
+    with open(path, 'w') as file:
+        json.dump({"script": {"numsep": "_", "suffix": ".pdf",
+                              "directory": script_dir},
+                   "marking": {"editor": "true",
+                               "template": os.path.join(BENCH_DIR,
+                                                        "bench_template.txt"),
+                               "directory": "source",
+                               "marked suffix": "_m.tex",
+                               "output suffix": "_m.pdf",
+                               "compile command": compile_command,
+                               "source escape": "%#"},
+                   "merge": {"merged suffix": "_m.pdf",
+                             "merge directory": "merge",
+                             "final directory": "final"}}, file, indent=1)
+
+
+def simulate_check(questions):
+    '''
+    Accept the compiled output of every marked script, as `check` does once
+    the marker approves it
+
+    Returns
+    -------
+    bool : True on success
+    '''
+    cfg = mh.g_config
+    to_check = mhsm.check_marking_state(cfg, questions, True, True)[0]
+    for tag in to_check:
+        record = to_check[tag]
+        record.out_hash = mh_hash.hash_pdf_stable(
+            [tag + cfg.output_suffix()], cfg.marking_dir())
+        record.valid_marks = dict(record.marks)
+    mhst.get_store(cfg.script_dir()).put_many(to_check)
+    return True
+
+
+def compile_marked(questions):
+    '''
+    Compile every marked script as `compile` does after marking, which
+    changes the source files compiled by prebuild (so forget those compiles)
+
+    Returns
+    -------
+    bool : True on success
+    '''
+    mhem.g_compile_cache.clear()
+    return mh.run_compile(questions)
+
+
+# (name, function run with no arguments returning True on success)
+STEPS = [("scan", lambda: mh.run_scan(QUESTIONS, False, False,
+                                      mh.g_config)),
+         ("prebuild", lambda: mh.run_prebuild(QUESTIONS, True)),
+         ("revalidate", lambda: mh.run_revalidate(QUESTIONS, True)),
+         ("compile", lambda: compile_marked(QUESTIONS)),
+         ("check", lambda: simulate_check(QUESTIONS)),
+         ("makemerged", lambda: mh.run_make_merged(QUESTIONS, mh.g_config)),
+         ("rescan", lambda: mh.run_scan(QUESTIONS, True, True,
+                                        mh.g_config))]
+
+
+def run_step(name, func, verbose=False):
+    '''
+    Run benchmark step `name` by calling `func`, hiding its output unless
+    `verbose`
+
+    Returns
+    -------
+    [ok, report] : result of `func` and mh_perf report of the step
+    '''
+    token = mh_perf.g_recorder.begin()
+    out = sys.stdout if verbose else io.StringIO()
+    with contextlib.redirect_stdout(out):
+        ok = func()
+    return [bool(ok), mh_perf.g_recorder.end(token, name)]
+
+
+def format_step(report, n_scripts):
+    '''
+    Returns
+    -------
+    list of lines describing the mh_perf `report` of a step over
+    `n_scripts` scripts
+    '''
+    wall = report["wall time"]
+    lines = ["{}: {:.3f} s, {:.1f} scripts/s".format(
+        report["command"], wall, n_scripts / wall if wall else 0.0)]
+    for stage in report["stages"]:
+        st = report["stages"][stage]
+        lines.append("  {:<12} {:>6} {:>9.1f}/s  latency ms: mean {:.2f} "
+                     "p50 {:.2f} p95 {:.2f} max {:.2f}".format(
+                         stage, st["count"], st["throughput"],
+                         st["mean"] * 1000, st["p50"] * 1000,
+                         st["p95"] * 1000, st["max"] * 1000))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark of mark_helper on a synthetic " +
+        "cohort.")
+    cohort.add_cohort_args(parser)
+    parser.add_argument("--workdir", default="",
+                        help="directory to work in (default: a temporary " +
+                        "directory, removed afterwards)")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the temporary directory")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="seconds each stub compile sleeps " +
+                        "(default: %(default)s)")
+    parser.add_argument("--json", default="",
+                        help="also write the results to this json file")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of each step")
+    args = parser.parse_args(argv)
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(
+        prefix="mh_bench_"))
+    json_path = os.path.abspath(args.json) if args.json else ''
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)  # Log.txt goes here
+    try:
+        script_dir = os.path.join(workdir, "scripts")
+        start = time.perf_counter()
+        scripts = cohort.make_cohort(script_dir, args.scripts,
+                                     args.pages[0], args.pages[1],
+                                     args.multi, args.image_kb, args.seed)
+        print("Generated {} scripts ({} files) in {:.1f} s".format(
+            len(scripts), sum(len(f) for f in scripts.values()),
+            time.perf_counter() - start))
+        write_config("marking.cfg", script_dir, args.delay)
+        mh.setup_logging()
+        mh.g_config.path = "marking.cfg"
+        mh.g_config.load()
+
+        results = {"cohort": {"scripts": args.scripts, "pages": args.pages,
+                              "multi": args.multi,
+                              "image kb": args.image_kb, "seed": args.seed},
+                   "steps": {}}
+        status = 0
+        for name, func in STEPS:
+            ok, report = run_step(name, func, args.verbose)
+            results["steps"][name] = report
+            print("\n".join(format_step(report, len(scripts))))
+            if not ok:
+                print("{} failed (rerun with --verbose for details)"
+                      .format(name))
+                status = 1
+                break
+        mh.cmd_exit([])
+        if json_path:
+            with open(json_path, 'w') as file:
+                json.dump(results, file, indent=1)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        elif args.keep:
+            print("Kept " + workdir)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 14:02:17 2026
+
+@author: Ben
+
+Timing helpers shared by the benchmark scripts
+"""
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import mh_stats  # noqa: E402
+
+# default rounds measured per benchmark
+ROUNDS = 7
+# default minimum seconds per round
+MIN_TIME = 0.2
+
+
+def measure(func, ops=1, rounds=ROUNDS, min_time=MIN_TIME):
+    '''
+    Time repeated calls of `func` (which does `ops` operations per call) in
+    `rounds` rounds of at least `min_time` seconds each, after one untimed
+    warm-up call
+
+    Returns
+    -------
+    list of operations per second, one per round
+    '''
+    func()
+    # calls per round, doubled until one round takes long enough
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        calls *= 2
+    samples = [calls * ops / elapsed]
+    for _ in range(rounds - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        samples.append(calls * ops / (time.perf_counter() - start))
+    return samples
+
+
+def summarise(samples):
+    '''
+    Returns
+    -------
+    {"median", "q1", "q3", "iqr"} of list of numbers `samples`
+    '''
+    ordered = sorted(samples)
+    q1 = mh_stats.quantile(ordered, 0.25)
+    q3 = mh_stats.quantile(ordered, 0.75)
+    return {"median": mh_stats.quantile(ordered, 0.5), "q1": q1, "q3": q3,
+            "iqr": q3 - q1}
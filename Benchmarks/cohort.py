@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 10:12:48 2026
+
+@author: Ben
+
+Generate synthetic cohorts of pdf scripts for benchmarking, without TeX or
+any other external tool. Each page carries a line of text and optionally a
+block of random image data standing in for a scan.
+
+Usage: python cohort.py <directory> [--scripts N] [--pages MIN MAX]
+       [--multi FRACTION] [--image-kb KB] [--seed SEED]
+"""
+import os
+import sys
+import random
+import argparse
+
+# A4 in points
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+# width in pixels of the random (8 bit grey) image on each page
+IMAGE_WIDTH = 256
+
+
+def pdf_page_count(path):
+    '''
+    Returns
+    -------
+    number of pages in a pdf written by `write_pdf` (without parsing it)
+    '''
+    with open(path, 'rb') as file:
+        return file.read().count(b'/Type /Page ')
+
+
+def write_pdf(path, n_pages, text="", image_bytes=0, rng=None):
+    '''
+    Write a valid pdf file of `n_pages` A4 pages to `path`, each showing
+    `text` and its page number and, if `image_bytes` > 0, an uncompressed
+    grey image of about that many bytes of random data (from random.Random
+    `rng`)
+    '''
+    if rng is None:
+        rng = random.Random()
+    objects = []  # bytes of object i+1
+
+    def add(data):
+        objects.append(data)
+        return len(objects)
+
+    catalog = add(b'')  # filled in once pages known
+    pages = add(b'')
+    font = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    kids = []
+    rows = -(-image_bytes // IMAGE_WIDTH)
+    for i in range(n_pages):
+        content = "BT /F1 14 Tf 72 {} Td ({} page {}) Tj ET".format(
+            PAGE_HEIGHT - 72, text.replace('\\', '').replace('(', '')
+            .replace(')', ''), i + 1)
+        resources = "/Font << /F1 {} 0 R >>".format(font)
+        if rows:
+            data = rng.getrandbits(8 * IMAGE_WIDTH * rows).to_bytes(
+                IMAGE_WIDTH * rows, 'little')
+            image = add("<< /Type /XObject /Subtype /Image /Width {} "
+                        "/Height {} /ColorSpace /DeviceGray "
+                        "/BitsPerComponent 8 /Length {} >>\nstream\n"
+                        .format(IMAGE_WIDTH, rows, len(data)).encode() +
+                        data + b'\nendstream')
+            resources += " /XObject << /Im0 {} 0 R >>".format(image)
+            content = "q {} 0 0 {} 72 72 cm /Im0 Do Q ".format(
+                PAGE_WIDTH - 144, PAGE_HEIGHT - 216) + content
+        stream = add("<< /Length {} >>\nstream\n{}\nendstream".format(
+            len(content), content).encode())
+        kids.append(add("<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}] "
+                        "/Resources << {} >> /Contents {} 0 R >>"
+                        .format(pages, PAGE_WIDTH, PAGE_HEIGHT, resources,
+                                stream).encode()))
+    objects[catalog - 1] = "<< /Type /Catalog /Pages {} 0 R >>".format(
+        pages).encode()
+    objects[pages - 1] = "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+        " ".join("{} 0 R".format(k) for k in kids), n_pages).encode()
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for i, data in enumerate(objects):
+        offsets.append(len(out))
+        out += "{} 0 obj\n".format(i + 1).encode() + data + b'\nendobj\n'
+    xref = len(out)
+    out += "xref\n0 {}\n0000000000 65535 f \n".format(
+        len(objects) + 1).encode()
+    for offset in offsets:
+        out += "{:010d} 00000 n \n".format(offset).encode()
+    out += "trailer\n<< /Size {} /Root {} 0 R >>\nstartxref\n{}\n%%EOF\n" \
+        .format(len(objects) + 1, catalog, xref).encode()
+    with open(path, 'wb') as file:
+        file.write(out)
+
+
+def make_cohort(directory, n_scripts, min_pages=1, max_pages=10, multi=0.0,
+                image_kb=0, seed=0, numsep='_', suffix='.pdf'):
+    '''
+    Write a cohort of `n_scripts` scripts to `directory` (created if needed)
+
+    Parameters
+    ----------
+    directory : str - directory for the script files
+
+    n_scripts : int - number of scripts
+
+    min_pages, max_pages : int - range of pages per script (uniform)
+
+    multi : float - fraction of scripts split over 2 or 3 files
+    (<tag><numsep>1<suffix> etc), for scripts of more than one page
+
+    image_kb : int - KB of random image data per page (0 for text only)
+
+    seed : int - seed making the cohort reproducible
+
+    Returns
+    -------
+    {tag: list of file names} for the scripts written
+    '''
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    width = len(str(n_scripts))
+    scripts = {}
+    for n in range(n_scripts):
+        tag = "S{:0{}d}".format(n, width)
+        pages = rng.randint(min_pages, max_pages)
+        n_files = rng.randint(2, 3) if rng.random() < multi else 1
+        n_files = min(n_files, pages)
+        if n_files == 1:
+            split = [pages]
+            names = [tag + suffix]
+        else:
+            cuts = sorted(rng.sample(range(1, pages), n_files - 1))
+            split = [b - a for a, b in zip([0] + cuts, cuts + [pages])]
+            names = ["{}{}{}{}".format(tag, numsep, i + 1, suffix)
+                     for i in range(n_files)]
+        for name, count in zip(names, split):
+            write_pdf(os.path.join(directory, name), count, tag,
+                      image_kb * 1024, rng)
+        scripts[tag] = names
+    return scripts
+
+
+def add_cohort_args(parser):
+    '''
+    Add arguments describing a cohort to argparse.ArgumentParser `parser`
+    '''
+    parser.add_argument("--scripts", type=int, default=100,
+                        help="number of scripts (default: %(default)s)")
+    parser.add_argument("--pages", type=int, nargs=2, default=[1, 10],
+                        metavar=("MIN", "MAX"),
+                        help="pages per script (default: 1 10)")
+    parser.add_argument("--multi", type=float, default=0.2,
+                        help="fraction of scripts split over several " +
+                        "files (default: %(default)s)")
+    parser.add_argument("--image-kb", type=int, default=0,
+                        help="KB of random image data per page " +
+                        "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed (default: %(default)s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic cohort of pdf scripts.")
+    parser.add_argument("directory", help="directory for the scripts")
+    add_cohort_args(parser)
+    args = parser.parse_args(argv)
+    scripts = make_cohort(args.directory, args.scripts, args.pages[0],
+                          args.pages[1], args.multi, args.image_kb, args.seed)
+    print("Wrote {} scripts ({} files) to {}".format(
+        len(scripts), sum(len(f) for f in scripts.values()), args.directory))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 10:40:05 2026
+
+@author: Ben
+
+Stand-in for pdflatex when benchmarking: reads the page count from the
+'%pages <n>' line of a source file made from bench_template.txt and writes a
+valid overlay pdf with that many pages next to it.
+
+Usage: python stub_compile.py [--delay SECONDS] <source file>
+"""
+import os
+import re
+import sys
+import time
+
+import cohort
+
+
+def main(argv):
+    delay = 0.0
+    if len(argv) > 2 and argv[0] == "--delay":
+        delay = float(argv[1])
+        argv = argv[2:]
+    if len(argv) != 1:
+        print(__doc__.strip().splitlines()[-1])
+        return 2
+    source = argv[0]
+    with open(source) as file:
+        found = re.search(r'^%pages (\d+)', file.read(), re.MULTILINE)
+    if found is None:
+        print("No '%pages' line in {}".format(source))
+        return 1
+    time.sleep(delay)  # e.g. to mimic the time TeX takes
+    cohort.write_pdf(os.path.splitext(source)[0] + ".pdf",
+                     int(found.group(1)), "Marked")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,6 +4,7 @@ Created on Tue May 12 11:27:32 2020
 
 @author: Ben
 """
+import copy
 import json
 
 import logging
@@ -145,6 +146,18 @@ class Config:
         raise ValueError("Property {} not found in {}"
                          .format(prop_name, category))
 
+    def copy(self):
+        '''
+        Returns
+        -------
+        Copy of this config (of the same class) whose properties can be set
+        without affecting this one
+        '''
+        other = copy.copy(self)
+        other._categories = {sec: dict(self._categories[sec])
+                             for sec in self._categories}
+        return other
+
     def load(self):
         """
         Update config data from self.path (a json file)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 09:20:14 2026
+
+@author: Ben
+"""
+import importlib
+
+
+class LazyModule:
+    '''
+    Stand-in for a module that is only imported when one of its attributes is
+    first used, so that modules slow to load cost nothing at startup if they
+    are never needed. Safe to first use from several threads at once (the
+    import itself is serialised by the import system)
+    '''
+
+    def __init__(self, name):
+        """
+        Parameters
+        ----------
+        name : str - full name of the module to import
+
+        Returns
+        -------
+        None.
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name)
+            self._module = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module {!r}{}>".format(
+            self._name, "" if self._module is None else " (loaded)")
+
+
+def lazy_import(name):
+    '''
+    Returns
+    -------
+    LazyModule for module `name`. An ImportError (e.g. if it is not
+    installed) is raised on first use rather than here
+    '''
+    return LazyModule(name)
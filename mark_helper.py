@@ -7,21 +7,40 @@ Date 01/04/2020
 Tool to help streamline marking pdf scripts in tex
 '''
 
+import time
+g_start_time = time.perf_counter()  # for --timing
+
 import os
+import sys
 import logging
+import threading
 
 
+import lazyimport
 import loghelper
+import mh_hash
 import mh_script_management as mhsm
-import mh_edit_management as mhem
+import mh_lease as mhl
+import mh_metrics
+import mh_perf
+import mh_state as mhst
+import mh_workspace
+# only needed by some commands, so loaded on first use
+argparse = lazyimport.lazy_import("argparse")
+asyncio = lazyimport.lazy_import("asyncio")
+mhem = lazyimport.lazy_import("mh_edit_management")
+mhpl = lazyimport.lazy_import("mh_pipeline")
+mh_profile = lazyimport.lazy_import("mh_profile")
+mhp = lazyimport.lazy_import("mh_parsing")
+mh_stats = lazyimport.lazy_import("mh_stats")
 
+g_import_time = time.perf_counter()  # for --timing
 
-logging.basicConfig(filename="Log.txt", format="{asctime}#################" +
-                    "##################################\n{message}",
-                    style="{")
 logger = logging.getLogger(__name__)
 
-g_config = mhsm.MarkingConfig("marking.cfg")
+g_config = mhsm.MarkingConfig("marking.cfg")  # current paper, see use_paper
+g_workspace = mh_workspace.Workspace()  # all papers being marked
+g_exporter = None  # mh_metrics.Exporter while exporting metrics
 
 ###############################################################################
 # Command line interface
@@ -33,11 +52,61 @@ g_config = mhsm.MarkingConfig("marking.cfg")
 
 def cmd_exit(args):
     '''
-    **CLI command:** Causes CLI loop to quit
+    **CLI command:** Causes CLI loop to quit (after folding the marking state
+    journals of all papers into the mkh files)
     '''
+    directories = {cfg.script_dir() for cfg in
+                   list(g_workspace.papers.values()) or [g_config]}
+    for directory in sorted(directories):
+        try:
+            mhst.get_store(directory).compact()
+        except OSError:
+            loghelper.print_and_log(logger, "Warning! Failed to compact " +
+                                    "marking state journal in {}."
+                                    .format(directory))
     return False
 
 
+def cmd_config(args):
+    '''
+    **CLI command:** Edit the config of the current paper (see
+    config.Config.cmd_config)
+    '''
+    return g_config.cmd_config(args)
+
+
+def cmd_job(args):
+    '''
+    **CLI command:** With no arguments list the papers in the workspace. Use
+    'job <name>' to switch to marking paper <name>, or 'job add <name>
+    <config file>' to add a paper (and save the workspace file)
+    '''
+    if not args:
+        for name in g_workspace.papers:
+            print("{} {}: {}".format('*' if name == g_workspace.current
+                                     else ' ', name,
+                                     g_workspace.papers[name].script_dir()))
+    elif args[0] == 'add' and len(args) == 3:
+        try:
+            g_workspace.add(args[1], args[2])
+        except OSError:
+            loghelper.print_and_log(logger, "Failed to load config file " +
+                                    "{}.".format(args[2]))
+            return True
+        try:
+            g_workspace.save()
+        except OSError:
+            loghelper.print_and_log(logger, "Warning! Failed to save " +
+                                    "workspace file.")
+        print("Added paper {}.".format(args[1]))
+    elif len(args) == 1:
+        if use_paper(args[0]):
+            print("Now marking {}.".format(args[0]))
+    else:
+        print("Usage: job [<name>|add <name> <config file>]")
+    return True
+
+
 def cmd_begin(args):
     """
     **CLI command:** Let user select some questions, then open each script
@@ -64,6 +133,10 @@ def cmd_begin(args):
         if to_mark == {}:
             print("Marking complete!")
             break
+        unclaimed(to_mark, g_config)
+        if to_mark == {}:
+            print("Remaining scripts are being marked by others.")
+            break
         try:  # precompile
             print("Precompiling...")
             mhem.pre_build(to_mark, g_config)
@@ -72,16 +145,297 @@ def cmd_begin(args):
         except Exception:
             loghelper.print_and_log(logger, "Precompiling failed!")
             return True
-        for tag in to_mark:
-            print("Now marking " + tag)
+        quit_flag = mark_each(to_mark, "Now marking ", question_names,
+                              source_validate, False)
+    return True
+
+
+def cmd_prepare(args):
+    '''
+    **CLI command:** Let user select some questions, then reset the source
+    file of every script still to mark for those questions, in parallel, so
+    that `begin` only has to open the editor
+    '''
+    inp = input("Questions to mark (separated by spaces): ")
+    question_names = inp.split()
+
+    source_validate = input("Do final validation of source file? [y/n]: ") \
+        in ["y", "Y"]
+
+    print("Checking marking state...")
+    try:
+        to_mark = mhsm.check_marking_state(g_config, question_names,
+                                           source_validate)[0]
+    except Exception:
+        loghelper.print_and_log(logger, "Failed to update marking state!")
+        return True
+    unclaimed(to_mark, g_config)
+    done, failed = mhem.batch_prepare(to_mark, question_names,
+                                      source_validate, g_config)
+    print("Prepared {} scripts.".format(len(done)))
+    if failed:
+        print("Failed to prepare (see log): ")
+        print_some(sorted(failed))
+    return True
+
+
+def cmd_revalidate(args):
+    '''
+    **CLI command:** Let user select some questions, then re-run the mark
+    extraction and validation of every source file in parallel (without
+    opening the editor). Save the updated marking state and list scripts
+    that now fail validation
+    '''
+    inp = input("Questions to revalidate (separated by spaces): ")
+    question_names = inp.split()
+
+    source_validate = input("Do final validation of source file? [y/n]: ") \
+        in ["y", "Y"]
+
+    run_revalidate(question_names, source_validate)
+    return True
+
+
+def run_revalidate(question_names, source_validate):
+    '''
+    Body of `cmd_revalidate` without prompts
+
+    Returns
+    -------
+    bool : True if all scripts were checked and the state saved
+    '''
+    print("Checking marking state...")
+    try:
+        to_mark, done_mark = mhsm.check_marking_state(g_config,
+                                                      question_names,
+                                                      source_validate)
+    except Exception:
+        loghelper.print_and_log(logger, "Failed to update marking state!")
+        return False
+    to_mark.update(done_mark)
+    unclaimed(to_mark, g_config)
+    try:
+        checked, changed, failures = mhem.batch_revalidate(
+            to_mark, question_names, source_validate, g_config)
+    except OSError:
+        loghelper.print_and_log(logger, "Failed to save marking state!")
+        return False
+    print("Revalidated {} scripts ({} updated).".format(len(checked),
+                                                        len(changed)))
+    if failures:
+        print("{} scripts now fail validation: ".format(len(failures)))
+        for tag in sorted(failures):
+            print("{}: {}".format(tag, failures[tag]))
+    return True
+
+
+def run_scan(question_names, source_validate, output_validate, cfg):
+    '''
+    Check the marking state of all scripts of paper `cfg` (MarkingConfig) and
+    report how many are marked (and checked, if `output_validate`) for
+    `question_names`
+
+    Returns
+    -------
+    bool : True if the state could be read
+    '''
+    try:
+        to_mark, done_mark = mhsm.check_marking_state(cfg,
+                                                      question_names,
+                                                      source_validate,
+                                                      output_validate)
+    except Exception:
+        loghelper.print_and_log(logger, "Failed to update marking state!")
+        return False
+    print("{} scripts done, {} remaining.".format(len(done_mark),
+                                                  len(to_mark)))
+    print_some(sorted(to_mark))
+    return True
+
+
+def run_scan_all(question_names, source_validate, output_validate, papers,
+                 cfg):
+    '''
+    As `run_scan` for each paper in {name: MarkingConfig} `papers` at once
+    (see mh_workspace.scan_all), with the hashing workers set in `cfg`
+
+    Returns
+    -------
+    bool : True if the state of every paper could be read
+    '''
+    results = mh_workspace.scan_all(papers, question_names,
+                                    source_validate, output_validate,
+                                    cfg.stage_workers("hash"))
+    ok = True
+    for name in results:
+        if results[name] is None:
+            ok = False
+            continue
+        to_mark, done_mark = results[name]
+        print("{}: {} scripts done, {} remaining.".format(
+            name, len(done_mark), len(to_mark)))
+    return ok
+
+
+def run_prebuild(question_names, source_validate):
+    '''
+    Create and compile the source file of each script still to mark for
+    `question_names` (as `begin` does before opening the editor)
+
+    Returns
+    -------
+    bool : True on success
+    '''
+    print("Checking marking state...")
+    try:
+        to_mark = mhsm.check_marking_state(g_config, question_names,
+                                           source_validate)[0]
+    except Exception:
+        loghelper.print_and_log(logger, "Failed to update marking state!")
+        return False
+    unclaimed(to_mark, g_config)
+    try:
+        print("Precompiling...")
+        mhem.pre_build(to_mark, g_config, manual_fallback=False)
+        print("Precompiling successful!")
+    except Exception:
+        loghelper.print_and_log(logger, "Precompiling failed!")
+        return False
+    return True
+
+
+def run_compile(question_names):
+    '''
+    Compile the source file of each script marked for `question_names` whose
+    output has not been checked (as `check` does before opening the editor)
+
+    Returns
+    -------
+    bool : True on success
+    '''
+    def progress(done, total):
+        print("\rCompiling: {}/{}. ".format(done, total), end='\r')
+
+    return run_async(compile_marked(question_names, progress, g_config))
+
+
+async def compile_marked(question_names, progress, cfg):
+    '''
+    Body of `run_compile` for paper `cfg` (MarkingConfig), compiling up to
+    cfg.stage_workers("compile") source files at once. `progress` is called
+    as progress(done, total) as each compile finishes
+    '''
+    print("Checking marking state...")
+    to_mark = await in_thread(compile_targets, question_names, cfg)
+    if to_mark is None:
+        return False
+    print("Compiling {} scripts...".format(len(to_mark)))
+    inputs = mhem.script_inputs(to_mark, cfg.script_dir())
+    failed = await mhem.batch_compile_async(
+        cfg.marking_dir(),
+        [tag + cfg.marked_suffix() for tag in to_mark],
+        cfg.compile_command(), cfg.stage_workers("compile"),
+        progress, {tag + cfg.marked_suffix(): inputs[tag]
+                   for tag in inputs})
+    print('')  # newline to break from progress bar
+    failed += [tag + cfg.marked_suffix() for tag in to_mark
+               if not os.path.isfile(cfg.tag_to_outputpath(tag))
+               and tag + cfg.marked_suffix() not in failed]
+    if failed:
+        print("{} files failed to compile (compile these manually): "
+              .format(len(failed)))
+        print_some(sorted(failed))
+        return False
+    print("Compiling successful!")
+    return True
+
+
+def compile_targets(question_names, cfg):
+    '''
+    Returns
+    -------
+    {tag: ScriptRecord} for scripts of paper `cfg` (MarkingConfig) marked
+    for `question_names` but not
+    checked, and not claimed by another marker, or None (after reporting
+    why) if some scripts are not yet marked or the state cannot be read
+    '''
+    try:
+        to_mark = mhsm.check_marking_state(cfg, question_names,
+                                           True, False)[0]
+        if to_mark != {}:
+            print("Some scripts missing marks or validation: ")
+            print_some(to_mark)
+            return None
+        to_mark = mhsm.check_marking_state(cfg, question_names,
+                                           True, True)[0]
+    except Exception:
+        loghelper.print_and_log(logger, "Failed to update marking state!")
+        return None
+    unclaimed(to_mark, cfg)
+    return to_mark
+
+
+def unclaimed(to_mark, cfg):
+    '''
+    Remove scripts claimed by other markers from dict `to_mark` (scripts of
+    paper `cfg`) and report them
+    '''
+    others = mhl.claimed_by_others(cfg.script_dir())
+    for tag in others:
+        if tag in to_mark:
+            print("Skipping {} (claimed by {})".format(tag, others[tag]))
+            del to_mark[tag]
+
+
+def mark_each(to_mark, msg, question_names, source_validate,
+              output_validate):
+    '''
+    Claim each script in `to_mark` in turn and run mhem.mark_one_loop on it,
+    renewing the claim while the script is open and releasing it once its
+    marking state is saved. Scripts claimed, or whose saved state has
+    changed, since `to_mark` was made are skipped.
+
+    Returns
+    -------
+    bool : True if user quit
+    '''
+    for tag in to_mark:
+        lease = mhl.try_claim(g_config.script_dir(), tag)
+        if lease is None:
+            print("Skipping {} (claimed by another marker)".format(tag))
+            continue
+        with lease:
+            if mhsm.state_changed_since(tag, to_mark[tag], g_config):
+                print("Skipping {} (updated by another marker)".format(tag))
+                continue
+            print(msg + tag)
             quit_flag = not mhem.mark_one_loop(tag, to_mark, g_config,
                                                question_names,
-                                               source_validate, False)
+                                               source_validate,
+                                               output_validate)
             # update marking state in file
             mhsm.declare_marked(tag, to_mark, g_config)
-            if quit_flag:
-                break
-    return True
+        if quit_flag:
+            return True
+    return False
+
+
+def report_perf(token, command, cfg):
+    '''
+    Finish timing `command` (started by mh_perf.g_recorder.begin returning
+    `token`). If any spans were recorded print the performance report and
+    save it in the script directory of paper `cfg`
+    '''
+    report = mh_perf.g_recorder.end(token, command)
+    if not report["stages"]:
+        return
+    for line in mh_perf.format_report(report):
+        print(line)
+    try:
+        mh_perf.save_report(report, cfg.script_dir())
+    except OSError:
+        loghelper.print_and_log(logger, "Warning! Failed to save " +
+                                "performance report.")
 
 
 def print_some(data, n=10):
@@ -132,24 +486,21 @@ def cmd_build_n_check(args):
         if to_mark == {}:
             print("Checking complete!")
             break
+        unclaimed(to_mark, g_config)
+        if to_mark == {}:
+            print("Remaining scripts are being checked by others.")
+            break
 
         try:  # compile
             print("Compiling...")
             mhem.batch_compile_and_check(g_config.marking_dir(), to_mark,
-                                         g_config)
+                                         g_config, records=to_mark)
             print("Compiling successful!")
         except Exception:
             loghelper.print_and_log(logger, "Compiling failed!")
             return True
-        for tag in to_mark:
-            print("Now checking " + tag)
-            quit_flag = not mhem.mark_one_loop(tag, to_mark, g_config,
-                                               question_names,
-                                               True, True)
-            # update marking state in file
-            mhsm.declare_marked(tag, to_mark, g_config)
-            if quit_flag:
-                break
+        quit_flag = mark_each(to_mark, "Now checking ", question_names,
+                              True, True)
     return True
 
 
@@ -198,34 +549,75 @@ def cmd_makecsv(args):
     inp = input("Questions for which to extract marks (separated by spaces): ")
     question_names = inp.split()
 
+    verify = input("Check script and output files are unchanged? [y/n]: ") \
+        in ["y", "Y"]
+
+    run_makecsv(out_path, question_names, verify)
+    return True
+
+
+def run_makecsv(out_path, question_names, verify):
+    '''
+    Body of `cmd_makecsv` without prompts: write validated marks for
+    `question_names` to `out_path` (overwriting it), first checking files
+    against their saved hashes if `verify`
+
+    Returns
+    -------
+    bool : True if the csv file was written
+    '''
     try:
-        # initialize to_mark from given script directory
-        to_mark, done_mark = mhsm.check_marking_state(g_config,
-                                                      question_names,
-                                                      True, True)
+        # marks as saved when output was validated, no files rehashed
+        records, unsaved = mhsm.read_marking_state(g_config)
+        incomplete = unsaved + [tag for tag in records
+                                if not records[tag].out_hash or
+                                any(q not in records[tag].valid_marks
+                                    for q in question_names)]
+        if verify:
+            print("Checking files...")
+            failures = mhsm.verify_marking_state(records, g_config)
+            incomplete += [tag for tag in failures if tag not in incomplete]
     except Exception:
         loghelper.print_and_log(logger, "Failed to read marking state!")
-        return True
+        return False
 
-    if to_mark != {}:
+    if incomplete:
         print("Selected questions may not be validly marked in some" +
               " scripts. Including: ")
-        print_some(to_mark)
+        print_some(sorted(incomplete))
         print("Remember to run \'check\' command for final version.")
-        return True
+        return False
 
     try:
-        with open(out_path, 'w') as file:
-            file.write("Script #")  # header line
-            for q in question_names:
-                file.write(", Question {}".format(q))
-            # body
-            for d in sorted(done_mark.keys()):
-                file.write("\n{}".format(d))
-                for q in question_names:
-                    file.write(",{}".format(done_mark[d][4][1][q]))
+        mhsm.write_marks_csv(out_path, records, question_names)
     except Exception:
         loghelper.print_and_log(logger, "Failed to write csv file.")
+        return False
+    return True
+
+
+def cmd_stats(args):
+    '''
+    **CLI command:** Use argument 'marks' to print per-question statistics
+    (mean, standard deviation, quartiles, histogram and outliers) of the
+    validated marks across all scripts, and list scripts missing marks
+    '''
+    if args[:1] != ['marks']:
+        print("Usage: stats marks")
+        return True
+    inp = input("Questions (separated by spaces, blank for all): ")
+    question_names = inp.split()
+
+    try:
+        records, unsaved = mhsm.read_marking_state(g_config)
+    except Exception:
+        loghelper.print_and_log(logger, "Failed to read marking state!")
+        return True
+    report, missing = mh_stats.mark_stats(records, question_names)
+    for tag in unsaved:
+        missing[tag] = question_names or ["(not marked)"]
+    for line in mh_stats.format_report(report, missing):
+        print(line)
     return True
 
 
@@ -242,93 +634,459 @@ def cmd_make_merged_output(args):
                 "(separated by spaces): ")
     question_names = inp.split()
 
+    run_make_merged(question_names, g_config)
+    return True
+
+
+def run_make_merged(question_names, cfg, progress=None):
+    '''
+    Body of `cmd_make_merged_output` without prompts, for paper `cfg`
+    (MarkingConfig). If given, `progress`
+    is called as progress(done, total) as each final output is made, instead
+    of printing a progress bar
+
+    Returns
+    -------
+    bool : True if final output was made for every script
+    '''
     print("Checking marking state...")
     try:
         # check for scripts with unmarked questions (from list) or which
         # have not had the source validated
-        to_mark, done_mark = mhsm.check_marking_state(g_config,
+        to_mark, done_mark = mhsm.check_marking_state(cfg,
                                                       question_names,
                                                       True, True)
         if to_mark != {}:
             print("Some scripts missing marks or validation: ")
             print_some(to_mark)
             print("Please ensure all marking completed before merging.")
-            return True
+            return False
     except Exception:
         loghelper.print_and_log(logger, "Failed to update marking state!")
-        return True
+        return False
 
-    '''
-    Make blanks
-    '''
-    print("Making blanks...")
-    blankdir = g_config.merged_dir()
-    newsourcedir = g_config.merged_sourcedir()
-    newfinaldir = g_config.final_dir()
+    blankdir = cfg.merged_dir()
+    newsourcedir = cfg.merged_sourcedir()
+    newfinaldir = cfg.final_dir()
     for path in [blankdir, newsourcedir, newfinaldir]:
         if not os.path.isdir(path):  # create directory if necessary
             os.mkdir(path)
-    for d in done_mark:
+
+    '''
+    Skip scripts whose final output was made from the current inputs
+    '''
+    manifest = mhsm.load_merge_manifest(cfg)
+    inputs = {}
+    failed = {}  # {tag: step that failed}
+    skipped = 0
+    for d in list(done_mark):
         try:
-            for file in done_mark[d][0]:  # constituent files
-                mhsm.make_blank_pdf_like(os.path.join(g_config.script_dir(),
-                                                      file),
-                                         os.path.join(blankdir, file))
-        except Exception:
-            loghelper.print_and_log(logger,
-                                    "Warning! Failed to make blanks for {}"
-                                    .format(d))
+            inputs[d] = mhsm.get_merge_inputs(d, done_mark, cfg)
+        except OSError:
+            logger.exception("Failed to hash inputs for %s", d)
+            failed[d] = "Hashing inputs"
+            del done_mark[d]
+            continue
+        if mhsm.is_merge_up_to_date(d, inputs[d], manifest, cfg):
+            del done_mark[d]
+            skipped += 1
+        else:
+            manifest.pop(d, None)  # until merged again
+    print("Skipping {} up-to-date scripts.".format(skipped))
+    if done_mark == {}:
+        return report_merge_failures(failed)
 
     '''
-    copy source files
+    Each script moves through the stages on its own:
+    make blanks -> copy source file -> compile -> merge
     '''
-    print("Copying source files...")
-    to_compile = []
-    for d in done_mark:
+    def blank_stage(d):
+        mhsm.make_blanks_for(d, done_mark, cfg)
+
+    def copy_stage(d):
+        strategy = mhem.stage_file(cfg.tag_to_sourcepath(d),
+                                   cfg.tag_to_mergesource(d))
+        with staged_lock:
+            staged[strategy] = staged.get(strategy, 0) + 1
+
+    def compile_stage(d):
+        blanks = [os.path.join(blankdir, f) for f in done_mark[d].files]
+        mhem.compile_one(newsourcedir, d + cfg.marked_suffix(),
+                         cfg.compile_command(), blanks)
+        mhem.batch_check_exist(newsourcedir, [d + cfg.output_suffix()])
+
+    def merge_stage(d):
+        mhsm.merge_pdfs(done_mark[d].files, cfg.tag_to_mergeoutput(d),
+                        cfg.tag_to_mergefinal(d), cfg.script_dir(),
+                        cfg.merge_memory_budget())
+        manifest[d] = inputs[d]
+        mh_metrics.merges.inc()
+        with staged_lock:
+            merged[0] += 1
+            mh_metrics.merge_rate.set(
+                merged[0] / max(time.perf_counter() - merge_start, 1e-9))
+
+    def report_done(d):
+        if progress is not None:
+            progress(len(manifest) - already_done, len(done_mark))
+            return
+        print("\rFinal output ready: {}/{}. "
+              .format(len(manifest) - already_done, len(done_mark)),
+              end='\r')
+
+    staged = {}  # {strategy: number of source files staged with it}
+    staged_lock = threading.Lock()
+    merged = [0]  # scripts merged by this run
+    merge_start = time.perf_counter()
+    print("Merging {} scripts...".format(len(done_mark)))
+    already_done = len(manifest)
+    try:
+        failed.update(mhpl.run_pipeline(
+            sorted(done_mark),
+            [mhpl.Stage("Making blanks", blank_stage,
+                        cfg.stage_workers("blank")),
+             mhpl.Stage("Copying source file", copy_stage,
+                        cfg.stage_workers("copy")),
+             mhpl.Stage("Compiling", compile_stage,
+                        cfg.stage_workers("compile")),
+             mhpl.Stage("Merging", merge_stage,
+                        cfg.stage_workers("merge"))],
+            cfg.queue_size(), report_done)[1])
+    finally:
+        print('')  # newline to break from progress bar
         try:
-            mhem.copyFile(g_config.tag_to_sourcepath(d),
-                          g_config.tag_to_mergesource(d))
-            to_compile.append(d)
-        except Exception:
-            loghelper.print_and_log(logger, "Warning! Failed to copy source " +
-                                    "file for {}".format(d))
+            mhsm.save_merge_manifest(cfg, manifest)
+        except OSError:
+            loghelper.print_and_log(logger, "Warning! Failed to save " +
+                                    "merge manifest.")
+    if staged:
+        print("Source files staged by: " +
+              ", ".join(["{} {}".format(k, staged[k]) for k in staged]))
+        logger.info("Source files staged by: %s", staged)
+    return report_merge_failures(failed)
+
 
+def report_merge_failures(failed):
     '''
-    compile source files
+    Print the scripts in {tag: step that failed} `failed` at the end of
+    `run_make_merged`
+
+    Returns
+    -------
+    bool : True if none failed
     '''
-    print("Compiling...")
-    mhem.batch_compile_and_check(newsourcedir, to_compile, g_config)
+    for d in sorted(failed):
+        print("{} failed for {}.".format(failed[d], d))
+    if failed:
+        print("Run makemerged again once these are fixed.")
+    print("Merge complete.")
+    return not failed
+
+
+# *****************************************************************************
+# Background jobs (interactive CLI only)
+
+
+class Job:
+    '''
+    Long command running in the background of the interactive CLI
+    '''
+
+    def __init__(self, name, cfg):
+        """
+        Parameters
+        ----------
+        name : str - name of the command
+
+        cfg : MarkingConfig - copy of the config of the current paper (so the
+        job is not affected if the config is changed while it runs)
 
+        Returns
+        -------
+        None.
+        """
+        self.name = name
+        self.cfg = cfg
+        self.progress = ''  # latest progress message
+        self.started = time.monotonic()
+        self.finished = None  # time.monotonic() when finished
+        self.ok = None  # result once finished
+        self.task = None  # asyncio.Task running the command
+
+    def describe(self):
+        '''
+        Returns one line describing the state of this job
+        '''
+        if self.finished is None:
+            state = "running"
+            elapsed = time.monotonic() - self.started
+        else:
+            state = "finished" if self.ok else "failed"
+            elapsed = self.finished - self.started
+        return "{}: {} ({:.0f} s){}".format(
+            self.name, state, elapsed,
+            ", " + self.progress if self.progress else "")
+
+    def report(self, done, total):
+        '''
+        Progress callback: record `done` out of `total` items complete
+        '''
+        self.progress = "{}/{}".format(done, total)
+
+
+g_jobs = {}  # {command name: Job} for latest background job of each command
+
+
+def run_async(main):
     '''
-    Merge files
+    Run coroutine `main` in a new event loop (see asyncio.run) able to run
+    compiler processes
+
+    Returns
+    -------
+    result of `main`
     '''
-    print("Merging...")
-    for d in done_mark:
+    if sys.platform == 'win32' and sys.version_info < (3, 8):
+        # the default event loop here cannot run subprocesses before 3.8
+        asyncio.set_event_loop_policy(
+            asyncio.WindowsProactorEventLoopPolicy())
+    return asyncio.run(main)
+
+
+async def ask(prompt):
+    '''
+    Returns
+    -------
+    line input by user after `prompt`, read without blocking the event loop
+    '''
+    return await asyncio.get_event_loop().run_in_executor(None, input,
+                                                          prompt)
+
+
+def start_job(name, func):
+    '''
+    Start running command `name` in the background, unless it is running
+    already. `func` is called with the new Job and returns an awaitable
+    giving True on success. The command must use the job's own copy of the
+    config (job.cfg), not g_config
+    '''
+    if name in g_jobs and g_jobs[name].finished is None:
+        print("{} is already running (see \'status\').".format(name))
+        return
+    job = Job(name, g_config.copy())
+
+    async def run():
+        token = mh_perf.g_recorder.begin()
+        mh_metrics.jobs_running.inc(value=name)
         try:
-            mhsm.merge_pdfs(done_mark[d][0], g_config.tag_to_mergeoutput(d),
-                            g_config.tag_to_mergefinal(d),
-                            g_config.script_dir())
+            job.ok = await func(job)
         except Exception:
-            loghelper.print_and_log(logger,
-                                    "Warning! Failed to merge output for {}"
-                                    .format(d))
-    print("Merge complete.")
+            loghelper.print_and_log(logger, "Problem occured in {}"
+                                    .format(name))
+            job.ok = False
+        finally:
+            mh_metrics.jobs_running.dec(value=name)
+        job.finished = time.monotonic()
+        print("\n" + job.describe())
+        report_perf(token, name, job.cfg)
+
+    g_jobs[name] = job
+    job.task = asyncio.ensure_future(run())
+    print("Started {} in the background (see \'status\').".format(name))
+
+
+def in_thread(func, *args):
+    '''
+    Returns
+    -------
+    awaitable running func(*args) in a worker thread (timed as part of the
+    current command)
+    '''
+    return asyncio.get_event_loop().run_in_executor(None, mh_perf.bind(func),
+                                                    *args)
+
+
+async def bg_scan(args):
+    '''
+    **CLI command:** Let user select some questions, then report in the
+    background which scripts are still to mark
+    '''
+    question_names = (await ask("Questions to check (separated by " +
+                                "spaces): ")).split()
+    source_validate = await ask("Require final validation of source " +
+                                "file? [y/n]: ") in ["y", "Y"]
+    output_validate = await ask("Require checked output? [y/n]: ") \
+        in ["y", "Y"]
+    start_job("scan", lambda job: in_thread(mh_profile.run_instrumented,
+                                            "scan", run_scan, question_names,
+                                            source_validate,
+                                            output_validate, job.cfg))
+
+
+async def bg_scan_all(args):
+    '''
+    **CLI command:** As `bg_scan` but for all papers in the workspace at once
+    '''
+    question_names = (await ask("Questions to check (separated by " +
+                                "spaces): ")).split()
+    source_validate = await ask("Require final validation of source " +
+                                "file? [y/n]: ") in ["y", "Y"]
+    output_validate = await ask("Require checked output? [y/n]: ") \
+        in ["y", "Y"]
+    papers = {name: g_workspace.papers[name].copy()
+              for name in g_workspace.papers}
+    start_job("scanall", lambda job: in_thread(
+        mh_profile.run_instrumented, "scanall", run_scan_all,
+        question_names, source_validate, output_validate, papers, job.cfg))
+
+
+async def bg_compile(args):
+    '''
+    **CLI command:** Let user select some questions, then compile in the
+    background all marked scripts whose output is not yet checked
+    '''
+    question_names = (await ask("Questions required in completed scripts " +
+                                "(separated by spaces): ")).split()
+    start_job("compile", lambda job: compile_marked(question_names,
+                                                    job.report, job.cfg))
+
+
+async def bg_make_merged(args):
+    '''
+    **CLI command:** As `cmd_make_merged_output` but merging in the
+    background
+    '''
+    question_names = (await ask("Confirm questions required in completed " +
+                                "scripts (separated by spaces): ")).split()
+    start_job("makemerged", lambda job: in_thread(
+        mh_profile.run_instrumented, "makemerged", run_make_merged,
+        question_names, job.cfg, job.report))
+
+
+def cmd_profile(args):
+    '''
+    **CLI command:** Use argument 'on' to profile (with cProfile) the
+    commands that follow, 'off' to stop, or 'dump <file>' to save the
+    profile collected (pstats format; also after 'off') and print the most
+    expensive functions
+    '''
+    if args[:1] == ['on']:
+        mh_profile.start_profile()
+        print("Profiling on.")
+    elif args[:1] == ['off']:
+        mh_profile.stop_profile()
+        print("Profiling off.")
+    elif args[:1] == ['dump'] and len(args) == 2:
+        try:
+            print(mh_profile.dump_profile(args[1]))
+            print("Profile saved to {}".format(args[1]))
+        except ValueError as e:
+            print(e)
+        except OSError:
+            loghelper.print_and_log(logger, "Failed to save profile.")
+    else:
+        print("Usage: profile on|off|dump <file>")
     return True
 
 
+def cmd_memtrace(args):
+    '''
+    **CLI command:** Use argument 'on' to trace memory allocations (with
+    tracemalloc) by the commands that follow, 'off' to stop, 'top [n]' to
+    print where the last command allocated most memory, or 'dump <file>'
+    to save a snapshot taken after the last command
+    '''
+    try:
+        if args[:1] == ['on']:
+            mh_profile.start_memtrace()
+            print("Memory tracing on.")
+        elif args[:1] == ['off']:
+            mh_profile.stop_memtrace()
+            print("Memory tracing off.")
+        elif args[:1] == ['top'] and len(args) <= 2:
+            for line in mh_profile.memtrace_top(*[int(a) for a in args[1:]]):
+                print(line)
+        elif args[:1] == ['dump'] and len(args) == 2:
+            mh_profile.dump_memtrace(args[1])
+            print("Snapshot saved to {}".format(args[1]))
+        else:
+            print("Usage: memtrace on|off|top [n]|dump <file>")
+    except ValueError as e:
+        print(e)
+    except OSError:
+        loghelper.print_and_log(logger, "Failed to save snapshot.")
+    return True
+
+
+def cmd_parsestats(args):
+    '''
+    **CLI command:** Use argument 'on' to count calls and time spent in
+    each template script command and active line while source files are
+    parsed, 'off' to stop, 'report [n]' to print the `n` hottest lines
+    or 'reset' to clear the counts
+    '''
+    if args[:1] == ['on']:
+        mhp.enable_stats()
+        print("Parser statistics on.")
+    elif args[:1] == ['off']:
+        mhp.disable_stats()
+        print("Parser statistics off.")
+    elif args[:1] == ['reset']:
+        if mhp.disable_stats() is not None:
+            mhp.enable_stats()
+    elif args[:1] == ['report'] and len(args) <= 2 and \
+            all(a.isdigit() for a in args[1:]):
+        if mhp.g_stats is None:
+            print("Parser statistics are off.")
+        else:
+            for line in mhp.g_stats.report(*[int(a) for a in args[1:]]):
+                print(line)
+    else:
+        print("Usage: parsestats on|off|report [n]|reset")
+    return True
+
+
+def cmd_status(args):
+    '''
+    **CLI command:** Print the state of background jobs
+    '''
+    if not g_jobs:
+        print("No background jobs.")
+    for name in g_jobs:
+        print(g_jobs[name].describe())
+    return True
+
+
+g_bg_handlers = {'scan': bg_scan,
+                 'scanall': bg_scan_all,
+                 'compile': bg_compile,
+                 'makemerged': bg_make_merged}  # run in the background
+
+
 # *****************************************************************************
 # *****************************************************************************
 # Main CLI cmd parser
 
 
-g_handlers = {"quit": cmd_exit, "config": g_config.cmd_config,
+g_handlers = {"quit": cmd_exit, "config": cmd_config,
+              'job': cmd_job,
               "begin": cmd_begin,
+              'prepare': cmd_prepare,
+              'revalidate': cmd_revalidate,
               'makecsv': cmd_makecsv,
               'check': cmd_build_n_check,
               'makemerged': cmd_make_merged_output,
+              'stats': cmd_stats,
+              'status': cmd_status,
+              'profile': cmd_profile,
+              'memtrace': cmd_memtrace,
+              'parsestats': cmd_parsestats,
               'invalidate': cmd_reset_validation}  # define handlers
 
 
+g_uninstrumented = {'profile', 'memtrace'}  # not profiled or traced
+
+
 def parse_cmd(cmd):
     '''
     Tokenize a string `cmd` and dispatch tokens [1:] to handler specified by
@@ -343,27 +1101,305 @@ def parse_cmd(cmd):
         return True  # basic checks
 
     if toks[0] in g_handlers:
+        token = mh_perf.g_recorder.begin()
+        mh_metrics.jobs_running.inc(value=toks[0])
         try:
-            return g_handlers[toks[0]](toks[1:])
+            if toks[0] in g_uninstrumented:
+                return g_handlers[toks[0]](toks[1:])
+            return mh_profile.run_instrumented(toks[0], g_handlers[toks[0]],
+                                               toks[1:])
         except Exception:
             loghelper.print_and_log(logger,
                                     "Problem occured in {}".format(toks[0]))
             return True
+        finally:
+            mh_metrics.jobs_running.dec(value=toks[0])
+            report_perf(token, toks[0], g_config)
     else:
         print("Unrecognized command!")
         return True
 
 
-# Initialization  #############################################################
-try:  # load config
-    g_config.load()
-except OSError:
-    g_config.cmd_config(['all'])
+def use_paper(name):
+    '''
+    Make paper `name` of the workspace the one commands act on (g_config)
+
+    Returns
+    -------
+    bool : True if there is such a paper (otherwise reported)
+    '''
+    global g_config
+    if name not in g_workspace.papers:
+        print("No paper {} in workspace (papers: {}).".format(
+            name, ", ".join(g_workspace.papers)))
+        return False
+    g_config = g_workspace.papers[name]
+    g_workspace.current = name
+    return True
+
+
+def load_workspace(path, paper=''):
+    '''
+    Load the papers in workspace file `path` and make `paper` (default the
+    first) current
+
+    Returns
+    -------
+    bool : True on success (otherwise reported)
+    '''
+    global g_workspace
+    g_workspace = mh_workspace.Workspace(path)
+    try:
+        g_workspace.load()
+    except (OSError, ValueError):
+        loghelper.print_and_log(logger, "Failed to load workspace {}."
+                                .format(path))
+        return False
+    if not g_workspace.papers:
+        print("No papers in workspace {}.".format(path))
+        return False
+    return use_paper(paper or g_workspace.current)
+
+
+def add_config_paper():
+    '''
+    Make g_config (once loaded) the only paper in the workspace, named after
+    its config file
+    '''
+    name = os.path.splitext(os.path.basename(g_config.path))[0]
+    g_workspace.papers = {name: g_config}
+    g_workspace.current = name
+
+
+def repl(timing=False, workspace=''):
+    '''
+    Run the interactive CLI until the user quits. Papers are loaded from
+    `workspace` if given (see load_workspace), otherwise g_config is loaded
+    (configuring first if its file cannot be loaded). If `timing` report the
+    startup time before the first prompt
+    '''
+    # Initialization  #########################################################
+    if not workspace:
+        try:  # load config
+            g_config.load()
+        except OSError:
+            g_config.cmd_config(['all'])
+        add_config_paper()
+    if timing:
+        print_timing("startup", g_start_time)
+    start_metrics()
+
+    # Main CLI loop  ##########################################################
+    try:
+        run_async(repl_loop())
+    except BaseException:
+        cmd_exit([])  # (normally on quit) fold journals even if CLI failed
+        raise
+
+
+async def repl_loop():
+    '''
+    Read and run commands until the user quits. Commands in g_bg_handlers
+    start background jobs, others run in a worker thread, so that jobs keep
+    going while the user works. Quitting waits for running jobs first
+    '''
+    while True:
+        for warning in mh_hash.g_hash_cache.pop_warnings():
+            print(warning)
+        cmd = await ask(g_workspace.current + ">"
+                        if len(g_workspace.papers) > 1 else ">")
+        toks = cmd.split()
+        if toks and toks[0] in g_bg_handlers:
+            try:
+                await g_bg_handlers[toks[0]](toks[1:])
+            except Exception:
+                loghelper.print_and_log(logger, "Problem occured in {}"
+                                        .format(toks[0]))
+            continue
+        if toks and toks[0] == "quit":
+            running = [g_jobs[name].task for name in g_jobs
+                       if g_jobs[name].finished is None]
+            if running:
+                print("Waiting for background jobs to finish...")
+                await asyncio.gather(*running)
+        if not await in_thread(parse_cmd, cmd):
+            break
+
+
+def setup_logging():
+    '''
+    Send log messages to Log.txt (in the working directory), which is only
+    created once something is logged
+    '''
+    logging.basicConfig(handlers=[logging.FileHandler("Log.txt", delay=True)],
+                        format="{asctime}#################" +
+                        "##################################\n{message}",
+                        style="{")
+
+
+def print_timing(what, since):
+    '''
+    Print time taken by `what` since time.perf_counter() returned `since`
+    '''
+    print("Timing: {} {:.1f} ms".format(what,
+                                        (time.perf_counter() - since) * 1000))
+
+
+def make_arg_parser():
+    '''
+    Returns
+    -------
+    argparse.ArgumentParser for the non-interactive subcommands. Each
+    subcommand sets `run`, a unary function of the parsed arguments
+    returning True on success
+    '''
+    parser = argparse.ArgumentParser(
+        description="Tool to help streamline marking pdf scripts. Run " +
+        "without a subcommand for the interactive CLI.")
+    parser.add_argument("--config", default="marking.cfg",
+                        help="config file (default: %(default)s)")
+    parser.add_argument("--workspace", default="",
+                        help="workspace file listing several papers to " +
+                        "mark, each with its own config file")
+    parser.add_argument("--paper", default="",
+                        help="paper in the workspace to act on (default: " +
+                        "the first)")
+    parser.add_argument("--timing", action="store_true",
+                        help="report time taken by imports, startup and " +
+                        "subcommands")
+    sub = parser.add_subparsers(dest="command", metavar="command")
+
+    def add(name, run, help_text, final=True):
+        cmd = sub.add_parser(name, help=help_text, description=help_text)
+        cmd.add_argument("-q", "--questions", nargs="+", default=[],
+                         metavar="Q", help="question names")
+        if final:
+            cmd.add_argument("--final", action="store_true",
+                             help="require final validation of source files")
+        cmd.add_argument("--timing", action="store_true",
+                         default=argparse.SUPPRESS, help=argparse.SUPPRESS)
+        cmd.set_defaults(run=run)
+        return cmd
+
+    cmd = add("scan", lambda a: run_scan_all(
+        a.questions, a.final, a.output, g_workspace.papers, g_config)
+        if a.all else run_scan(a.questions, a.final, a.output, g_config),
+        "Report which scripts are marked for the questions.")
+    cmd.add_argument("--output", action="store_true",
+                     help="also require validated (checked) output")
+    cmd.add_argument("--all", action="store_true",
+                     help="scan all papers in the workspace at once")
+    add("prebuild", lambda a: run_prebuild(a.questions, a.final),
+        "Create and compile source files of scripts still to mark.")
+    add("compile", lambda a: run_compile(a.questions),
+        "Compile marked scripts whose output is not yet checked.",
+        final=False)
+    add("revalidate", lambda a: run_revalidate(a.questions, a.final),
+        "Re-run mark extraction and validation on all source files.")
+    cmd = add("makecsv", run_makecsv_file,
+              "Write validated marks to a csv file.", final=False)
+    cmd.add_argument("csv", help="csv file name (in the script directory)")
+    cmd.add_argument("--verify", action="store_true",
+                     help="check scripts and outputs against saved hashes")
+    cmd.add_argument("--force", action="store_true",
+                     help="overwrite an existing csv file")
+    add("makemerged", lambda a: run_make_merged(a.questions, g_config),
+        "Merge checked output over the original scripts.", final=False)
+    return parser
+
+
+def run_makecsv_file(args):
+    '''
+    Run `run_makecsv` for parsed `makecsv` subcommand arguments, refusing to
+    overwrite an existing file unless --force was given
+    '''
+    out_path = os.path.join(g_config.script_dir(), args.csv)
+    if os.path.exists(out_path) and not args.force:
+        print("File {} exists, use --force to overwrite.".format(out_path))
+        return False
+    return run_makecsv(out_path, args.questions, args.verify)
+
+
+def start_metrics():
+    '''
+    Start exporting metrics as set in the config (if at all)
+    '''
+    global g_exporter
+    if not g_config.metrics_textfile() and not g_config.metrics_port():
+        return
+    g_exporter = mh_metrics.Exporter(g_config.metrics_textfile(),
+                                     g_config.metrics_interval(),
+                                     g_config.metrics_port())
+    try:
+        g_exporter.start()
+    except OSError:
+        loghelper.print_and_log(logger, "Warning! Failed to serve metrics " +
+                                "on port {}.".format(g_config.metrics_port()))
+
+
+def stop_metrics():
+    '''
+    Stop exporting metrics, writing the textfile a last time
+    '''
+    global g_exporter
+    if g_exporter is not None:
+        g_exporter.stop()
+        g_exporter = None
+
+
+def main(argv=None):
+    '''
+    Entry point: run subcommand given in `argv` (default sys.argv[1:]), or
+    the interactive CLI if there is none
+
+    Returns
+    -------
+    int : exit status (0 on success, 1 if the command failed, 2 if the
+    config could not be loaded)
+    '''
+    args = make_arg_parser().parse_args(argv)
+    if args.timing:
+        print("Timing: imports {:.1f} ms".format(
+            (g_import_time - g_start_time) * 1000))
+    setup_logging()
+    g_config.path = args.config
+    status = 0
+    if args.workspace and not load_workspace(args.workspace, args.paper):
+        return 2
+    if args.paper and not args.workspace:
+        print("--paper needs --workspace.")
+        return 2
+    try:
+        if args.command is None:
+            repl(args.timing, args.workspace)
+            return status
+        if not args.workspace:
+            try:
+                g_config.load()
+            except OSError:
+                print("Failed to load config file {}. Run without a "
+                      "subcommand to create it.".format(g_config.path))
+                return 2
+            add_config_paper()
+        if args.timing:
+            print_timing("startup", g_start_time)
+        start_metrics()
+        start = time.perf_counter()
+        token = mh_perf.g_recorder.begin()
+        mh_metrics.jobs_running.inc(value=args.command)
+        try:
+            status = 0 if args.run(args) else 1
+        finally:
+            mh_metrics.jobs_running.dec(value=args.command)
+            report_perf(token, args.command, g_config)
+            cmd_exit([])
+        if args.timing:
+            print_timing(args.command, start)
+        return status
+    finally:
+        stop_metrics()
+        logging.shutdown()
 
-# Main CLI loop  ##############################################################
-while True:
-    cmd = input(">")
-    if not parse_cmd(cmd):
-        break
 
-logging.shutdown()
+if __name__ == '__main__':  # not in worker processes
+    sys.exit(main())
@@ -7,8 +7,18 @@ Created on Mon May 11 12:11:45 2020
 Methods involving creating and editing marked documents
 """
 import os
+import json
+import asyncio
 import subprocess as sp
+import concurrent.futures as cf
 import shlex
+import shutil
+import filecmp
+import threading
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 import logging
 
@@ -16,11 +26,23 @@ import logging
 import loghelper
 
 import mh_hash
+import mh_lease as mhl
+import mh_metrics
 import mh_parsing as mhp
+import mh_perf
+import mh_record as mhr
 import mh_script_management as mhsm
+import mh_state as mhst
 
 logger = logging.getLogger(__name__)
 
+# register of source files reset in advance (in marking directory)
+PREPARED_FILE = "prepared.json"
+# scripts prepared between saves of the register
+PREPARED_SAVE_EVERY = 50
+# ioctl request to clone file extents (linux/fs.h)
+FICLONE = 0x40049409
+
 
 def make_from_template(file_path, script_base_path, page_count, cfg):
     '''
@@ -151,7 +173,7 @@ def ready_source_file(filepath, tag, to_mark, cfg):
     ----------
     filepath : Desired path for the file
     tag : Key for the associated script data in to_mark
-    to_mark : Dict of script data for current marking task (MKH format)
+    to_mark : Dict of ScriptRecords for current marking task
     cfg : MarkingConfig for current task (specifies template etc)
 
     Returns
@@ -170,7 +192,7 @@ def ready_source_file(filepath, tag, to_mark, cfg):
             make_from_template(filepath, '../'+tag,
                                mhsm.count_pdf_pages
                                ([os.path.join(cfg.script_dir(), p)
-                                 for p in to_mark[tag][0]]),
+                                 for p in to_mark[tag].files]),
                                cfg)
         except Exception:
             loghelper.print_and_log(logger,
@@ -178,6 +200,332 @@ def ready_source_file(filepath, tag, to_mark, cfg):
                                     .format(filepath))
 
 
+def prepare_source_file(tag, record, questions, final_validate_source, cfg):
+    '''
+    Do the work done by `make_user_mark` before the editor opens: create
+    the source file for `tag` if necessary and reset it for marking
+    `questions` (and final validation if `final_validate_source`).
+    Suitable for running in a worker process.
+
+    Parameters
+    ----------
+    `tag` : prefix of script to prepare
+
+    `record` : ScriptRecord for the script
+
+    `questions` : list of question names to be marked
+
+    `final_validate_source` : if True also reset for final validation
+
+    `cfg` : MarkingConfig for current task
+
+    Returns
+    -------
+    dict : entry for `tag` to save with `save_prepared`
+
+    Raises
+    ------
+    OSError or mh_parsing.ParseError if preparation fails
+    '''
+    sourcefile = cfg.tag_to_sourcepath(tag)
+    ready_source_file(sourcefile, tag, {tag: record}, cfg)
+    prevmarks = {q: record.marks.get(q, '') for q in questions}
+    for q in questions:
+        reset_file_q(sourcefile, q, cfg, prevmarks[q])
+    if final_validate_source:
+        reset_file_final_check(sourcefile, cfg)
+    return {"mtime_ns": os.stat(sourcefile).st_mtime_ns,
+            "prevmarks": prevmarks, "final": final_validate_source}
+
+
+def is_prepared(sourcefile, record, questions, final_validate_source, entry):
+    '''
+    Returns
+    -------
+    bool : True iff `entry` (from `prepare_source_file`, or None) shows
+    that `sourcefile` was reset for `questions` with the marks now in
+    `record` (and for final validation if needed), and that the file has
+    not changed since
+    '''
+    if not entry:
+        return False
+    try:
+        if os.stat(sourcefile).st_mtime_ns != entry["mtime_ns"]:
+            return False
+        for q in questions:
+            if entry["prevmarks"].get(q) != record.marks.get(q, ''):
+                return False
+        return entry["final"] or not final_validate_source
+    except (OSError, KeyError, TypeError, AttributeError):
+        return False
+
+
+def load_prepared(cfg):
+    '''
+    Read the register of prepared source files from the marking directory
+
+    Returns
+    -------
+    {tag: entry} for entries from `prepare_source_file`, or {}
+    '''
+    try:
+        with open(os.path.join(cfg.marking_dir(), PREPARED_FILE), 'r') as file:
+            prepared = json.load(file)
+        if isinstance(prepared, dict):
+            return prepared
+    except (OSError, TypeError, ValueError):
+        pass
+    return {}
+
+
+def save_prepared(cfg, prepared):
+    '''
+    Write {tag: entry} `prepared` to the register of prepared source files
+
+    Raises
+    ------
+    OSError if file cannot be written
+    '''
+    path = os.path.join(cfg.marking_dir(), PREPARED_FILE)
+    with open(path + ".tmp", 'w') as file:
+        json.dump(prepared, file)
+    os.replace(path + ".tmp", path)
+
+
+def run_claimed(to_mark, submit, cfg, window):
+    '''
+    Claim each script in `to_mark` in turn and call `submit(tag)` (returning
+    a concurrent.futures.Future) for it, with at most `window` submitted
+    and not yet done at once. Each claim is released once its future is
+    done. Scripts claimed by another marker, or whose saved state has
+    changed since `to_mark` was made, are skipped (and reported)
+
+    Yields
+    ------
+    [tag, future] as each future is done (the claim is held until the
+    next item is requested)
+    '''
+    tags = list(to_mark)
+    pos = 0
+    pending = {}  # {future: [tag, Lease]}
+    try:
+        while pos < len(tags) or pending:
+            while pos < len(tags) and len(pending) < window:
+                tag = tags[pos]
+                pos += 1
+                lease = mhl.try_claim(cfg.script_dir(), tag)
+                if lease is None:
+                    print("Skipping {} (claimed by another marker)"
+                          .format(tag))
+                    continue
+                if mhsm.state_changed_since(tag, to_mark[tag], cfg):
+                    lease.release()
+                    print("Skipping {} (updated by another marker)"
+                          .format(tag))
+                    continue
+                pending[submit(tag)] = [tag, lease]
+            done = cf.wait(pending, return_when=cf.FIRST_COMPLETED)[0]
+            for future in done:
+                tag, lease = pending[future]
+                yield [tag, future]
+                del pending[future]
+                lease.release()
+    finally:  # e.g. interrupted: keep claims until work stops
+        for future in pending:
+            future.cancel()
+        cf.wait(pending)
+        for future in pending:
+            pending[future][1].release()
+
+
+def batch_prepare(to_mark, questions, final_validate_source, cfg):
+    '''
+    Run `prepare_source_file` on every script in `to_mark` in a pool of
+    cfg.stage_workers("parse") processes and record the results, so that
+    `make_user_mark` only needs to open the editor. Each script is claimed
+    while it is prepared (see `run_claimed`), and the results are saved as
+    they come in
+
+    Parameters
+    ----------
+    `to_mark` : dict of ScriptRecords for scripts to prepare
+
+    `questions` : list of question names to be marked
+
+    `final_validate_source` : if True also reset for final validation
+
+    `cfg` : MarkingConfig for current task
+
+    Returns
+    -------
+    [done, failed] : lists of tags prepared and that could not be prepared
+    '''
+    if not os.path.isdir(cfg.marking_dir()):  # create directory if necessary
+        os.mkdir(cfg.marking_dir())
+    prepared = load_prepared(cfg)
+    done = []
+    failed = []
+    workers = cfg.stage_workers("parse")
+
+    def save():
+        try:
+            save_prepared(cfg, prepared)
+        except OSError:
+            loghelper.print_and_log(logger, "Warning! Failed to save " +
+                                    "register of prepared source files.")
+
+    try:
+        with cf.ProcessPoolExecutor(workers) as pool:
+            for tag, future in run_claimed(
+                    to_mark, lambda tag: pool.submit(
+                        prepare_source_file, tag, to_mark[tag], questions,
+                        final_validate_source, cfg), cfg, 2 * workers):
+                try:
+                    prepared[tag] = future.result()
+                    done.append(tag)
+                except Exception:
+                    logger.exception("Failed to prepare %s", tag)
+                    failed.append(tag)
+                count = len(done) + len(failed)
+                print("\rPreparing: {}/{}. ".format(count, len(to_mark)),
+                      end='\r')
+                if count % PREPARED_SAVE_EVERY == 0:
+                    save()
+    finally:
+        print('')  # newline to break from progress bar
+        save()
+    return [done, failed]
+
+
+def revalidate_source_file(tag, questions, final_validate_source, cfg):
+    '''
+    Run the checks done by `make_user_mark` after the editor closes on the
+    source file for `tag`, without opening an editor. Suitable for running in
+    a worker process.
+
+    Parameters
+    ----------
+    `tag` : prefix of script to check
+
+    `questions` : list of question names to extract marks for
+
+    `final_validate_source` : if True also run the final source validation
+
+    `cfg` : MarkingConfig for current task
+
+    Returns
+    -------
+    [marks, failed, final_ok] : where
+        `marks` : {name: mark} for all questions validly marked
+
+        `failed` : list of questions not validly marked
+
+        `final_ok` : result of final source validation (False if not run)
+
+    Raises
+    ------
+    OSError or mh_parsing.ParseError if the source file cannot be checked
+    '''
+    sourcefile = cfg.tag_to_sourcepath(tag)
+    marks = {}
+    failed = []
+    for q in questions:
+        marked, score = do_file_q_check(sourcefile, q, cfg)
+        if marked:
+            marks[q] = score
+        else:
+            failed.append(q)
+    final_ok = final_validate_source and do_file_final_check(sourcefile, cfg)
+    return [marks, failed, final_ok]
+
+
+def batch_revalidate(records, questions, final_validate_source, cfg):
+    '''
+    Run `revalidate_source_file` on every script in `records` that has a
+    source file, in a pool of cfg.stage_workers("parse") processes, and
+    save the records updated with the results. Each script is claimed until
+    its state is saved (see `run_claimed`). Scripts whose original files
+    have changed since they were marked are not revalidated: they must be
+    marked again.
+
+    A record whose source fails final validation (when requested) or any
+    question loses its final validation. A record whose marks no longer
+    match those validated with its output loses its output validation.
+
+    Parameters
+    ----------
+    `records` : {tag: ScriptRecord} for scripts to check
+
+    `questions` : list of question names to extract marks for
+
+    `final_validate_source` : if True also run the final source validation
+
+    `cfg` : MarkingConfig for current task
+
+    Returns
+    -------
+    [checked, changed, failures] : where
+        `checked` : list of tags revalidated
+
+        `changed` : {tag: ScriptRecord} for updated (and saved) records
+
+        `failures` : {tag: reason} for scripts now failing validation (or
+        not revalidated because their originals were modified)
+
+    Raises
+    ------
+    OSError if marking state cannot be saved
+    '''
+    checked = []
+    changed = {}
+    failures = {}
+    tags = {}
+    for tag in records:
+        if not os.path.isfile(cfg.tag_to_sourcepath(tag)):
+            continue
+        if mhsm.originals_changed(tag, records[tag], cfg):
+            failures[tag] = "originals modified since marked (not " + \
+                "revalidated, mark again with begin)"
+            continue
+        tags[tag] = records[tag]
+    store = mhst.get_store(cfg.script_dir())
+    workers = cfg.stage_workers("parse")
+    with cf.ProcessPoolExecutor(workers) as pool:
+        for tag, future in run_claimed(
+                tags, lambda tag: pool.submit(
+                    revalidate_source_file, tag, questions,
+                    final_validate_source, cfg), cfg, 2 * workers):
+            checked.append(tag)
+            print("\rRevalidating: {}/{}. ".format(len(checked), len(tags)),
+                  end='\r')
+            record = records[tag].copy()
+            try:
+                marks, failed, final_ok = future.result()
+            except Exception:
+                logger.exception("Failed to revalidate %s", tag)
+                marks, failed, final_ok = {}, questions, False
+                failures[tag] = "could not be parsed (see log)"
+            record.marks.update(mhr.intern_marks(marks))
+            if failed:
+                failures.setdefault(tag, "questions not validly marked: " +
+                                    " ".join(failed))
+            elif final_validate_source and not final_ok:
+                failures.setdefault(tag, "final source validation failed")
+            if tag in failures:
+                record.final_valid = False
+            elif final_validate_source:
+                record.final_valid = True
+            if record.out_hash and (tag in failures or any(
+                    record.valid_marks.get(q) != marks[q] for q in marks)):
+                record.out_hash = ''
+                record.valid_marks = {}
+            if record != records[tag]:
+                store.put(tag, record)  # while still claimed
+                changed[tag] = record
+    print('')  # newline to break from progress bar
+    return [checked, changed, failures]
+
+
 def open_one_to_edit(cfg, sourcefile):
     '''
     Run editor specified in `cfg` on selected sourcefile.
@@ -208,7 +556,7 @@ def make_user_mark(tag, to_mark, cfg, questions=None,
         prefix of script to mark (key in `to_mark`)
 
     `to_mark` :
-        dict of scripts to mark in mkh format
+        dict of ScriptRecords of scripts to mark
 
     `cfg` :
         MarkingConfig object specifying details of marking job
@@ -235,7 +583,7 @@ def make_user_mark(tag, to_mark, cfg, questions=None,
         (output validation has no effect)
 
         *`outhash` ='' or a hash string of the final output file
-        (as generated by mh_hash.hash_file_list), if
+        (as generated by mh_hash.hash_pdf_stable), if
         final_validate_output==True and
         all tests are passed (including final source validation)
     '''
@@ -249,16 +597,20 @@ def make_user_mark(tag, to_mark, cfg, questions=None,
     sourcefile = cfg.tag_to_sourcepath(tag)
     ready_source_file(sourcefile, tag, to_mark, cfg)
 
+    # skip resets already done by `prepare_source_file`
+    prepared = is_prepared(sourcefile, to_mark[tag], questions,
+                           final_validate_source, load_prepared(cfg).get(tag))
+
     # reset all variables to inspect later
-    for q in questions:
+    for q in questions if not prepared else []:
         try:
             reset_file_q(sourcefile,
-                         q, cfg, to_mark[tag][2].get(q, ''))
+                         q, cfg, to_mark[tag].marks.get(q, ''))
         except Exception:
             loghelper.print_and_log(logger,
                                     "Failed to reset question {} in {}"
                                     .format(q, sourcefile))
-    if final_validate_source:
+    if final_validate_source and not prepared:
         try:
             reset_file_final_check(sourcefile, cfg)
         except Exception:
@@ -298,12 +650,12 @@ def make_user_mark(tag, to_mark, cfg, questions=None,
             else:  # generate hash (also warn about page counts)
                 if not mhsm.check_page_counts(
                         [os.path.join(cfg.script_dir(), p)
-                         for p in to_mark[tag][0]],
+                         for p in to_mark[tag].files],
                         cfg.tag_to_outputpath(tag)):
                     print("Warning: page count in {} doesn't match input."
                           .format(cfg.tag_to_outputpath(tag)))
-                output_hash = mh_hash.hash_file_list([tag+cfg.output_suffix()],
-                                                     cfg.marking_dir())
+                output_hash = mh_hash.hash_pdf_stable(
+                    [tag+cfg.output_suffix()], cfg.marking_dir())
         if final_validate_source:
             try:
                 ret[1] = ret[1] \
@@ -336,6 +688,215 @@ def make_user_mark(tag, to_mark, cfg, questions=None,
         return ret
 
 
+class CompileCache:
+    '''
+    Source files compiled successfully in this process, so that compiling
+    one again can be skipped if neither it, the other files it reads that
+    the caller lists (e.g. the script pdfs), the compile command nor its
+    output (taken to be <source stem>.pdf, as for pdflatex) has changed
+    since. Other files read by the compiler (packages, images) are not
+    tracked. Safe to share between threads
+    '''
+
+    def __init__(self):
+        '''
+        {full source path: [digest, compile command, output size,
+                            output mtime_ns]}
+        '''
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def source_digest(self, directory, file, inputs=None):
+        '''
+        Returns
+        -------
+        [full path, digest] of source `file` in `directory` together with
+        the files at paths `inputs`, or None if there are no `inputs` (so
+        the compile cannot be checked) or a file cannot be read
+        '''
+        if inputs is None:
+            return None
+        path = os.path.abspath(os.path.join(directory, file))
+        try:
+            return [path, mh_hash.combine_digests(
+                mh_hash.hash_file_digests([path] + list(inputs)))]
+        except OSError:
+            return None
+
+    def is_current(self, source, compile_command):
+        '''
+        Returns
+        -------
+        True if `source` (from `source_digest`) was compiled with
+        `compile_command` and its output is unchanged since
+        '''
+        if source is None:
+            return False
+        with self._lock:
+            entry = self._entries.get(source[0])
+        if entry is None or entry[:2] != [source[1], compile_command]:
+            return False
+        try:
+            stat = os.stat(os.path.splitext(source[0])[0] + ".pdf")
+        except OSError:
+            return False
+        return entry[2:] == [stat.st_size, stat.st_mtime_ns]
+
+    def record(self, source, compile_command):
+        '''
+        Remember that `source` (from `source_digest`, taken before compiling)
+        compiled successfully with `compile_command`
+        '''
+        if source is None:
+            return
+        try:
+            stat = os.stat(os.path.splitext(source[0])[0] + ".pdf")
+        except OSError:
+            return  # output elsewhere: cannot tell if it changes
+        with self._lock:
+            self._entries[source[0]] = [source[1], compile_command,
+                                        stat.st_size, stat.st_mtime_ns]
+
+    def clear(self):
+        '''
+        Forget all compiles
+        '''
+        with self._lock:
+            self._entries = {}
+
+
+# compiles shared by all callers (and marking tasks) in this process
+g_compile_cache = CompileCache()
+
+
+def script_inputs(records, directory):
+    '''
+    Returns
+    -------
+    {tag: list of full paths of the script files} for {tag: ScriptRecord}
+    `records` of scripts in `directory`: the inputs of compiling their
+    source files (see `compile_one`)
+    '''
+    return {tag: [os.path.join(directory, f) for f in records[tag].files]
+            for tag in records}
+
+
+@mh_perf.timed("compile", 1)
+def compile_one(directory, file, compile_command, inputs=None):
+    '''
+    Runs string `compile_command` in terminal in the given `directory` on one
+    source `file` (path relative to `directory`). If `inputs`, the paths of
+    the other files the compile reads (e.g. the script pdfs), are given,
+    this is skipped when g_compile_cache shows its output is up to date.
+    Safe to call from several threads at once.
+
+    Raises
+    ------
+    subprocess.CalledProcessError if the compiler returns non-zero
+    '''
+    source = g_compile_cache.source_digest(directory, file, inputs)
+    if g_compile_cache.is_current(source, compile_command):
+        mh_metrics.compiles.inc(value="cached")
+        return
+    cmd_toks = shlex.split(compile_command)
+    cmd_toks.append(file)
+    mh_metrics.compiles_in_flight.inc()
+    try:
+        sp.run(cmd_toks, check=True, stdin=sp.PIPE, stdout=sp.PIPE,
+               stderr=sp.PIPE, cwd=directory)
+    except Exception:
+        mh_metrics.compiles.inc(value="failed")
+        raise
+    finally:
+        mh_metrics.compiles_in_flight.dec()
+    mh_metrics.compiles.inc(value="ok")
+    g_compile_cache.record(source, compile_command)
+
+
+async def compile_one_async(directory, file, compile_command, inputs=None):
+    '''
+    As `compile_one`, but runs the compiler without blocking the event loop
+    (or occupying a thread) while it works
+
+    Raises
+    ------
+    subprocess.CalledProcessError if the compiler returns non-zero
+    '''
+    source = g_compile_cache.source_digest(directory, file, inputs)
+    if g_compile_cache.is_current(source, compile_command):
+        mh_metrics.compiles.inc(value="cached")
+        return
+    cmd_toks = shlex.split(compile_command)
+    cmd_toks.append(file)
+    mh_metrics.compiles_in_flight.inc()
+    try:
+        with mh_perf.span("compile", file):
+            proc = await asyncio.create_subprocess_exec(
+                *cmd_toks, stdin=sp.DEVNULL, stdout=sp.DEVNULL,
+                stderr=sp.DEVNULL, cwd=directory)
+            returncode = await proc.wait()
+    except Exception:
+        mh_metrics.compiles.inc(value="failed")
+        raise
+    finally:
+        mh_metrics.compiles_in_flight.dec()
+    if returncode != 0:
+        mh_metrics.compiles.inc(value="failed")
+        raise sp.CalledProcessError(returncode, cmd_toks)
+    mh_metrics.compiles.inc(value="ok")
+    g_compile_cache.record(source, compile_command)
+
+
+async def batch_compile_async(directory, files, compile_command, limit,
+                              progress=None, inputs=None):
+    '''
+    Compile each source file listed in `files`, with up to `limit` compiler
+    processes running at once. Nothing is printed and no prompts are given,
+    so this can run in the background
+
+    Parameters
+    ----------
+    `directory` : directory in which to run compiler
+
+    `files` : list of file paths to compile (relative to `directory`)
+
+    `compile_command` : command line command to which file paths will be
+    appended (see `batch_compile`)
+
+    `limit` : maximum number of compiles in flight
+
+    `progress` : optional function called as progress(done, total) as each
+    compile finishes
+
+    `inputs` : optional {file: paths of other files its compile reads} (see
+    `compile_one`)
+
+    Returns
+    -------
+    list of files that failed to compile
+    '''
+    inputs = inputs or {}
+    semaphore = asyncio.Semaphore(max(1, limit))
+    fail_list = []
+    done = 0
+
+    async def compile_file(file):
+        nonlocal done
+        async with semaphore:
+            try:
+                await compile_one_async(directory, file, compile_command,
+                                        inputs.get(file))
+            except (OSError, sp.CalledProcessError):
+                logger.exception("Compilation failed for %s.", file)
+                fail_list.append(file)
+        done += 1
+        if progress is not None:
+            progress(done, len(files))
+
+    await asyncio.gather(*[compile_file(file) for file in files])
+    return fail_list
+
+
 def batch_compile(directory, files, compile_command, **kwargs):
     '''
     Runs string `compile_command` in terminal in the given `directory` for each
@@ -355,19 +916,16 @@ def batch_compile(directory, files, compile_command, **kwargs):
     `manual_fallback` - if True `cfg` must be given
     user will be prompted to manually compile any files that
     failed
+    `inputs` - {file: paths of other files its compile reads} (see
+    `compile_one`)
     '''
-    here = ".."
+    inputs = kwargs.get('inputs', {})
     fail_list = []  # list of files that did not compile
     try:
-        here = os.getcwd()
-        os.chdir(directory)
         for i, s in enumerate(files):  # compile examples
             try:
                 print("\rCompiling: {}/{}. ".format(i+1, len(files)), end='\r')
-                cmd_toks = shlex.split(compile_command)
-                cmd_toks.append(s)
-                sp.run(cmd_toks, check=True, stdin=sp.PIPE, stdout=sp.PIPE,
-                       stderr=sp.PIPE)
+                compile_one(directory, s, compile_command, inputs.get(s))
 
             except sp.CalledProcessError:
                 fail_list.append(s)
@@ -376,7 +934,6 @@ def batch_compile(directory, files, compile_command, **kwargs):
                 print(" Continuing...")
     finally:
         print('')  # newline to break from progress bar
-        os.chdir(here)
     go_manual = kwargs.get('manual_fallback', False)
     if go_manual:
         print("There are {} files to compile manually.".format(len(fail_list)))
@@ -403,7 +960,8 @@ def batch_check_exist(directory, files):
             raise
 
 
-def batch_compile_and_check(directory, tags, cfg, comp_if_output_exists=True):
+def batch_compile_and_check(directory, tags, cfg, comp_if_output_exists=True,
+                            manual_fallback=True, records=None):
     """
     Run a batch compile and batch check
 
@@ -419,6 +977,13 @@ def batch_compile_and_check(directory, tags, cfg, comp_if_output_exists=True):
     comp_if_output_exists : if True (default) try to compile all source files
     indicated by `tags`. Otherwise check which already exist and ignore those.
 
+    manual_fallback : if True (default) prompt the user to compile any files
+    that failed by hand (see `batch_compile`). Use False where there is no
+    user to prompt
+
+    records : optional {tag: ScriptRecord} for `tags`, so that compiles of
+    unchanged source files and scripts can be skipped (see `compile_one`)
+
     Returns
     -------
     None.
@@ -439,12 +1004,16 @@ def batch_compile_and_check(directory, tags, cfg, comp_if_output_exists=True):
         tags = newtags
     source_filelist = [tag + cfg.marked_suffix() for tag in tags]
     output_filelist = [tag + cfg.output_suffix() for tag in tags]
+    inputs = {}
+    if records is not None:
+        paths = script_inputs(records, cfg.script_dir())
+        inputs = {tag + cfg.marked_suffix(): paths[tag] for tag in tags}
     batch_compile(directory, source_filelist, cfg.compile_command(),
-                  cfg=cfg, manual_fallback=True)
+                  cfg=cfg, manual_fallback=manual_fallback, inputs=inputs)
     batch_check_exist(directory, output_filelist)
 
 
-def pre_build(to_mark, cfg):
+def pre_build(to_mark, cfg, manual_fallback=True):
     '''
     Create tex files for marking all scripts in to_mark
 
@@ -452,9 +1021,11 @@ def pre_build(to_mark, cfg):
 
     Parameters
     ----------
-    `to_mark` : dict of mkh entries for scripts to mark
+    `to_mark` : dict of ScriptRecords for scripts to mark
 
     `cfg` : MarkingConfig for current task
+
+    `manual_fallback` : as for `batch_compile_and_check`
     '''
     if not os.path.isdir(cfg.marking_dir()):  # create directory if necessary
         os.mkdir(cfg.marking_dir())
@@ -462,7 +1033,8 @@ def pre_build(to_mark, cfg):
         # file to create/edit
         filepath = cfg.tag_to_sourcepath(tag)
         ready_source_file(filepath, tag, to_mark, cfg)
-    batch_compile_and_check(cfg.marking_dir(), to_mark, cfg, False)
+    batch_compile_and_check(cfg.marking_dir(), to_mark, cfg, False,
+                            manual_fallback, to_mark)
 
 
 def mark_one_loop(tag, to_mark, cfg, question_names=None,
@@ -479,7 +1051,7 @@ def mark_one_loop(tag, to_mark, cfg, question_names=None,
         prefix of script to mark (key in `to_mark`)
 
     `to_mark` :
-        dict of scripts to mark in mkh format
+        dict of ScriptRecords of scripts to mark
 
     `cfg` :
         MarkingConfig object specifying details of marking job
@@ -502,12 +1074,12 @@ def mark_one_loop(tag, to_mark, cfg, question_names=None,
     marks_done = {}  # questions already marked for this script this pass
     quit_flag = False
 
+    record = to_mark[tag]
     # source and output validation reset
-    to_mark[tag][3] = False
-    to_mark[tag][4] = ['', {}]
+    record.reset_validation()
 
-    print("Marks on file: " + ", ".join(["Q" + q + ": " + to_mark[tag][2][q]
-                                         for q in to_mark[tag][2]]))
+    print("Marks on file: " + ", ".join(["Q" + q + ": " + record.marks[q]
+                                         for q in record.marks]))
 
     while not quit_flag:
 
@@ -516,7 +1088,7 @@ def mark_one_loop(tag, to_mark, cfg, question_names=None,
                                                 source_validate,
                                                 output_validate)
         # record scores in to_mark
-        to_mark[tag][2].update(marks)
+        record.marks.update(mhr.intern_marks(marks))
         marks_done.update(marks)
 
         print("Marks updated: "+", ".join(["Q" + q + ": "+marks_done[q]
@@ -531,12 +1103,12 @@ def mark_one_loop(tag, to_mark, cfg, question_names=None,
                 # check also validation verdict from make_user_mark
                 # marked==True here. if not source_validate,
                 # don't assume checks complete
-                to_mark[tag][3] = source_validate
+                record.final_valid = source_validate
 
                 # source validate should already be True if output_validate!
                 if source_validate and output_validate and outhash:
-                    to_mark[tag][4][0] = outhash
-                    to_mark[tag][4][1] = {q: marks_done[q] for q in marks_done}
+                    record.out_hash = outhash
+                    record.valid_marks = mhr.intern_marks(marks_done)
                 break  # all done for this script
         else:
             selection = input("Marking of "+tag+" not complete. Continue? " +
@@ -561,3 +1133,83 @@ def copyFile(path_in, path_out):
                 if buf == b'':
                     break  # eof
                 ofile.write(buf)
+
+
+def stage_file(path_in, path_out):
+    '''
+    Make the file at `path_out` a copy of `path_in`, as cheaply as possible.
+    Strategies are tried in the order:
+        'unchanged' - `path_out` already has identical content
+        'reflink' - clone the file extents (copy on write filesystems only)
+        'sendfile' - copy inside the kernel with os.sendfile
+        'copy' - shutil.copyfile
+
+    The new file is made alongside `path_out` and renamed over it, so
+    `path_out` is never left incomplete. It is always a separate file (not a
+    hard link), as the source may later be rewritten in place (e.g. by
+    revalidate or an editor)
+
+    Returns
+    -------
+    str : name of the strategy used
+
+    Raises
+    ------
+    OSError if all strategies fail
+    '''
+    try:
+        # a hard link left by older versions is replaced by a copy
+        if not os.path.samefile(path_in, path_out) and \
+                filecmp.cmp(path_in, path_out, shallow=False):
+            return 'unchanged'
+    except OSError:
+        pass  # no existing copy
+    tmp_path = path_out + ".staging"
+    for strategy, stage_func in [('reflink', _stage_reflink),
+                                 ('sendfile', _stage_sendfile),
+                                 ('copy', shutil.copyfile)]:
+        try:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            stage_func(path_in, tmp_path)
+            os.replace(tmp_path, path_out)
+            return strategy
+        except (OSError, AttributeError):
+            if strategy == 'copy':
+                raise
+    return None
+
+
+def _stage_reflink(path_in, path_out):
+    '''
+    Clone `path_in` to `path_out` with the FICLONE ioctl
+
+    Raises
+    ------
+    OSError if not supported by the platform or filesystem
+    '''
+    if fcntl is None:
+        raise OSError("Reflinks not supported")
+    with open(path_in, 'rb') as ifile:
+        with open(path_out, 'wb') as ofile:
+            fcntl.ioctl(ofile.fileno(), FICLONE, ifile.fileno())
+
+
+def _stage_sendfile(path_in, path_out):
+    '''
+    Copy `path_in` to `path_out` with os.sendfile
+
+    Raises
+    ------
+    OSError (or AttributeError if os.sendfile unavailable) on failure
+    '''
+    with open(path_in, 'rb') as ifile:
+        with open(path_out, 'wb') as ofile:
+            size = os.fstat(ifile.fileno()).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(ofile.fileno(), ifile.fileno(), offset,
+                                   size - offset)
+                if sent == 0:
+                    break
+                offset += sent
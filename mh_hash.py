@@ -5,9 +5,37 @@ Created on Wed Apr  1 10:20:52 2020
 @author: Ben
 """
 import os
+import re
+import json
+import time
+import threading
+
+import logging
 
 import hashlib
 
+import mh_metrics
+import mh_perf
+
+logger = logging.getLogger(__name__)
+
+# seconds to pause between files when verifying in the background
+VERIFY_PAUSE = 0.01
+
+# algorithm tag for hashes of pdfs ignoring volatile metadata. Stored hashes
+# take the form '<tag>:<hex digest>'. Untagged hashes are plain sha256 of
+# the raw file bytes (see hash_file_list)
+ALGO_PDF_STABLE = "pdfnorm-sha256"
+
+# algorithm tag for script hashes combined from per-file digests (see
+# combine_digests)
+ALGO_MERKLE = "merkle-sha256"
+
+# metadata that pdflatex rewrites on every compile
+_VOLATILE_PDF_FIELDS = re.compile(rb"/(?:CreationDate|ModDate)\s*"
+                                  rb"\((?:\\.|[^\\)])*\)"
+                                  rb"|/ID\s*\[[^\]]*\]")
+
 
 def hash_file_list(files, directory=''):
     '''
@@ -31,6 +59,271 @@ def hash_file_list(files, directory=''):
     return the_hash.hexdigest()
 
 
+class HashCache:
+    '''
+    Per-file sha256 digests, remembered with the size and modification time
+    of each file when it was hashed. A file is only re-read if these change.
+    Safe to share between threads.
+
+    Digests loaded from disk (see `load`) are trusted until verified by
+    re-reading the files (see `verify_in_background`)
+    '''
+
+    def __init__(self):
+        '''
+        {full path: [size, mtime_ns, hex digest]}
+        '''
+        self._entries = {}
+        '''
+        full paths of entries loaded from disk and not yet re-read
+        '''
+        self._unverified = set()
+        '''
+        mismatches found by background verification, not yet reported
+        '''
+        self._warnings = []
+        '''
+        full paths of entries changed since last saved
+        '''
+        self._dirty = set()
+        self._verifier = None
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        '''
+        Returns
+        -------
+        hex digest of file at `path`, read from the file only if it has
+        changed since last hashed
+
+        Raises
+        ------
+        OSError if file cannot be read
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            mh_metrics.hash_cache.inc(value="hit")
+            return entry[2]
+        mh_metrics.hash_cache.inc(value="miss")
+        mh_metrics.hashed_bytes.inc(stat.st_size)
+        with mh_perf.span("hash", os.path.basename(path)):
+            digest = hash_file_list([path])
+        with self._lock:
+            self._entries[path] = [stat.st_size, stat.st_mtime_ns, digest]
+            self._unverified.discard(path)
+            self._dirty.add(path)
+        return digest
+
+    def clear(self):
+        '''
+        Forget all cached digests
+        '''
+        with self._lock:
+            self._entries = {}
+            self._unverified = set()
+            self._dirty = set()
+
+    def load(self, path):
+        '''
+        Add digests saved at `path` (see `save`) for files not already known.
+        These are trusted without re-reading the files, if their size and
+        modification time still match, until verified.
+
+        Does nothing if the file cannot be read
+        '''
+        try:
+            with open(path, 'r') as file:
+                saved = json.load(file)
+        except (OSError, TypeError, ValueError):
+            return
+        with self._lock:
+            for fpath in saved:
+                if fpath not in self._entries:
+                    self._entries[fpath] = saved[fpath]
+                    self._unverified.add(fpath)
+
+    def save(self, path, directory=''):
+        '''
+        Save digests of files in `directory` (default all files) to `path`
+        (json file), if any have changed since saved. So digests of several
+        script directories can be kept in one cache but saved separately
+
+        Raises
+        ------
+        OSError if file cannot be written
+        '''
+        prefix = os.path.join(os.path.abspath(directory), '') \
+            if directory else ''
+        with self._lock:
+            changed = {p for p in self._dirty if p.startswith(prefix)}
+            if not changed:
+                return
+            data = json.dumps({p: self._entries[p] for p in self._entries
+                               if p.startswith(prefix)})
+            self._dirty -= changed
+        with open(path + ".tmp", 'w') as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+
+    def verify_in_background(self):
+        '''
+        Start a low priority daemon thread re-reading each file whose digest
+        was trusted from disk. Any file whose contents no longer match is
+        logged, recorded (see `pop_warnings`) and its digest corrected.
+
+        Does nothing if verification is already running
+        '''
+        with self._lock:
+            if self._verifier is not None and self._verifier.is_alive():
+                return
+            self._verifier = threading.Thread(target=self._verify,
+                                              daemon=True)
+            self._verifier.start()
+
+    def pop_warnings(self):
+        '''
+        Returns
+        -------
+        list of str : mismatches found by background verification since
+        last called
+        '''
+        with self._lock:
+            ret = self._warnings
+            self._warnings = []
+        return ret
+
+    def _verify(self):
+        '''
+        Background verification loop (see `verify_in_background`)
+        '''
+        try:  # lower priority of this thread only (linux)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            with self._lock:
+                if not self._unverified:
+                    return
+                path = self._unverified.pop()
+                entry = self._entries.get(path)
+            try:
+                digest = hash_file_list([path])
+            except OSError:
+                continue  # file removed. Will be noticed elsewhere
+            if entry is not None and digest != entry[2]:
+                msg = "Warning: {} was modified but its size and " \
+                    "modification time were not. Check marking state " \
+                    "again.".format(path)
+                logger.warning(msg)
+                with self._lock:
+                    self._warnings.append(msg)
+                    self._entries[path] = entry[:2] + [digest]
+                    self._dirty.add(path)
+            time.sleep(VERIFY_PAUSE)
+
+
+# cache shared by all callers in this process
+g_hash_cache = HashCache()
+
+
+def hash_file_digests(files, directory='', cache=None):
+    '''
+    Hash each file in the list `files` contained in `directory` separately
+
+    Parameters
+    ----------
+    cache : HashCache to use (default g_hash_cache)
+
+    Returns
+    -------
+    list of hex digests, one for each of `files`
+    '''
+    if cache is None:
+        cache = g_hash_cache
+    return [cache.digest(os.path.join(directory, f)) for f in files]
+
+
+def combine_digests(digests):
+    '''
+    Combine per-file digests (from `hash_file_digests`) into one hash for a
+    script, so that a change to any file (or their order) changes the result
+
+    Returns
+    -------
+    hash tagged with its algorithm: '<ALGO_MERKLE>:<hex digest>'
+    '''
+    the_hash = hashlib.sha256()
+    for d in digests:
+        the_hash.update(bytes.fromhex(d))
+    return ALGO_MERKLE + ":" + the_hash.hexdigest()
+
+
+def script_hash_matches(saved_hash, files, directory='', digests=None):
+    '''
+    Check a saved script hash against the current `files` in `directory`,
+    using the algorithm recorded with `saved_hash`
+
+    Parameters
+    ----------
+    saved_hash : hash from `combine_digests` or (untagged) `hash_file_list`
+
+    digests : current per-file digests of `files`, if already known
+
+    Returns
+    -------
+    bool : True iff `saved_hash` matches the files
+    '''
+    if saved_hash.startswith(ALGO_MERKLE + ":"):
+        if digests is None:
+            digests = hash_file_digests(files, directory)
+        return combine_digests(digests) == saved_hash
+    return hash_file_list(files, directory) == saved_hash
+
+
+def hash_pdf_stable(files, directory=''):
+    '''
+    As `hash_file_list` but for pdf files, ignoring the creation and
+    modification dates and the document ID, so that recompiling unchanged
+    source gives the same hash
+
+    Returns
+    -------
+    hash tagged with its algorithm: '<ALGO_PDF_STABLE>:<hex digest>'
+    '''
+    the_hash = hashlib.sha256()
+    with mh_perf.span("hash output", os.path.basename(files[0])
+                      if files else ''):
+        for f in files:
+            with open(os.path.join(directory, f), "rb") as the_file:
+                data = the_file.read()
+            mh_metrics.hashed_bytes.inc(len(data))
+            the_hash.update(_VOLATILE_PDF_FIELDS.sub(b'', data))
+    return ALGO_PDF_STABLE + ":" + the_hash.hexdigest()
+
+
+def output_hash_matches(saved_hash, files, directory=''):
+    '''
+    Check a saved output hash against the current `files` in `directory`,
+    using the algorithm recorded with `saved_hash`
+
+    Parameters
+    ----------
+    saved_hash : hash from `hash_pdf_stable` or (untagged) `hash_file_list`
+
+    Returns
+    -------
+    bool : True iff `saved_hash` is set and matches the files
+    '''
+    if not saved_hash:
+        return False
+    if saved_hash.startswith(ALGO_PDF_STABLE + ":"):
+        return hash_pdf_stable(files, directory) == saved_hash
+    return hash_file_list(files, directory) == saved_hash
+
+
 ###############################################################################
 if __name__ == '__main__':
     # print(hash_file_list(["HashTest/f1.txt","HashTest/f2.txt",
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 13:30:05 2026
+
+@author: Ben
+
+Expiring claims (leases) on scripts, so that several markers can work through
+one script directory at once without marking the same script
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import threading
+import contextlib
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:  # only available on Windows
+    msvcrt = None
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# sub-directory of script directory holding claim files
+CLAIM_DIR = "claims"
+# lock file serialising changes to claim files
+LOCK_FILE = "claims.lock"
+# seconds a claim lasts unless renewed
+DEFAULT_TTL = 600
+
+# identifies this process to other markers
+g_owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(),
+                            uuid.uuid4().hex[:8])
+
+
+@contextlib.contextmanager
+def file_lock(fd, exclusive=True):
+    '''
+    Context manager holding an advisory lock on open file descriptor `fd`
+    (shared if `exclusive` is False). No locking where the platform offers
+    none
+    '''
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)  # exclusive only
+        try:
+            yield
+        finally:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        yield
+
+
+class Lease:
+    '''
+    Claim held by this process on one script
+    '''
+
+    def __init__(self, directory, tag, ttl=DEFAULT_TTL):
+        """
+        Parameters
+        ----------
+        directory : str - script directory
+
+        tag : str - tag of claimed script
+
+        ttl : float - seconds the claim lasts unless renewed
+
+        Returns
+        -------
+        None.
+        """
+        self.directory = directory
+        self.tag = tag
+        self.ttl = ttl
+        self._renewer = None
+        self._stop = threading.Event()
+
+    def path(self):
+        '''
+        Returns full path to the claim file
+        '''
+        return os.path.join(self.directory, CLAIM_DIR, self.tag + ".claim")
+
+    def renew(self):
+        '''
+        Extend the claim by `ttl` seconds from now
+
+        Returns
+        -------
+        bool : False if the claim has been lost (expired and taken by another
+        marker)
+        '''
+        with _claim_table(self.directory):
+            claim = _read_claim(self.path())
+            if claim is not None and claim["owner"] != g_owner \
+                    and claim["expires"] > time.time():
+                return False
+            _write_claim(self.path(), self.ttl)
+        return True
+
+    def release(self):
+        '''
+        Stop renewing and give up the claim (if still held)
+        '''
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+        with _claim_table(self.directory):
+            claim = _read_claim(self.path())
+            if claim is not None and claim["owner"] == g_owner:
+                try:
+                    os.remove(self.path())
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        '''
+        Renew the claim in the background until the context exits, then
+        release it
+        '''
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._renew_loop, daemon=True)
+        self._renewer.start()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    logger.warning("Claim on %s lost to another marker",
+                                   self.tag)
+                    return
+            except OSError:
+                logger.exception("Failed to renew claim on %s", self.tag)
+
+
+def try_claim(directory, tag, ttl=DEFAULT_TTL):
+    '''
+    Claim script `tag` in `directory` for this process, unless another marker
+    holds an unexpired claim on it
+
+    Returns
+    -------
+    Lease or None if already claimed by another marker
+
+    Raises
+    ------
+    OSError if claim files cannot be written
+    '''
+    lease = Lease(directory, tag, ttl)
+    with _claim_table(directory):
+        claim = _read_claim(lease.path())
+        if claim is not None and claim["owner"] != g_owner \
+                and claim["expires"] > time.time():
+            return None
+        _write_claim(lease.path(), ttl)
+    return lease
+
+
+def claimed_by_others(directory):
+    '''
+    Returns
+    -------
+    {tag: owner} for unexpired claims in `directory` held by other markers
+    '''
+    ret = {}
+    try:
+        names = os.listdir(os.path.join(directory, CLAIM_DIR))
+    except OSError:
+        return ret
+    now = time.time()
+    for name in names:
+        if name.endswith(".claim"):
+            claim = _read_claim(os.path.join(directory, CLAIM_DIR, name))
+            if claim is not None and claim["owner"] != g_owner \
+                    and claim["expires"] > now:
+                ret[name[:-len(".claim")]] = claim["owner"]
+    return ret
+
+
+g_table_lock = threading.Lock()  # serialises claims between threads
+
+
+@contextlib.contextmanager
+def _claim_table(directory):
+    '''
+    Context manager serialising changes to the claims in `directory` between
+    processes (and threads)
+    '''
+    os.makedirs(os.path.join(directory, CLAIM_DIR), exist_ok=True)
+    with g_table_lock:
+        fd = os.open(os.path.join(directory, CLAIM_DIR, LOCK_FILE),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with file_lock(fd):
+                yield
+        finally:
+            os.close(fd)
+
+
+def _read_claim(path):
+    '''
+    Returns
+    -------
+    {"owner": str, "expires": float} from claim file at `path`, or None if
+    there is no valid claim
+    '''
+    try:
+        with open(path, 'r') as file:
+            claim = json.load(file)
+        if isinstance(claim.get("owner"), str) and \
+                isinstance(claim.get("expires"), (int, float)):
+            return claim
+    except (OSError, TypeError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def _write_claim(path, ttl):
+    '''
+    Atomically write a claim by this process lasting `ttl` seconds
+    '''
+    with open(path + ".tmp", 'w') as file:
+        json.dump({"owner": g_owner, "expires": time.time() + ttl}, file)
+    os.replace(path + ".tmp", path)
+
+
+###############################################################################
+if __name__ == '__main__':
+    # Run several copies at once to check claims don't collide, e.g.
+    # python mh_lease.py <directory> 20 & python mh_lease.py <directory> 20
+    # Each claims what it can of tags 0..n-1 (claims expire after 5 seconds)
+    if len(sys.argv) < 3:
+        print("Usage: mh_lease.py <directory> <number of tags>")
+        sys.exit(1)
+    got = []
+    for i in range(int(sys.argv[2])):
+        if try_claim(sys.argv[1], str(i), 5) is not None:
+            got.append(str(i))
+            time.sleep(0.02)
+    print("{} claimed: {}".format(g_owner, " ".join(got)))
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 22 09:31:26 2026
+
+@author: Ben
+
+Counters and gauges describing the work done (scripts scanned, bytes hashed,
+compiles, merges...), exported in the Prometheus text format to a
+node-exporter textfile and/or a local http endpoint
+"""
+import os
+import time
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# prefix of all metric names
+PREFIX = "mark_helper_"
+
+
+class Metric:
+    '''
+    One counter or gauge, optionally split by label values. Safe to update
+    from several threads
+    '''
+
+    def __init__(self, name, kind, doc, label=None):
+        """
+        Parameters
+        ----------
+        name : str - metric name (without PREFIX)
+
+        kind : str - 'counter' or 'gauge'
+
+        doc : str - help text
+
+        label : str - name of the label splitting this metric, or None
+
+        Returns
+        -------
+        None.
+        """
+        self.name = PREFIX + name
+        self.kind = kind
+        self.doc = doc
+        self.label = label
+        '''
+        {label value (or None): value}
+        '''
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, value=None):
+        '''
+        Add `amount` to the metric (for label value `value`)
+        '''
+        with self._lock:
+            self._values[value] = self._values.get(value, 0) + amount
+
+    def dec(self, amount=1, value=None):
+        '''
+        Subtract `amount` from a gauge (for label value `value`)
+        '''
+        self.inc(-amount, value)
+
+    def set(self, amount, value=None):
+        '''
+        Set a gauge to `amount` (for label value `value`)
+        '''
+        with self._lock:
+            self._values[value] = amount
+
+    def get(self, value=None):
+        '''
+        Returns current value (for label value `value`)
+        '''
+        with self._lock:
+            return self._values.get(value, 0)
+
+    def render(self):
+        '''
+        Returns
+        -------
+        list of lines describing this metric in Prometheus text format
+        '''
+        lines = ["# HELP {} {}".format(self.name, self.doc),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda i: str(i[0]))
+        if not values and self.label is None:
+            values = [(None, 0)]
+        for value, amount in values:
+            labels = '' if value is None else '{{{}="{}"}}'.format(
+                self.label, str(value).replace('\\', '\\\\')
+                .replace('"', '\\"'))
+            lines.append("{}{} {}".format(self.name, labels, repr(amount)
+                                          if isinstance(amount, float)
+                                          else amount))
+        return lines
+
+
+g_metrics = []  # all metrics, in order of registration
+
+
+def counter(name, doc, label=None):
+    '''
+    Returns a new registered counter Metric
+    '''
+    metric = Metric(name, "counter", doc, label)
+    g_metrics.append(metric)
+    return metric
+
+
+def gauge(name, doc, label=None):
+    '''
+    Returns a new registered gauge Metric
+    '''
+    metric = Metric(name, "gauge", doc, label)
+    g_metrics.append(metric)
+    return metric
+
+
+scripts_scanned = counter("scripts_scanned_total",
+                          "Scripts whose marking state has been checked.")
+hashed_bytes = counter("hashed_bytes_total",
+                       "Bytes read to hash script and output files.")
+hash_cache = counter("hash_cache_lookups_total",
+                     "Script file digests looked up, by result (hit or " +
+                     "miss).", "result")
+compiles = counter("compiles_total",
+                   "Source files compiled, by result (ok, failed, or " +
+                   "cached if skipped as up to date).",
+                   "result")
+compiles_in_flight = gauge("compiles_in_flight",
+                           "Source files being compiled now.")
+merges = counter("merges_total", "Final merged outputs made.")
+merge_rate = gauge("merge_scripts_per_second",
+                   "Final outputs made per second by the current (or last) " +
+                   "makemerged.")
+jobs_running = gauge("jobs_running", "Commands or background jobs running.",
+                     "command")
+last_update = gauge("last_update_timestamp_seconds",
+                    "Unix time when metrics were last written.")
+
+
+def hash_cache_hit_ratio():
+    '''
+    Returns fraction of hash cache lookups that were hits (0 if none)
+    '''
+    hits = hash_cache.get("hit")
+    total = hits + hash_cache.get("miss")
+    return hits / total if total else 0.0
+
+
+def render():
+    '''
+    Returns
+    -------
+    str : all metrics in Prometheus text format
+    '''
+    last_update.set(time.time())
+    lines = []
+    for metric in g_metrics:
+        lines += metric.render()
+    name = PREFIX + "hash_cache_hit_ratio"
+    lines += ["# HELP {} Fraction of hash cache lookups that were hits."
+              .format(name), "# TYPE {} gauge".format(name),
+              "{} {!r}".format(name, hash_cache_hit_ratio())]
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    '''
+    Atomically write all metrics to `path` (for the node-exporter textfile
+    collector, which reads files ending '.prom')
+
+    Raises
+    ------
+    OSError if file cannot be written
+    '''
+    with open(path + ".tmp", 'w') as file:
+        file.write(render())
+    os.replace(path + ".tmp", path)
+
+
+class Exporter:
+    '''
+    Background export of metrics: rewrites a textfile every `interval`
+    seconds and/or serves them over http on localhost
+    '''
+
+    def __init__(self, textfile='', interval=15, port=0):
+        """
+        Parameters
+        ----------
+        textfile : str - path of textfile to write ('' for none)
+
+        interval : float - seconds between textfile writes
+
+        port : int - localhost port to serve /metrics on (0 for none)
+
+        Returns
+        -------
+        None.
+        """
+        self.textfile = textfile
+        self.interval = max(1, interval)
+        self.port = port
+        self._stop = threading.Event()
+        self._writer = None
+        self._server = None
+
+    def start(self):
+        '''
+        Start exporting
+
+        Raises
+        ------
+        OSError if the http port cannot be opened
+        '''
+        if self.textfile:
+            self._stop.clear()
+            self._writer = threading.Thread(target=self._write_loop,
+                                            daemon=True)
+            self._writer.start()
+        if self.port:
+            import http.server  # only loaded if serving
+            self._server = http.server.ThreadingHTTPServer(
+                ("127.0.0.1", self.port), _make_handler(http.server))
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever,
+                             daemon=True).start()
+
+    def stop(self):
+        '''
+        Stop exporting, writing the textfile one last time
+        '''
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._writer is not None:
+            self._stop.set()
+            self._writer.join()
+            self._writer = None
+
+    def _write_loop(self):
+        while True:
+            try:
+                write_textfile(self.textfile)
+            except OSError:
+                logger.exception("Failed to write metrics to %s",
+                                 self.textfile)
+            if self._stop.wait(self.interval):
+                break
+        try:
+            write_textfile(self.textfile)
+        except OSError:
+            logger.exception("Failed to write metrics to %s", self.textfile)
+
+
+def _make_handler(server_module):
+    '''
+    Returns
+    -------
+    request handler class (from module http.server `server_module`) serving
+    metrics at /metrics
+    '''
+    class MetricsHandler(server_module.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics request: " + format, *args)
+
+    return MetricsHandler
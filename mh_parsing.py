@@ -4,15 +4,23 @@ Created on Wed Apr  1 10:20:52 2020
 
 @author: Ben
 """
+import os
 import re
 import copy
+import time
+import functools
+import threading
 
 import logging
 
 # import loghelper
+import mh_perf
 
 logger = logging.getLogger(__name__)
 
+# number of distinct active lines whose tokens are cached
+TOKEN_CACHE_SIZE = 4096
+
 
 def nextToken(string):
     """
@@ -103,6 +111,107 @@ def makeTokens(string):
         ret.append(val[:2])
     return ret
 
+
+@functools.lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _cached_tokens(string):
+    return tuple(tuple(tok) for tok in makeTokens(string))
+
+
+def cached_tokens(string):
+    '''
+    As `makeTokens`, but remembering the tokens of recently seen strings
+    (e.g. the active lines of a template, parsed once per script), shared by
+    all callers in this process
+
+    Returns
+    --------
+    [[tok0, toktype0], ...] : a new list, which the caller may consume
+    '''
+    return [list(tok) for tok in _cached_tokens(string)]
+
+###############################################################################
+# optional instrumentation
+
+
+class ParseStats:
+    '''
+    Calls and time spent per script command and per active line, collected
+    while enabled (see `enable_stats`). Times include nested commands. Safe
+    to share between threads
+    '''
+
+    def __init__(self):
+        '''
+        {command name: [calls, seconds]}
+        '''
+        self.commands = {}
+        '''
+        {active line text: [evaluations, seconds]}
+        '''
+        self.lines = {}
+        self._lock = threading.Lock()
+
+    def add_command(self, name, seconds):
+        with self._lock:
+            entry = self.commands.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def add_line(self, line, seconds):
+        with self._lock:
+            entry = self.lines.setdefault(line, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def report(self, n=10):
+        '''
+        Returns
+        -------
+        list of lines listing all commands and the `n` active lines taking
+        most time
+        '''
+        with self._lock:
+            commands = sorted(self.commands.items(), key=lambda i: -i[1][1])
+            lines = sorted(self.lines.items(), key=lambda i: -i[1][1])[:n]
+        ret = ["Commands (time includes nested commands):"]
+        ret += ["  \\{:<8} {:>8} calls {:>10.1f} ms".format(
+            name, entry[0], entry[1] * 1000) for name, entry in commands]
+        ret.append("Hottest active lines:")
+        ret += ["  {:>8} runs {:>10.1f} ms  {}".format(
+            entry[0], entry[1] * 1000, line) for line, entry in lines]
+        return ret
+
+
+g_stats = None  # ParseStats while instrumentation is enabled
+
+
+def enable_stats():
+    '''
+    Start collecting ParseStats (keeping any collected already)
+
+    Returns
+    -------
+    ParseStats being collected
+    '''
+    global g_stats
+    if g_stats is None:
+        g_stats = ParseStats()
+    return g_stats
+
+
+def disable_stats():
+    '''
+    Stop collecting ParseStats
+
+    Returns
+    -------
+    ParseStats collected, or None if not enabled
+    '''
+    global g_stats
+    stats = g_stats
+    g_stats = None
+    return stats
+
 ###############################################################################
 # command evaluation/distribution
 
@@ -162,9 +271,19 @@ def interpret(toks, n, lines, cur_line, out_lines, variables):
         except IndexError:
             raise ParseError("Not enough tokens!")
         if tok[1] == 'command':
-            val = command_list[tok[0]](toks,
-                                       lines, cur_line, out_lines,
-                                       variables)
+            stats = g_stats
+            if stats is None:
+                val = command_list[tok[0]](toks,
+                                           lines, cur_line, out_lines,
+                                           variables)
+            else:
+                start = time.perf_counter()
+                try:
+                    val = command_list[tok[0]](toks,
+                                               lines, cur_line, out_lines,
+                                               variables)
+                finally:
+                    stats.add_command(tok[0], time.perf_counter() - start)
         elif tok[1] == 'literal':
             pass  # default is to treat tok as literal
         else:  # assume other and try substitution
@@ -515,14 +634,20 @@ def process_lines(lines, variables, comment_start='%#'):
             line = line[len(comment_start):]
             eq_at = line.find('=')
             if eq_at >= 0:
+                stats = g_stats
+                if stats is not None:
+                    start = time.perf_counter()
                 try:
                     varname = line[:eq_at]
                     if varname in variables:
-                        toks = makeTokens(line[eq_at+1:])
+                        toks = cached_tokens(line[eq_at+1:])
                         variables[varname] = interpret(toks, 1, lines,
                                                        cur_line, ret,
                                                        variables)[0]
                         parsed = True
+                        if stats is not None:  # (lines may have changed)
+                            stats.add_line(comment_start + line,
+                                           time.perf_counter() - start)
                 except Exception as e:
                     print("Failed to parse the following line:")
                     print(line)
@@ -542,10 +667,11 @@ def process_file(input_path, output_path, variables, comment_start="%#"):
     OSError may be raised y IO methods
     '''
     ilines = []
-    with open(input_path, 'r') as ifile:
-        ilines = ifile.readlines()
-    with open(output_path, 'w') as ofile:
-        ofile.writelines(process_lines(ilines, variables, comment_start))
+    with mh_perf.span("parse", os.path.basename(input_path)):
+        with open(input_path, 'r') as ifile:
+            ilines = ifile.readlines()
+        with open(output_path, 'w') as ofile:
+            ofile.writelines(process_lines(ilines, variables, comment_start))
 
 ###############################################################################
 
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 11:42:03 2026
+
+@author: Ben
+
+Timed spans around the slow steps of marking (hashing, parsing, compiling,
+merging etc.), summarised per stage after each command
+"""
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+import contextvars
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# file in the script directory holding the report of the last command
+REPORT_FILE = "perf_report.json"
+# number of slowest spans listed in a report
+N_SLOWEST = 5
+# number of stages (taking most time) whose slowest spans are printed
+N_SLOW_STAGES = 3
+
+# if set, hook(func) wraps each function bound for a worker thread by `bind`
+# (e.g. to profile it, see mh_profile)
+g_worker_hook = None
+
+
+class Recorder:
+    '''
+    Collects spans: (stage, tag, start, duration) tuples, with times from
+    time.perf_counter(), separately for each command being timed. A span
+    goes to the command timed in the thread or asyncio task recording it
+    (or that ran `bind` on the function recording it in a worker thread).
+    Spans recorded outside any command are dropped. Safe to share between
+    threads
+    '''
+
+    def __init__(self):
+        '''
+        span list of the command being timed in the current context
+        '''
+        self._current = contextvars.ContextVar("spans", default=None)
+        self._lock = threading.Lock()
+
+    def add(self, stage, tag, start, duration):
+        '''
+        Record a span of `duration` seconds in `stage` for script/file `tag`
+        '''
+        spans = self._current.get()
+        if spans is not None:
+            with self._lock:
+                spans.append((stage, tag, start, duration))
+
+    def begin(self):
+        '''
+        Start timing a command in the current thread or asyncio task (and
+        tasks it starts)
+
+        Returns
+        -------
+        token to pass to `end` (in the same thread or task)
+        '''
+        spans = []
+        return [spans, time.perf_counter(), self._current.set(spans)]
+
+    def end(self, token, command):
+        '''
+        Stop timing the command started by `begin` returning `token`
+
+        Returns
+        -------
+        report dict (see `make_report`)
+        '''
+        end = time.perf_counter()
+        self._current.reset(token[2])
+        with self._lock:
+            spans = list(token[0])
+        return make_report(command, end - token[1], spans)
+
+    def bind(self, func):
+        '''
+        Returns
+        -------
+        `func` wrapped to record its spans for the command timed in the
+        current context, wherever it is called (e.g. in a worker thread)
+        '''
+        spans = self._current.get()
+        if g_worker_hook is not None:
+            func = g_worker_hook(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = self._current.set(spans)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._current.reset(token)
+        return wrapper
+
+
+g_recorder = Recorder()
+
+
+def bind(func):
+    '''
+    Returns
+    -------
+    `func` wrapped to record its spans for the current command (see
+    Recorder.bind). Use for functions run in worker threads
+    '''
+    return g_recorder.bind(func)
+
+
+@contextlib.contextmanager
+def span(stage, tag=''):
+    '''
+    Context manager recording the time spent in its body as a span of
+    `stage` for `tag` (e.g. script tag or file name). Recorded even if the
+    body raises
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g_recorder.add(stage, tag, start, time.perf_counter() - start)
+
+
+def timed(stage, tag_arg=None):
+    '''
+    Decorator recording each call of a function as a span of `stage`, tagged
+    with the base name of its positional argument number `tag_arg` (if set)
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tag = ''
+            if tag_arg is not None and len(args) > tag_arg:
+                tag = os.path.basename(str(args[tag_arg]))
+            with span(stage, tag):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def make_report(command, wall_time, spans):
+    '''
+    Summarise `spans` recorded during `command`, which took `wall_time`
+    seconds
+
+    Returns
+    -------
+    {"command", "wall time", "stages": {stage: {"count", "total", "mean",
+    "p50", "p95", "max", "busy", "throughput"}}, "slowest": {stage:
+    [[tag, duration]]}} where "p50" and "p95" are percentiles of the span
+    durations, "busy" is the time during which at least one span of the
+    stage was running, and "throughput" is count / busy (items per second)
+    '''
+    by_stage = {}
+    for stage, tag, start, duration in spans:
+        by_stage.setdefault(stage, []).append((tag, start, duration))
+    stages = {}
+    slowest = {}
+    for stage in sorted(by_stage, key=lambda st: -sum(
+            d for t, s, d in by_stage[st])):
+        items = by_stage[stage]
+        total = sum(d for t, s, d in items)
+        busy = _busy_time([(s, s + d) for t, s, d in items])
+        items.sort(key=lambda item: -item[2])
+        stages[stage] = {"count": len(items), "total": total,
+                         "mean": total / len(items),
+                         "p50": _percentile(items, 50),
+                         "p95": _percentile(items, 95),
+                         "max": items[0][2], "busy": busy,
+                         "throughput": len(items) / busy if busy else 0.0}
+        slowest[stage] = [[t, d] for t, s, d in items[:N_SLOWEST]]
+    return {"command": command, "wall time": wall_time, "stages": stages,
+            "slowest": slowest}
+
+
+def _percentile(items, p):
+    '''
+    Returns
+    -------
+    `p` percentile (nearest rank) of the durations of (tag, start, duration)
+    `items`, sorted longest first
+    '''
+    rank = max(1, -(-len(items) * p // 100))  # ceiling
+    return items[len(items) - rank][2]
+
+
+def _busy_time(intervals):
+    '''
+    Returns
+    -------
+    total length of the union of [start, end] `intervals`
+    '''
+    busy = 0.0
+    cur_start = cur_end = None
+    for start, end in sorted(intervals):
+        if cur_end is None or start > cur_end:
+            if cur_end is not None:
+                busy += cur_end - cur_start
+            cur_start, cur_end = start, end
+        else:
+            cur_end = max(cur_end, end)
+    if cur_end is not None:
+        busy += cur_end - cur_start
+    return busy
+
+
+def format_report(report):
+    '''
+    Returns
+    -------
+    list of lines describing `report` (from `make_report`)
+    '''
+    lines = ["Performance of {}: {:.3f} s".format(report["command"],
+                                                  report["wall time"])]
+    for i, stage in enumerate(report["stages"]):  # most time first
+        st = report["stages"][stage]
+        lines.append("  {}: {} in {:.3f} s (mean {:.1f} ms, max {:.1f} ms, "
+                     "{:.1f}/s)".format(stage, st["count"], st["total"],
+                                        st["mean"] * 1000, st["max"] * 1000,
+                                        st["throughput"]))
+        slow = [s for s in report["slowest"][stage] if s[0]]
+        if slow and st["count"] > 1 and i < N_SLOW_STAGES:
+            lines.append("    slowest: " + ", ".join(
+                "{} ({:.1f} ms)".format(t, d * 1000) for t, d in slow))
+    return lines
+
+
+def save_report(report, directory):
+    '''
+    Write `report` as json to REPORT_FILE in `directory`
+
+    Raises
+    ------
+    OSError if file cannot be written
+    '''
+    path = os.path.join(directory, REPORT_FILE)
+    with open(path + ".tmp", 'w') as file:
+        json.dump(report, file, indent=1)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 10:02:11 2026
+
+@author: Ben
+
+Streaming pipeline in which each item moves through a sequence of stages on
+its own. Stages are connected by bounded queues and each has its own pool of
+worker threads
+"""
+import threading
+import queue
+
+import logging
+
+
+import loghelper
+import mh_perf
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # sentinel telling a worker its input is exhausted
+
+
+class Stage:
+    '''
+    One stage of a pipeline: `func` is called on each item by `workers`
+    threads
+    '''
+
+    def __init__(self, name, func, workers=1):
+        """
+        Parameters
+        ----------
+        name : str - name used when reporting progress and failures
+
+        func : unary function called on each item. Items for which it raises
+        are dropped from the pipeline
+
+        workers : int - number of threads running this stage
+
+        Returns
+        -------
+        None.
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+
+
+def run_pipeline(items, stages, queue_size=8, on_done=None):
+    '''
+    Pass each of `items` through each of `stages` in turn. Each item moves on
+    to the next stage as soon as it leaves the last, so that different stages
+    (e.g. disk and cpu bound) overlap.
+
+    Parameters
+    ----------
+    items : iterable of items to process
+
+    stages : list of Stage
+
+    queue_size : maximum number of items waiting between two stages
+
+    on_done : optional unary function called (from a worker thread) with each
+    item that completes the last stage
+
+    Returns
+    -------
+    [done, failed] : where
+        `done` : list of items that completed all stages, in order of
+        completion
+
+        `failed` : {item: stage name} for items dropped by a stage
+    '''
+    done = []
+    failed = {}
+    lock = threading.Lock()
+    queues = [queue.Queue(max(1, queue_size)) for s in stages]
+    alive = [s.workers for s in stages]  # running workers per stage
+
+    def worker(index):
+        stage = stages[index]
+        while True:
+            item = queues[index].get()
+            if item is _STOP:
+                break
+            try:
+                stage.func(item)
+            except Exception:
+                loghelper.print_and_log(logger, "Warning! {} failed for {}"
+                                        .format(stage.name, item))
+                with lock:
+                    failed[item] = stage.name
+                continue
+            if index + 1 < len(stages):
+                queues[index+1].put(item)
+            else:
+                with lock:
+                    done.append(item)
+                if on_done is not None:
+                    on_done(item)
+        # last worker out tells the next stage to stop
+        with lock:
+            alive[index] -= 1
+            last = alive[index] == 0
+        if last and index + 1 < len(stages):
+            for n in range(stages[index+1].workers):
+                queues[index+1].put(_STOP)
+
+    # stage spans are timed as part of the command running the pipeline
+    threads = [threading.Thread(target=mh_perf.bind(worker), args=(i,),
+                                daemon=True)
+               for i, stage in enumerate(stages)
+               for n in range(stage.workers)]
+    for thread in threads:
+        thread.start()
+    if stages:
+        for item in items:  # blocks while first queue full
+            queues[0].put(item)
+        for n in range(stages[0].workers):
+            queues[0].put(_STOP)
+    for thread in threads:
+        thread.join()
+    return [done, failed]
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 15:08:37 2026
+
+@author: Ben
+
+Optional cProfile and tracemalloc instrumentation of CLI commands, switched
+on and off from the CLI
+"""
+import io
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+
+import logging
+
+import mh_perf
+
+logger = logging.getLogger(__name__)
+
+# frames kept for each traced memory allocation
+TRACE_FRAMES = 10
+# functions listed when a profile is dumped
+N_PROFILE_LINES = 20
+
+g_profiling = False  # True while profiling is on
+g_profiler = None  # cProfile.Profile of commands (kept after profiling off)
+g_profile_lock = threading.Lock()  # held briefly to change the globals here
+g_profiled_command = None  # name of command being profiled, if any
+g_worker_stats = None  # pstats.Stats of worker threads (kept likewise)
+g_worker_lock = threading.Lock()  # held while adding to g_worker_stats
+g_thread = threading.local()  # .profiled True while thread is profiled
+g_last_snapshot = None  # tracemalloc snapshot after last traced command
+g_last_diff = None  # memory statistics of last traced command
+g_last_command = ''  # name of last traced command
+
+
+def profiling():
+    '''
+    Returns True if profiling is on
+    '''
+    return g_profiling
+
+
+def start_profile():
+    '''
+    Profile commands run by `run_instrumented`, and functions they hand to
+    worker threads (see mh_perf.bind), from now on. If profiling is off any
+    profile kept from before is discarded, unless the command it is from is
+    still running
+    '''
+    global g_profiling, g_profiler, g_worker_stats
+    with g_profile_lock:
+        if not g_profiling:
+            if g_profiled_command is None:
+                g_profiler = cProfile.Profile()
+                with g_worker_lock:
+                    g_worker_stats = None
+            g_profiling = True
+            mh_perf.g_worker_hook = _profile_worker
+
+
+def stop_profile():
+    '''
+    Stop profiling. The profile collected is kept until profiling is next
+    switched on, so it can still be dumped
+    '''
+    global g_profiling
+    with g_profile_lock:
+        g_profiling = False
+        mh_perf.g_worker_hook = None
+
+
+def dump_profile(path):
+    '''
+    Write the profile collected (so far, or before profiling was switched
+    off) to `path` (pstats format), including worker threads
+
+    Returns
+    -------
+    str : summary of the functions taking most cumulative time
+
+    Raises
+    ------
+    ValueError if nothing has been profiled, or a command is being profiled
+    (reading the profile would stop it)
+
+    OSError if the file cannot be written
+    '''
+    with g_profile_lock:
+        if g_profiled_command is not None:
+            raise ValueError("{} is being profiled, dump the profile when it "
+                             "has finished.".format(g_profiled_command))
+        stats = None
+        if g_profiler is not None:
+            try:
+                stats = pstats.Stats(g_profiler, stream=io.StringIO())
+            except TypeError:  # no data
+                pass
+        with g_worker_lock:
+            if g_worker_stats is not None:
+                if stats is None:
+                    stats = pstats.Stats(stream=io.StringIO())
+                stats.add(g_worker_stats)
+        if stats is None:
+            raise ValueError("No commands profiled yet.")
+        stats.dump_stats(path)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(N_PROFILE_LINES)
+    return stats.stream.getvalue()
+
+
+def tracing():
+    '''
+    Returns True if memory tracing is on
+    '''
+    return tracemalloc.is_tracing()
+
+
+def start_memtrace():
+    '''
+    Trace memory allocations from now on, taking a snapshot after each
+    command run by `run_instrumented`
+    '''
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+
+
+def stop_memtrace():
+    '''
+    Stop tracing memory allocations and discard the last snapshot
+    '''
+    global g_last_snapshot, g_last_diff
+    tracemalloc.stop()
+    g_last_snapshot = None
+    g_last_diff = None
+
+
+def memtrace_top(n=10):
+    '''
+    Returns
+    -------
+    list of lines describing the `n` source lines whose allocations grew
+    most during the last traced command, and its peak traced memory
+
+    Raises
+    ------
+    ValueError if no command has been traced
+    '''
+    if g_last_diff is None:
+        raise ValueError("No commands traced yet.")
+    diff, peak, own_peak = g_last_diff
+    lines = ["Memory of {}: peak {:.1f} MiB{}".format(
+        g_last_command, peak / 2**20,
+        "" if own_peak else " (since memtrace was switched on)")]
+    lines += [str(stat) for stat in diff[:n]]
+    return lines
+
+
+def dump_memtrace(path):
+    '''
+    Write the snapshot taken after the last traced command to `path` (load
+    with tracemalloc.Snapshot.load)
+
+    Raises
+    ------
+    ValueError if no command has been traced
+
+    OSError if the file cannot be written
+    '''
+    if g_last_snapshot is None:
+        raise ValueError("No commands traced yet.")
+    g_last_snapshot.dump(path)
+
+
+def _snapshot():
+    '''
+    Returns
+    -------
+    tracemalloc snapshot, excluding allocations by tracemalloc and the
+    import system
+    '''
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>")])
+
+
+def _profile_worker(func):
+    '''
+    Returns
+    -------
+    `func` wrapped so that each call is profiled (in whichever thread runs
+    it) and its profile added to g_worker_stats. Installed as
+    mh_perf.g_worker_hook while profiling is on
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(g_thread, "profiled", False):
+            return func(*args, **kwargs)  # already profiled
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # another profiler active (python 3.12+)
+            return func(*args, **kwargs)
+        g_thread.profiled = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            g_thread.profiled = False
+            _add_worker_stats(profiler)
+    return wrapper
+
+
+def _add_worker_stats(profiler):
+    '''
+    Add the profile of `profiler` (disabled, in the thread that ran it) to
+    g_worker_stats
+    '''
+    global g_worker_stats
+    try:
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+    except TypeError:  # no data
+        return
+    with g_worker_lock:
+        if g_worker_stats is None:
+            g_worker_stats = stats
+        else:
+            g_worker_stats.add(stats)
+
+
+def run_instrumented(name, func, *args):
+    '''
+    Call func(*args) for command `name`, profiling it if profiling is on
+    (and no other command is being profiled) and recording its memory use
+    if tracing is on. Functions it hands to worker threads through
+    mh_perf.bind are profiled too, but not work done in worker processes
+
+    Returns
+    -------
+    result of func(*args)
+    '''
+    global g_last_snapshot, g_last_diff, g_last_command, g_profiled_command
+    tracing_now = tracemalloc.is_tracing()
+    # before python 3.9 the peak cannot be reset for each command
+    own_peak = hasattr(tracemalloc, "reset_peak")
+    if tracing_now:
+        before = _snapshot()
+        if own_peak:
+            tracemalloc.reset_peak()
+    profiler = None
+    if not getattr(g_thread, "profiled", False):
+        with g_profile_lock:
+            if g_profiling and g_profiled_command is None:
+                profiler = g_profiler
+                g_profiled_command = name
+    try:
+        if profiler is not None:
+            g_thread.profiled = True
+            return profiler.runcall(func, *args)
+        return func(*args)
+    finally:
+        if profiler is not None:
+            g_thread.profiled = False
+            with g_profile_lock:
+                g_profiled_command = None
+        if tracing_now and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            after = _snapshot()
+            g_last_snapshot = after
+            g_last_diff = [after.compare_to(before, 'lineno'), peak,
+                           own_peak]
+            g_last_command = name
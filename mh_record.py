@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:40:27 2026
+
+@author: Ben
+
+In-memory record of the marking state of one script
+"""
+import sys
+
+
+class ScriptRecord:
+    '''
+    Marking state of one script. Stored in mkh files as a json list (see
+    `to_list` and mh_script_management.declare_marked)
+
+    Attributes
+    ----------
+    files : list of file paths corresponding to the script's tag
+
+    hash : hash value of those files at the time they were deemed marked
+
+    marks : {'question':'mark'} for questions asserted as marked
+
+    final_valid : True when source file passed a final validation check
+
+    out_hash : '' or a hash of the output (pdf) when both source and output
+    validation have succeeded
+
+    valid_marks : {'question':'mark'} for all questions checked when
+    `out_hash` last set
+
+    file_hashes : hash of each file in `files` when `hash` was set
+    '''
+    __slots__ = ('files', 'hash', 'marks', 'final_valid', 'out_hash',
+                 'valid_marks', 'file_hashes')
+
+    def __init__(self, files, file_hash='', marks=None, final_valid=False,
+                 out_hash='', valid_marks=None, file_hashes=None):
+        self.files = files
+        self.hash = file_hash
+        self.marks = intern_marks(marks)
+        self.final_valid = final_valid
+        self.out_hash = out_hash
+        self.valid_marks = intern_marks(valid_marks)
+        self.file_hashes = file_hashes if file_hashes is not None else []
+
+    @classmethod
+    def from_list(cls, data):
+        '''
+        Make a record from mkh file data (older files may lack trailing
+        elements)
+
+        Raises
+        ------
+        ValueError if `data` is not in mkh format
+        '''
+        try:
+            validation = data[4] if len(data) > 4 and data[4] else ['', {}]
+            return cls(list(data[0]), data[1], dict(data[2]), bool(data[3]),
+                       validation[0], dict(validation[1]),
+                       list(data[5]) if len(data) > 5 else [])
+        except (IndexError, KeyError, TypeError) as e:
+            raise ValueError("Invalid mkh data!") from e
+
+    def to_list(self):
+        '''
+        Returns
+        -------
+        list in mkh file format
+        '''
+        return [self.files, self.hash, self.marks, self.final_valid,
+                [self.out_hash, self.valid_marks], self.file_hashes]
+
+    def copy(self):
+        '''
+        Returns
+        -------
+        ScriptRecord : copy of this record (not sharing any mutable members)
+        '''
+        return ScriptRecord(self.files[:], self.hash, self.marks,
+                            self.final_valid, self.out_hash, self.valid_marks,
+                            self.file_hashes[:])
+
+    def reset_validation(self):
+        '''
+        Clear source and output validation (marks are kept)
+        '''
+        self.final_valid = False
+        self.out_hash = ''
+        self.valid_marks = {}
+
+    def __eq__(self, other):
+        if not isinstance(other, ScriptRecord):
+            return NotImplemented
+        return self.to_list() == other.to_list()
+
+    def __repr__(self):
+        return "ScriptRecord({!r})".format(self.to_list())
+
+
+def intern_marks(marks):
+    '''
+    Returns
+    -------
+    copy of dict `marks` ({question: mark}) with the question names interned,
+    so that each name is held only once however many scripts use it
+    '''
+    if not marks:
+        return {}
+    return {sys.intern(q): marks[q] for q in marks}
@@ -7,18 +7,39 @@ Created on Mon May 11 12:06:04 2020
 Methods involving tracking marking progress, and script files
 """
 import os
+import csv
 import json
 import logging
+import concurrent.futures as cf
 import re
-
-import PyPDF2 as ppdf
+import shutil
+import tempfile
+import threading
 
 import mh_hash
+import mh_metrics
+import mh_perf
+import mh_record as mhr
+import mh_state as mhst
+import lazyimport
 import loghelper
 import config
 
+ppdf = lazyimport.lazy_import("PyPDF2")  # slow to load, only for pdf work
+
 logger = logging.getLogger(__name__)
 
+# approximate ratio of peak memory to input size when merging in one pass
+MERGE_MEMORY_FACTOR = 4
+# default pages per part file for merge_pdfs_streamed
+MERGE_CHUNK_PAGES = 32
+# largest difference in page width or height (pt) accepted when merging
+PAGE_SIZE_TOLERANCE = 1
+# file in final directory recording inputs behind each final output
+MERGE_MANIFEST = "manifest.json"
+# file in script directory saving hashes of script files
+HASH_CACHE_FILE = "hashcache.json"
+
 
 class MarkingConfig(config.Config):
     '''
@@ -34,6 +55,9 @@ class MarkingConfig(config.Config):
                           prompt="Script suffix e.g. \'.pdf\': ")
         self.add_property("script", "directory", value="",
                           prompt="Script directory: ")
+        self.add_property("script", "integrity", value="full",
+                          prompt="Integrity checks on script files (\'full\'" +
+                          " or \'fast\'): ")
         # source file names directories, editors etc
         self.add_category("marking")
         self.add_property("marking", "editor", value="texworks",
@@ -62,6 +86,34 @@ class MarkingConfig(config.Config):
                           prompt="Sub-directory used to prepare for merge: ")
         self.add_property("merge", "final directory", value="final",
                           prompt="Sub-directory where final output appears: ")
+        self.add_property("merge", "memory budget", value=512,
+                          prompt="Memory budget for merging one script in" +
+                          " MB (0 for no limit): ", vartype=int)
+        # worker threads for each stage of merging etc
+        self.add_category("parallel")
+        for stage, workers in [("blank", 1), ("copy", 1),
+                               ("compile", os.cpu_count() or 1),
+                               ("merge", 1),
+                               ("parse", os.cpu_count() or 1),
+                               ("hash", os.cpu_count() or 1)]:
+            self.add_property("parallel", stage + " workers", value=workers,
+                              prompt="Number of {} workers: ".format(stage),
+                              vartype=int)
+        self.add_property("parallel", "queue size", value=8,
+                          prompt="Maximum scripts waiting between stages: ",
+                          vartype=int)
+        # export of progress metrics for monitoring
+        self.add_category("metrics")
+        self.add_property("metrics", "textfile", value="",
+                          prompt="File to write metrics to (e.g. for the " +
+                          "node exporter textfile collector, blank for " +
+                          "none): ")
+        self.add_property("metrics", "interval", value=15,
+                          prompt="Seconds between writes of metrics file: ",
+                          vartype=int)
+        self.add_property("metrics", "http port", value=0,
+                          prompt="Localhost port to serve metrics on (0 " +
+                          "for none): ", vartype=int)
 
     # handy access functions
     def numsep(self):
@@ -82,6 +134,18 @@ class MarkingConfig(config.Config):
         '''
         return self._categories["script"]["directory"]
 
+    def integrity_mode(self):
+        '''
+        Returns script/integrity property
+        '''
+        return self._categories["script"]["integrity"]
+
+    def hash_cache_path(self):
+        '''
+        Returns full path to saved hashes of script files (in script dir)
+        '''
+        return os.path.join(self.script_dir(), HASH_CACHE_FILE)
+
     def editor(self):
         '''
         Returns marking/editor property
@@ -154,6 +218,44 @@ class MarkingConfig(config.Config):
         return os.path.join(self.script_dir(),
                             self._categories["merge"]["final directory"])
 
+    def merge_memory_budget(self):
+        '''
+        Returns merge/memory budget property converted to bytes (0 if no
+        limit is set)
+        '''
+        return max(0, int(self._categories["merge"]["memory budget"])) \
+            * 1024 * 1024
+
+    def stage_workers(self, stage):
+        '''
+        Returns parallel/<stage> workers property (at least 1)
+        '''
+        return max(1, int(self._categories["parallel"][stage + " workers"]))
+
+    def queue_size(self):
+        '''
+        Returns parallel/queue size property (at least 1)
+        '''
+        return max(1, int(self._categories["parallel"]["queue size"]))
+
+    def metrics_textfile(self):
+        '''
+        Returns metrics/textfile property
+        '''
+        return self._categories["metrics"]["textfile"]
+
+    def metrics_interval(self):
+        '''
+        Returns metrics/interval property (at least 1)
+        '''
+        return max(1, int(self._categories["metrics"]["interval"]))
+
+    def metrics_port(self):
+        '''
+        Returns metrics/http port property
+        '''
+        return int(self._categories["metrics"]["http port"])
+
     def tag_to_sourcepath(self, tag):
         '''
         Given `tag` return full path to associated source file
@@ -188,6 +290,7 @@ class MarkingConfig(config.Config):
         return os.path.join(self.final_dir(), tag+self.merged_suffix())
 
 
+@mh_perf.timed("list scripts")
 def get_script_list(cfg):
     '''
     Parameters
@@ -246,10 +349,15 @@ def check_marking_state(cfg, questions=None, final_assert=True,
     final_assert : if True then any file that has not passed final validation
     will also be included
 
+    If cfg.integrity_mode() is \'fast\' then script files whose size and
+    modification time match those saved when last hashed are assumed
+    unchanged, and their hashes are verified in the background (see
+    mh_hash.HashCache)
+
     Returns
     -------
-    [to_mark, done_mark]: lists of scripts left to mark and marked in mkh
-    format.
+    [to_mark, done_mark]: dicts {tag: ScriptRecord} of scripts left to mark
+    and marked.
     (A script is 'marked' in this case if all requested questions are available
     and final validation reported complete, if final_assert == True)
 
@@ -262,62 +370,201 @@ def check_marking_state(cfg, questions=None, final_assert=True,
     if not questions:
         questions = []
 
+    fast = cfg.integrity_mode() == 'fast'
+    if fast:  # trust digests of files unchanged since last session
+        mh_hash.g_hash_cache.load(cfg.hash_cache_path())
+
     to_mark_temp = get_script_list(cfg)
+    existing = set(os.listdir(script_directory))
+    store = mhst.get_store(script_directory)
+    journal = store.journal_records()
     ret = [{}, {}]  # to_mark, done_mark
 
     for tag in to_mark_temp:
-        # input hash, question marks, source validate flag, output hash
-        to_mark_temp[tag] = [to_mark_temp[tag], '', {}, False, '']
-        files_hash = mh_hash.hash_file_list(to_mark_temp[tag][0],
+        mh_metrics.scripts_scanned.inc()
+        # only files that changed since last hashed are re-read
+        digests = mh_hash.hash_file_digests(to_mark_temp[tag],
                                             script_directory)
+        record = mhr.ScriptRecord(to_mark_temp[tag],
+                                  mh_hash.combine_digests(digests),
+                                  file_hashes=digests)
         marked = False  # file exists and all questions marked?
-        # check for matching .mkh file
-        if tag+'.mkh' in os.listdir(script_directory):
+        # check for saved state (journal entry or matching .mkh file)
+        if tag in journal or tag+'.mkh' in existing:
             try:
-                with open(os.path.join(script_directory, tag+".mkh"),
-                          "r")as mkh:
-                    mkh_data = json.load(mkh)
-                    # extract non-hash, non-path data
-                    to_mark_temp[tag][2:] = mkh_data[2:]
-                    # if hashes don't match it's not marked!
-                    if mkh_data[:2] == [to_mark_temp[tag][0], files_hash]:
-                        marked = mkh_data[3] or not final_assert
-                        marklist = mkh_data[2]
-                        #  in output validation mode
-                        #  check marks from validation instead
-                        if match_outhash:
-                            marklist = mkh_data[4][1]
-                        # make sure all questions marked too
-                        for que in questions:
-                            if que not in marklist:
-                                marked = False
-                                break
-                        if match_outhash:
-                            outhash = mh_hash.hash_file_list(
-                                [tag + cfg.output_suffix()],
-                                cfg.marking_dir())
-                            # outhash valid and matches saved value
-                            marked = marked and outhash == \
-                                mkh_data[4][0] and outhash
-
-                    else:
-                        print("Warning: originals modified for script {}"
-                              .format(tag))
+                saved = journal.get(tag)
+                if saved is None:
+                    saved = mhst.read_snapshot(store.snapshot_path(tag))
+                # extract non-hash, non-path data
+                record.marks = saved.marks
+                record.final_valid = saved.final_valid
+                record.out_hash = saved.out_hash
+                record.valid_marks = saved.valid_marks
+                # if hashes don't match it's not marked!
+                if saved.files == record.files and \
+                        mh_hash.script_hash_matches(
+                            saved.hash, saved.files, script_directory,
+                            digests):
+                    marked = saved.final_valid or not final_assert
+                    marklist = saved.marks
+                    #  in output validation mode
+                    #  check marks from validation instead
+                    if match_outhash:
+                        marklist = saved.valid_marks
+                    # make sure all questions marked too
+                    for que in questions:
+                        if que not in marklist:
+                            marked = False
+                            break
+                    if match_outhash:
+                        # outhash valid and matches saved value
+                        marked = marked and mh_hash.output_hash_matches(
+                            saved.out_hash, [tag + cfg.output_suffix()],
+                            cfg.marking_dir())
+
+                else:
+                    print("Warning: originals modified for script {}{}"
+                          .format(tag, _describe_modified(saved,
+                                                          record)))
             except (OSError, TypeError, ValueError):
                 loghelper.print_and_log(logger, "Error occurred checking {}"
                                         .format(tag))
                 marked = False
 
         # add to to_mark
-        if not marked:
-            ret[0][tag] = to_mark_temp[tag]
-            ret[0][tag][1] = files_hash
-        else:
-            ret[1][tag] = to_mark_temp[tag]
-            ret[1][tag][1] = files_hash
+        ret[0 if not marked else 1][tag] = record
+    try:
+        mh_hash.g_hash_cache.save(cfg.hash_cache_path(), script_directory)
+    except OSError:
+        loghelper.print_and_log(logger, "Warning: failed to save hashes.")
+    if fast:
+        mh_hash.g_hash_cache.verify_in_background()
     return ret
 
 
+def read_marking_state(cfg):
+    '''
+    Read the saved marking state of every script in one pass over the script
+    directory and journal, without hashing any files
+
+    Parameters
+    ----------
+    cfg : MarkingConfig specifying current job
+
+    Returns
+    -------
+    [records, unsaved] : where
+        `records` : {tag: ScriptRecord} as last saved for each script
+
+        `unsaved` : list of tags with no (valid) saved state
+    '''
+    script_directory = cfg.script_dir()
+    scripts = get_script_list(cfg)
+    existing = set(os.listdir(script_directory))
+    store = mhst.get_store(script_directory)
+    journal = store.journal_records()
+    records = {}
+    unsaved = []
+    for tag in scripts:
+        if tag in journal:
+            records[tag] = journal[tag]
+        elif tag+'.mkh' in existing:
+            try:
+                records[tag] = mhst.read_snapshot(store.snapshot_path(tag))
+            except (OSError, ValueError):
+                loghelper.print_and_log(logger, "Error occurred reading {}"
+                                        .format(tag))
+                unsaved.append(tag)
+        else:
+            unsaved.append(tag)
+    return [records, unsaved]
+
+
+def verify_marking_state(records, cfg):
+    '''
+    Check that the script files and compiled output of each record still
+    match the hashes saved with it. Scripts are checked in parallel by
+    cfg.stage_workers("hash") threads
+
+    Parameters
+    ----------
+    records : {tag: ScriptRecord} e.g. from `read_marking_state`
+
+    cfg : MarkingConfig specifying current job
+
+    Returns
+    -------
+    {tag: reason} for records that fail the check
+    '''
+    script_directory = cfg.script_dir()
+    scripts = get_script_list(cfg)
+
+    def verify(tag):
+        record = records[tag]
+        if scripts.get(tag) != record.files:
+            return "script files added or removed"
+        if not mh_hash.script_hash_matches(record.hash, record.files,
+                                           script_directory):
+            return "originals modified"
+        if not mh_hash.output_hash_matches(record.out_hash,
+                                           [tag + cfg.output_suffix()],
+                                           cfg.marking_dir()):
+            return "output modified or not validated"
+        return None
+
+    failures = {}
+    with cf.ThreadPoolExecutor(cfg.stage_workers("hash")) as pool:
+        for tag, reason in zip(records,
+                               pool.map(mh_perf.bind(verify), records)):
+            if reason is not None:
+                failures[tag] = reason
+    return failures
+
+
+def write_marks_csv(out_path, records, questions):
+    '''
+    Write the validated marks for `questions` from each of `records` to a
+    csv file, one row per script (in tag order) streamed as it is produced
+
+    Parameters
+    ----------
+    out_path : path to csv file to (over)write
+
+    records : {tag: ScriptRecord} all with validated marks for `questions`
+
+    questions : list of question names (one column each)
+
+    Raises
+    ------
+    OSError if the file cannot be written
+
+    KeyError if a record lacks a validated mark for one of `questions`
+    '''
+    with open(out_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["Script #"] +
+                        ["Question {}".format(q) for q in questions])
+        writer.writerows([tag] + [records[tag].valid_marks[q]
+                                  for q in questions]
+                         for tag in sorted(records))
+
+
+def _describe_modified(saved, record):
+    '''
+    Compare per-file hashes saved in ScriptRecord `saved` with those in
+    `record`
+
+    Returns
+    -------
+    str : ' (<changed files>)' or '' if these cannot be identified
+    '''
+    if not saved.file_hashes or saved.files != record.files:
+        return ''
+    changed = [f for f, old, new in zip(record.files, saved.file_hashes,
+                                        record.file_hashes) if old != new]
+    return " ({})".format(", ".join(changed)) if changed else ''
+
+
 def get_edit_epoch(paths):
     """
     Return maximum modification timestamp among files at a list of directories
@@ -354,6 +601,60 @@ def check_page_counts(input_pdf_paths, output_pdf_path):
         == count_pdf_pages([output_pdf_path])
 
 
+class PageSizeCache:
+    '''
+    Page sizes of pdf files, remembered with the size and modification time
+    of each file when read, so that a file is only parsed again if these
+    change. Safe to share between threads
+    '''
+
+    def __init__(self):
+        '''
+        {full path: [size, mtime_ns, [[width, height] of each page]]}
+        '''
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def sizes(self, path):
+        '''
+        Returns
+        -------
+        list of [width, height] of each page of the pdf at `path`
+
+        Raises
+        ------
+        OSError if file cannot be read
+
+        PyPDF2.utils.PdfReadError if it is not a valid pdf
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        reader = ppdf.PdfFileReader(path)
+        sizes = []
+        for i in range(reader.getNumPages()):
+            dims = reader.getPage(i).mediaBox
+            sizes.append([abs(dims.lowerRight[0]-dims.lowerLeft[0]),
+                          abs(dims.upperRight[1]-dims.lowerRight[1])])
+        with self._lock:
+            self._entries[path] = [stat.st_size, stat.st_mtime_ns, sizes]
+        return sizes
+
+    def clear(self):
+        '''
+        Forget all page sizes
+        '''
+        with self._lock:
+            self._entries = {}
+
+
+# page sizes shared by all callers (and marking tasks) in this process
+g_page_sizes = PageSizeCache()
+
+
 def count_pdf_pages(file_paths):
     '''
     given a list of file paths (all pdfs) sum the numbers of pages in those
@@ -370,8 +671,7 @@ def count_pdf_pages(file_paths):
     pages = 0
     for fip in file_paths:
         try:
-            reader = ppdf.PdfFileReader(fip)
-            pages += reader.getNumPages()
+            pages += len(g_page_sizes.sizes(fip))
         except (ppdf.utils.PdfReadError, OSError):
             loghelper.print_and_log(logger,
                                     "Could not count pages in {}"
@@ -382,7 +682,8 @@ def count_pdf_pages(file_paths):
 def declare_marked(tag, to_mark, cfg):
     '''
     To be called when marking state of script with given tag deemed to have
-    changed. Create/update associated mkh file
+    changed. Record the new state in the journal (later compacted into the
+    associated mkh file, see mh_state.StateStore)
 
     Parameters
     ----------
@@ -390,7 +691,7 @@ def declare_marked(tag, to_mark, cfg):
 
     script_directory : directory of script files (where mkh files live)
 
-    to_mark : dictionary of mkh entry data for current doc list
+    to_mark : dictionary of ScriptRecords for current doc list
     (tag is a key for this)
 
 
@@ -400,12 +701,13 @@ def declare_marked(tag, to_mark, cfg):
 
 
     [`filenames`,`hash`,`questions`,`final_valid`,
-     [`output_hash`,`qs_valid`]] where:
+     [`output_hash`,`qs_valid`], `file_hashes`] where:
 
         `filenames` : list of file paths corresponding to the tag
 
         `hash` : hash value of those files at the time they were
-        deemed marked
+        deemed marked. Either untagged (sha256 of all files in turn) or
+        tagged with its algorithm (see mh_hash.combine_digests)
 
         `questions` : {'question':'mark'} for `question`s
         asserted as marked. `mark` is the recorded mark
@@ -414,19 +716,74 @@ def declare_marked(tag, to_mark, cfg):
         check last time it was marked
 
         `output_hash` : '' or a hash of the output (pdf) when both source
-        and output validation have succeeded
+        and output validation have succeeded. Either untagged (raw sha256) or
+        tagged with its algorithm (see mh_hash.hash_pdf_stable)
 
         `qs_valid` : {`question_name`: `mark`} (as in questions)
         for all questions checked when `output_hash` last set
+
+        `file_hashes` : hash of each file in `filenames` when `hash` was set
+        (may be absent from older files)
     '''
-    with open(os.path.join(cfg.script_dir(),
-                           tag+".mkh"), "w") as mkh:
-        json.dump(to_mark[tag], mkh)
+    mhst.get_store(cfg.script_dir()).put(tag, to_mark[tag])
+
+
+def originals_changed(tag, record, cfg):
+    '''
+    Check whether the script files of `tag` have changed since its marking
+    state was saved
+
+    Parameters
+    ----------
+    tag : internal tag of script
+
+    record : ScriptRecord for `tag` as returned by check_marking_state
+    (with the current files and hash)
+
+    cfg : MarkingConfig for current job
+
+    Returns
+    -------
+    bool : True iff state is saved for `tag` and its files or hash differ
+    from the current ones in `record`
+    '''
+    try:
+        saved = mhst.get_store(cfg.script_dir()).get(tag)
+    except (OSError, ValueError):
+        return False  # nothing saved yet
+    return saved.files != record.files or not mh_hash.script_hash_matches(
+        saved.hash, saved.files, cfg.script_dir(), record.file_hashes)
+
+
+def state_changed_since(tag, record, cfg):
+    '''
+    Check whether the saved marking state of `tag` differs from `record`
+    (e.g. because another marker has saved it since `record` was read)
+
+    Parameters
+    ----------
+    tag : internal tag of script
+
+    record : ScriptRecord for `tag` as returned by check_marking_state
+
+    cfg : MarkingConfig for current job
+
+    Returns
+    -------
+    bool : True iff marks or validation saved for `tag` differ from `record`
+    '''
+    try:
+        saved = mhst.get_store(cfg.script_dir()).get(tag)
+    except (OSError, ValueError):
+        saved = mhr.ScriptRecord(record.files)  # nothing saved yet
+    return [saved.marks, saved.final_valid, saved.out_hash,
+            saved.valid_marks] != [record.marks, record.final_valid,
+                                   record.out_hash, record.valid_marks]
 
 
 def reset_validation(tag, cfg):
     '''
-    Look for mkh file associated to `tag` and reset validation elements
+    Look for saved state associated to `tag` and reset validation elements
 
     Parameters
     ----------
@@ -437,24 +794,91 @@ def reset_validation(tag, cfg):
 
     Raises
     ------
-    OSError if mkh file not found
+    OSError if no state saved for `tag`
+
+    ValueError if saved data invalid
+    '''
+    store = mhst.get_store(cfg.script_dir())
+    record = store.get(tag)
+    record.reset_validation()
+    store.put(tag, record)
+
+
+def get_merge_inputs(tag, done_mark, cfg):
+    '''
+    Collect the hashes of the inputs used to produce the final merged output
+    for a script
+
+    Parameters
+    ----------
+    tag : internal tag of script
+
+    done_mark : dict of ScriptRecords (tag is a key for this)
+
+    cfg : MarkingConfig for current job
+
+    Returns
+    -------
+    {'originals': hash, 'source': hash, 'overlay': hash} where `originals` is
+    the hash of the script files, `source` the hash of the marked source file
+    and `overlay` the validated output hash saved in the record
+
+    Raises
+    ------
+    OSError if the source file cannot be read
+    '''
+    return {'originals': done_mark[tag].hash,
+            'source': mh_hash.hash_file_list([cfg.tag_to_sourcepath(tag)]),
+            'overlay': done_mark[tag].out_hash}
+
 
-    TypeError or ValueError if JSON fails
+def load_merge_manifest(cfg):
+    '''
+    Read the merge manifest from the final output directory
+
+    Merge manifest format
+    =====================
+    json file containing {`tag`: `inputs`} where `inputs` is as returned by
+    `get_merge_inputs` at the time the final output for `tag` was made
 
-    ValueError if data format invalid
+    Returns
+    -------
+    dict : the manifest, or {} if none can be read
     '''
-    filepath = os.path.join(cfg.script_dir(), tag+".mkh")
-    mkh_data = None
-    with open(filepath, 'r') as file:
-        mkh_data = json.load(file)
     try:
-        mkh_data[3:] = [False, ['', {}]]
-    except (IndexError, KeyError):
-        raise ValueError("Invalid mkh data for {}!".format(tag))
-    with open(filepath, 'w') as file:
-        json.dump(mkh_data, file)
+        with open(os.path.join(cfg.final_dir(), MERGE_MANIFEST), 'r') as file:
+            manifest = json.load(file)
+        if isinstance(manifest, dict):
+            return manifest
+    except (OSError, TypeError, ValueError):
+        pass
+    return {}
 
 
+def save_merge_manifest(cfg, manifest):
+    '''
+    Write `manifest` (see `load_merge_manifest`) to the final output directory
+
+    Raises
+    ------
+    OSError if file cannot be written
+    '''
+    with open(os.path.join(cfg.final_dir(), MERGE_MANIFEST), 'w') as file:
+        json.dump(manifest, file)
+
+
+def is_merge_up_to_date(tag, inputs, manifest, cfg):
+    '''
+    Returns
+    -------
+    bool : True iff the final output for `tag` exists and the manifest records
+    that it was made from `inputs`
+    '''
+    return manifest.get(tag) == inputs \
+        and os.path.isfile(cfg.tag_to_mergefinal(tag))
+
+
+@mh_perf.timed("blank", 1)
 def make_blank_pdf_like(in_path, out_path):
     '''
     Copy a pdf from `in_path` and create a new pdf at `out_path` (may overwrite
@@ -468,18 +892,85 @@ def make_blank_pdf_like(in_path, out_path):
 
     out_path : path of file to create/overwrite
     '''
-    reader = ppdf.PdfFileReader(in_path)
     writer = ppdf.PdfFileWriter()
-    for i in range(reader.getNumPages()):
-        dims = reader.getPage(i).mediaBox
-        writer.addBlankPage(abs(dims.lowerRight[0]-dims.lowerLeft[0]),
-                            abs(dims.upperRight[1]-dims.lowerRight[1]))
+    for width, height in g_page_sizes.sizes(in_path):
+        writer.addBlankPage(width, height)
 
     with open(out_path, "wb") as file:
         writer.write(file)
 
 
-def merge_pdfs(files_below, file_above, out_path, below_dir=''):
+def estimate_merge_memory(files_below, file_above, below_dir=''):
+    '''
+    Rough estimate of the peak memory (in bytes) used by `merge_pdfs` when all
+    pages are merged in a single pass
+
+    Parameters
+    ----------
+    files_below : list of paths (relative to `below_dir`) of the base layer
+
+    file_above : full path to pdf to overlay
+
+    below_dir : directory for files in files_below
+
+    Returns
+    -------
+    int : estimated bytes
+    '''
+    total = os.path.getsize(file_above)
+    for fib in files_below:
+        total += os.path.getsize(os.path.join(below_dir, fib))
+    return total * MERGE_MEMORY_FACTOR
+
+
+def _merge_page(page, page_above):
+    '''
+    Check page sizes agree (within PAGE_SIZE_TOLERANCE) and merge
+    `page_above` onto `page` (in place), moved to the origin of `page`
+    (blank pages made by `make_blank_pdf_like` start at 0, 0 but scanned
+    pages need not)
+
+    Raises
+    ------
+    ValueError if page sizes don't match
+    '''
+    dims = page.mediaBox
+    dims_above = page_above.mediaBox
+    if abs(abs(dims.getWidth()) - abs(dims_above.getWidth())) > \
+            PAGE_SIZE_TOLERANCE or \
+       abs(abs(dims.getHeight()) - abs(dims_above.getHeight())) > \
+            PAGE_SIZE_TOLERANCE:
+        raise ValueError("Page size mismatch")
+
+    left = min(dims.lowerLeft[0], dims.upperRight[0])
+    bottom = min(dims.lowerLeft[1], dims.upperRight[1])
+    left_above = min(dims_above.lowerLeft[0], dims_above.upperRight[0])
+    bottom_above = min(dims_above.lowerLeft[1], dims_above.upperRight[1])
+    page.mergeTranslatedPage(page_above, float(left - left_above),
+                             float(bottom - bottom_above), True)
+
+
+def make_blanks_for(tag, done_mark, cfg):
+    '''
+    Make a blank pdf like each constituent file of script `tag` in the merging
+    directory (see `make_blank_pdf_like`)
+
+    Parameters
+    ----------
+    tag : internal tag of script
+
+    done_mark : dict of ScriptRecords (tag is a key for this)
+
+    cfg : MarkingConfig for current job
+    '''
+    for file in done_mark[tag].files:  # constituent files
+        make_blank_pdf_like(os.path.join(cfg.script_dir(), file),
+                            os.path.join(cfg.merged_dir(), file))
+
+
+@mh_perf.timed("merge", 2)
+def merge_pdfs(files_below, file_above, out_path, below_dir='',
+               memory_budget=0):
     """
     Add content of a pdf above a another (spread over one or more files)
     to create one file.
@@ -495,6 +986,10 @@ def merge_pdfs(files_below, file_above, out_path, below_dir=''):
     out_path : string
         full path to output file to generate
     below_dir : directory for files in files_below
+    memory_budget : int
+        if positive, and the merge is estimated to need more than this many
+        bytes (see `estimate_merge_memory`), `merge_pdfs_streamed` is used
+        instead
 
     Raises
     ------
@@ -507,9 +1002,15 @@ def merge_pdfs(files_below, file_above, out_path, below_dir=''):
     None.
 
     """
-
-    # pylint: disable=too-many-locals
-    # not too bad
+    if memory_budget > 0:
+        estimate = estimate_merge_memory(files_below, file_above, below_dir)
+        if estimate > memory_budget:
+            # scale chunks so each should fit comfortably in the budget
+            pages = max(1, count_pdf_pages([file_above]))
+            chunk = int(memory_budget * pages / estimate)
+            merge_pdfs_streamed(files_below, file_above, out_path, below_dir,
+                                max(1, chunk))
+            return
 
     readers_below = [ppdf.PdfFileReader(os.path.join(below_dir, f))
                      for f in files_below]
@@ -525,17 +1026,8 @@ def merge_pdfs(files_below, file_above, out_path, below_dir=''):
     writer = ppdf.PdfFileWriter()
     for reb in readers_below:
         for i in range(reb.getNumPages()):
-            page = None
             page = reb.getPage(i)
-            page_above = reader_above.getPage(page_at)
-
-            dims = page.mediaBox
-            dims_above = page.mediaBox
-            if dims.lowerLeft != dims_above.lowerLeft or\
-               dims.upperRight != dims_above.upperRight:
-                raise ValueError("Page size mismatch")
-
-            page.mergeScaledPage(page_above, 1.0, True)
+            _merge_page(page, reader_above.getPage(page_at))
 
             writer.addPage(page)
             page_at += 1
@@ -544,6 +1036,89 @@ def merge_pdfs(files_below, file_above, out_path, below_dir=''):
         writer.write(file)
 
 
+def merge_pdfs_streamed(files_below, file_above, out_path, below_dir='',
+                        chunk_pages=MERGE_CHUNK_PAGES):
+    """
+    As `merge_pdfs`, but with bounded memory: pages are merged in chunks of
+    at most `chunk_pages` which are written to temporary part files as soon
+    as they are complete. Each base layer file is opened only while its pages
+    are merged, and closed (releasing its reader) before the next is opened.
+    The parts are then joined to produce `out_path`.
+
+    Slower than `merge_pdfs`, so intended for very long scripts only.
+
+    Parameters
+    ----------
+    files_below : list of paths (relative to `below_dir`) of the base layer
+
+    file_above : full path to pdf to overlay
+
+    out_path : full path to output file to generate
+
+    below_dir : directory for files in files_below
+
+    chunk_pages : maximum number of merged pages held before writing a part
+
+    Raises
+    ------
+    ValueError
+            if number of pages in the two input files don't match
+            or if page sizes don't match
+    """
+    if count_pdf_pages([os.path.join(below_dir, f) for f in files_below]) \
+            != count_pdf_pages([file_above]):
+        raise ValueError("Pagecount mismatch.")
+
+    part_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_path)))
+    part_paths = []
+
+    def write_part(writer):
+        part_paths.append(os.path.join(part_dir,
+                                       "{}.pdf".format(len(part_paths))))
+        with open(part_paths[-1], "wb") as file:
+            writer.write(file)
+
+    try:
+        with open(file_above, "rb") as stream_above:
+            reader_above = ppdf.PdfFileReader(stream_above)
+            page_at = 0  # index of page being added
+            for fib in files_below:
+                with open(os.path.join(below_dir, fib), "rb") as stream_below:
+                    reader_below = ppdf.PdfFileReader(stream_below)
+                    writer = ppdf.PdfFileWriter()
+                    for i in range(reader_below.getNumPages()):
+                        page = reader_below.getPage(i)
+                        _merge_page(page, reader_above.getPage(page_at))
+                        writer.addPage(page)
+                        page_at += 1
+                        if writer.getNumPages() >= chunk_pages:
+                            write_part(writer)
+                            writer = ppdf.PdfFileWriter()
+                    # objects from reader_below must be written before the
+                    # stream closes
+                    if writer.getNumPages() > 0:
+                        write_part(writer)
+                    writer = None
+                    reader_below = None
+
+        # join parts, keeping only their (already merged) objects open
+        part_streams = []
+        try:
+            writer = ppdf.PdfFileWriter()
+            for path in part_paths:
+                part_streams.append(open(path, "rb"))
+                reader = ppdf.PdfFileReader(part_streams[-1])
+                for i in range(reader.getNumPages()):
+                    writer.addPage(reader.getPage(i))
+            with open(out_path, "wb") as file:
+                writer.write(file)
+        finally:
+            for stream in part_streams:
+                stream.close()
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
 ###############################################################################
 if __name__ == '__main__':
     make_blank_pdf_like("ToMark/silly_marked.pdf",
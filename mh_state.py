@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 09:12:48 2026
+
+@author: Ben
+
+Storage of the marking state of scripts: a snapshot (mkh file) per script
+plus an append-only journal of changes since the snapshots were written
+"""
+import os
+import json
+import threading
+import contextlib
+
+import logging
+
+
+import mh_lease as mhl
+import mh_perf
+import mh_record as mhr
+
+logger = logging.getLogger(__name__)
+
+# journal file in the script directory
+JOURNAL_FILE = "marking.journal"
+# lock file serialising compaction of the journal with appends and reads
+LOCK_FILE = "marking.journal.lock"
+# number of journal entries that triggers compaction into snapshots
+COMPACT_AFTER = 200
+
+
+class StateStore:
+    '''
+    Marking state for the scripts in one directory.
+
+    Each change is appended to the journal as one json line
+    {"tag": tag, "rec": record in mkh list format} and synced to disk, so an
+    update costs one small write and a crash can lose at most the entry being
+    written. `compact` folds the journal into the mkh snapshot files.
+
+    Several processes may share one journal: appends and reads hold a
+    shared lock on a separate lock file and compaction an exclusive one (the
+    journal itself is never locked, as Windows locks stop other handles
+    reading the locked bytes). Compaction starts the
+    emptied journal with a header line {"epoch": new random id}, so that
+    other processes notice it even if the journal has since grown past
+    where they had read to
+    '''
+
+    def __init__(self, directory):
+        """
+        Parameters
+        ----------
+        directory : str - script directory containing mkh files and journal
+
+        Returns
+        -------
+        None.
+        """
+        self.directory = directory
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+        '''
+        {tag: mkh list} of latest journal entry for each tag
+        '''
+        self._journal = {}
+        self._entries = 0  # entries in journal
+        self._journal_size = 0  # bytes of journal read so far
+        self._epoch = ''  # epoch of journal read ('' if no header)
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def _journal_lock(self, exclusive):
+        '''
+        Context manager holding the lock on the journal between processes
+        (shared unless `exclusive`)
+
+        Raises
+        ------
+        OSError if lock file cannot be opened
+        '''
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with mhl.file_lock(fd, exclusive):
+                yield
+        finally:
+            os.close(fd)
+
+    def snapshot_path(self, tag):
+        '''
+        Returns full path to mkh file for `tag`
+        '''
+        return os.path.join(self.directory, tag + ".mkh")
+
+    def journal_records(self):
+        '''
+        Returns
+        -------
+        {tag: ScriptRecord} for all tags changed since last compaction
+        '''
+        with self._lock:
+            self._read_journal()
+            return {tag: mhr.ScriptRecord.from_list(self._journal[tag])
+                    for tag in self._journal}
+
+    def get(self, tag):
+        '''
+        Returns
+        -------
+        ScriptRecord : latest saved state of script `tag`
+
+        Raises
+        ------
+        OSError if no state saved for `tag`
+
+        ValueError if saved state invalid
+        '''
+        with self._lock:
+            self._read_journal()
+            if tag in self._journal:
+                return mhr.ScriptRecord.from_list(self._journal[tag])
+        return read_snapshot(self.snapshot_path(tag))
+
+    def put(self, tag, record):
+        '''
+        Append new state `record` (ScriptRecord) for script `tag` to the
+        journal, compacting the journal if it has grown long
+
+        Raises
+        ------
+        OSError if journal cannot be written
+        '''
+        self.put_many({tag: record})
+
+    def put_many(self, records):
+        '''
+        As `put` for each item of {tag: ScriptRecord} `records`, written
+        with a single append
+        '''
+        if not records:
+            return
+        # leading newline ends any incomplete entry left by a crash
+        data = ("\n" + "".join([json.dumps({"tag": tag,
+                                            "rec": records[tag].to_list()})
+                                + "\n" for tag in records])).encode()
+        with self._lock:
+            self._read_journal()
+            # other processes may append too, but not compact meanwhile
+            with self._journal_lock(False):
+                fd = os.open(self.journal_path,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    with mh_perf.span("state write", JOURNAL_FILE):
+                        os.write(fd, data)
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+            self._read_journal()  # picks up the new entries
+            if self._entries >= COMPACT_AFTER:
+                self.compact()
+
+    def compact(self):
+        '''
+        Write the latest state of each script in the journal to its mkh
+        snapshot (atomically), then empty the journal.
+
+        Replaying a journal that was not emptied (e.g. after a crash) gives
+        the same result, so a crash at any point loses nothing. A journal
+        that cannot be read is left as it is
+
+        Raises
+        ------
+        OSError if a snapshot or the lock file cannot be written
+        '''
+        with self._lock:
+            try:
+                fd = os.open(self.journal_path, os.O_WRONLY)
+            except OSError:
+                return  # no journal
+            try:
+                # no other process may append until the journal is emptied
+                with self._journal_lock(True):
+                    if not self._read_journal(False):
+                        return
+                    for tag in self._journal:
+                        write_snapshot(self.snapshot_path(tag),
+                                       self._journal[tag])
+                    epoch = os.urandom(8).hex()
+                    header = (json.dumps({"epoch": epoch}) + "\n").encode()
+                    os.ftruncate(fd, 0)
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, header)
+                    os.fsync(fd)
+                    self._journal = {}
+                    self._entries = 0
+                    self._journal_size = len(header)
+                    self._epoch = epoch
+            finally:
+                os.close(fd)
+            self._read_journal()
+
+    def _read_journal(self, lock=True):
+        '''
+        Bring the journal up to date with entries appended since last read
+        (by any process), starting again from the beginning if it has been
+        compacted since. An incomplete entry left by a crash is skipped.
+        Takes a shared lock on the journal if `lock` (i.e. unless the caller
+        holds an exclusive one)
+
+        Returns
+        -------
+        bool : False if the journal exists but could not be read (what was
+        read before is kept)
+        '''
+        try:
+            with (self._journal_lock(False) if lock
+                  else contextlib.nullcontext()), \
+                    open(self.journal_path, 'rb') as file:
+                file.seek(0)
+                epoch = _journal_epoch(file.readline())
+                size = os.fstat(file.fileno()).st_size
+                if epoch != self._epoch or size < self._journal_size:
+                    self._reset_journal(epoch)  # compacted elsewhere
+                file.seek(self._journal_size)
+                data = file.read()
+                end = data.rfind(b"\n") + 1  # complete lines only
+        except FileNotFoundError:  # no journal
+            self._reset_journal('')
+            return True
+        except OSError as e:
+            logger.warning("Could not read journal %s: %s",
+                           self.journal_path, e)
+            return False
+        self._journal_size += end
+        for line in data[:end].splitlines():
+            if not line:
+                continue
+            try:
+                entry = json.loads(line.decode())
+                if "epoch" in entry:
+                    continue  # header
+                self._journal[entry["tag"]] = entry["rec"]
+                self._entries += 1
+            except (KeyError, TypeError, ValueError):
+                logger.warning("Invalid journal entry in %s",
+                               self.journal_path)
+        return True
+
+    def _reset_journal(self, epoch):
+        '''
+        Forget the journal read so far, to read journal `epoch` from the start
+        '''
+        self._journal = {}
+        self._entries = 0
+        self._journal_size = 0
+        self._epoch = epoch
+
+
+def _journal_epoch(line):
+    '''
+    Returns
+    -------
+    str : epoch in journal header `line` (bytes), or '' if it is not one
+    '''
+    try:
+        entry = json.loads(line.decode())
+        return str(entry["epoch"])
+    except (KeyError, TypeError, ValueError):
+        return ''
+
+
+def read_snapshot(path):
+    '''
+    Returns
+    -------
+    ScriptRecord read from mkh file at `path`
+
+    Raises
+    ------
+    OSError if file cannot be read
+
+    ValueError if it is not valid mkh data
+    '''
+    with mh_perf.span("state read", os.path.basename(path)):
+        with open(path, 'r') as file:
+            return mhr.ScriptRecord.from_list(json.load(file))
+
+
+def write_snapshot(path, data):
+    '''
+    Atomically replace the mkh file at `path` with `data` (mkh list format)
+
+    Raises
+    ------
+    OSError if file cannot be written
+    '''
+    with mh_perf.span("state write", os.path.basename(path)):
+        with open(path + ".tmp", 'w') as file:
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+
+
+g_stores = {}  # {full directory path: StateStore}
+g_stores_lock = threading.Lock()
+
+
+def get_store(directory):
+    '''
+    Returns
+    -------
+    StateStore : the one StateStore in this process for `directory`
+    '''
+    key = os.path.abspath(directory)
+    with g_stores_lock:
+        if key not in g_stores:
+            g_stores[key] = StateStore(directory)
+        return g_stores[key]
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 16:05:42 2026
+
+@author: Ben
+
+Cohort statistics for moderation: per-question summaries, histograms and
+outliers computed from the validated marks of all scripts
+"""
+import math
+from array import array
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# default number of histogram bins
+HIST_BINS = 10
+# marks further than this many interquartile ranges outside the quartiles
+# are outliers
+OUTLIER_IQR = 1.5
+# width of the longest histogram bar in characters
+BAR_WIDTH = 40
+
+_MISSING = float('nan')  # stands in for a missing or non-numeric mark
+
+
+def question_names(records):
+    '''
+    Returns
+    -------
+    sorted list of all questions with a validated mark in any of `records`
+    ({tag: ScriptRecord})
+    '''
+    names = set()
+    for tag in records:
+        names.update(records[tag].valid_marks)
+    return sorted(names)
+
+
+def load_columns(records, questions):
+    '''
+    Read the validated marks for `questions` from every record in one scan
+
+    Parameters
+    ----------
+    records : {tag: ScriptRecord}
+
+    questions : list of question names
+
+    Returns
+    -------
+    [tags, columns, missing] : where
+        `tags` : sorted list of script tags, giving the row order
+
+        `columns` : {question: array('d')} of marks, one per row, NaN where
+        a script has no numeric mark
+
+        `missing` : {tag: list of questions} for scripts with missing or
+        non-numeric marks
+    '''
+    tags = sorted(records)
+    columns = {q: array('d', bytes(8 * len(tags))) for q in questions}
+    missing = {}
+    for row, tag in enumerate(tags):
+        marks = records[tag].valid_marks
+        for q in questions:
+            try:
+                columns[q][row] = float(marks[q])
+            except (KeyError, TypeError, ValueError):
+                columns[q][row] = _MISSING
+                missing.setdefault(tag, []).append(q)
+    return [tags, columns, missing]
+
+
+def present(column):
+    '''
+    Returns
+    -------
+    array('d') of the non-missing values of `column`
+    '''
+    return array('d', [x for x in column if x == x])  # NaN != NaN
+
+
+def summarise(values):
+    '''
+    Parameters
+    ----------
+    values : array('d') of marks, none missing
+
+    Returns
+    -------
+    {"count", "mean", "std", "min", "q1", "median", "q3", "max"} (population
+    standard deviation), or {"count": 0} if there are no values
+    '''
+    n = len(values)
+    if n == 0:
+        return {"count": 0}
+    mean = math.fsum(values) / n
+    var = math.fsum([(x - mean) ** 2 for x in values]) / n
+    ordered = sorted(values)
+    return {"count": n, "mean": mean, "std": math.sqrt(var),
+            "min": ordered[0], "q1": quantile(ordered, 0.25),
+            "median": quantile(ordered, 0.5), "q3": quantile(ordered, 0.75),
+            "max": ordered[-1]}
+
+
+def quantile(ordered, p):
+    '''
+    Returns
+    -------
+    `p` quantile (0 <= `p` <= 1) of sorted non-empty list `ordered`,
+    interpolating linearly between values
+    '''
+    pos = p * (len(ordered) - 1)
+    i = int(pos)
+    if i + 1 >= len(ordered):
+        return ordered[-1]
+    return ordered[i] + (pos - i) * (ordered[i+1] - ordered[i])
+
+
+def histogram(values, bins=HIST_BINS, low=None, high=None):
+    '''
+    Count `values` in `bins` equal-width bins from `low` to `high` (default
+    the smallest and largest value). Values outside the range are ignored
+
+    Returns
+    -------
+    [counts, edges] : list of `bins` counts and list of `bins`+1 bin edges
+    '''
+    if low is None:
+        low = min(values, default=0.0)
+    if high is None:
+        high = max(values, default=0.0)
+    if high <= low:  # all marks equal: one bin holds them
+        high = low + 1.0
+    width = (high - low) / bins
+    counts = [0] * bins
+    for x in values:
+        if low <= x <= high:
+            counts[min(bins - 1, int((x - low) / width))] += 1
+    return [counts, [low + i * width for i in range(bins + 1)]]
+
+
+def outliers(tags, column, summary, spread=OUTLIER_IQR):
+    '''
+    Find marks more than `spread` interquartile ranges below the lower or
+    above the upper quartile
+
+    Parameters
+    ----------
+    tags : row labels of `column`
+
+    column : array('d') of marks (NaN where missing)
+
+    summary : result of `summarise` on the present values of `column`
+
+    Returns
+    -------
+    list of (tag, mark) for outlying marks, furthest from the median first
+    '''
+    if summary["count"] < 4:
+        return []
+    iqr = summary["q3"] - summary["q1"]
+    low = summary["q1"] - spread * iqr
+    high = summary["q3"] + spread * iqr
+    ret = [(tag, x) for tag, x in zip(tags, column)
+           if x < low or x > high]  # False for NaN
+    ret.sort(key=lambda item: -abs(item[1] - summary["median"]))
+    return ret
+
+
+def mark_stats(records, questions=None, bins=HIST_BINS):
+    '''
+    Compute statistics on the validated marks in `records` for `questions`
+    (default all questions found)
+
+    Returns
+    -------
+    [report, missing] : where
+        `report` : {question: {"summary", "histogram", "outliers"}} with
+        the results of `summarise`, `histogram` and `outliers`
+
+        `missing` : {tag: list of questions} for scripts lacking marks
+    '''
+    if not questions:
+        questions = question_names(records)
+    tags, columns, missing = load_columns(records, questions)
+    report = {}
+    for q in questions:
+        values = present(columns[q])
+        summary = summarise(values)
+        report[q] = {"summary": summary,
+                     "histogram": histogram(values, bins),
+                     "outliers": outliers(tags, columns[q], summary)}
+    return [report, missing]
+
+
+def format_report(report, missing, n_show=10):
+    '''
+    Returns
+    -------
+    list of lines describing the results of `mark_stats`, showing at most
+    `n_show` outliers and scripts with missing marks
+    '''
+    lines = []
+    for q in report:
+        summary = report[q]["summary"]
+        lines.append("Question {}: {} marks".format(q, summary["count"]))
+        if summary["count"] == 0:
+            continue
+        lines.append("  mean {mean:.2f}, std {std:.2f}, min {min:g}, "
+                     "quartiles {q1:g}/{median:g}/{q3:g}, max {max:g}"
+                     .format(**summary))
+        counts, edges = report[q]["histogram"]
+        scale = BAR_WIDTH / max(max(counts), 1)
+        for i, count in enumerate(counts):
+            lines.append("  {:>8.4g} - {:<8.4g} {:>6} {}"
+                         .format(edges[i], edges[i+1], count,
+                                 "#" * int(round(count * scale))))
+        found = report[q]["outliers"]
+        if found:
+            lines.append("  {} outliers: ".format(len(found)) +
+                         ", ".join("{} ({:g})".format(tag, x)
+                                   for tag, x in found[:n_show]) +
+                         (", ..." if len(found) > n_show else ""))
+    if missing:
+        lines.append("{} scripts missing marks:".format(len(missing)))
+        for tag in sorted(missing)[:n_show]:
+            lines.append("  {}: {}".format(tag, " ".join(missing[tag])))
+        if len(missing) > n_show:
+            lines.append("  ...")
+    return lines
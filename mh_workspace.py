@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 24 13:37:52 2026
+
+@author: Ben
+
+Workspaces: several marking tasks (papers), each with its own MarkingConfig,
+handled by one process. Caches of script hashes, pdf page sizes, template
+tokens and compiles are process-wide, so papers share them
+"""
+import os
+import json
+import concurrent.futures as cf
+
+import logging
+
+import loghelper
+import mh_hash
+import mh_perf
+import mh_script_management as mhsm
+
+logger = logging.getLogger(__name__)
+
+
+class Workspace:
+    '''
+    Named papers and their MarkingConfigs, listed in a json workspace file:
+    {"papers": {name: config file path}} (paths relative to the workspace
+    file's directory)
+    '''
+
+    def __init__(self, path=''):
+        """
+        Parameters
+        ----------
+        path : str - workspace file ('' for a workspace that is not saved)
+
+        Returns
+        -------
+        None.
+        """
+        self.path = path
+        '''
+        {name: MarkingConfig} in order added
+        '''
+        self.papers = {}
+        self.current = ''  # name of paper commands act on
+
+    def load(self):
+        '''
+        Load the workspace file and the config of each paper in it. The first
+        paper becomes current
+
+        Raises
+        ------
+        OSError if the workspace file or a config cannot be read
+
+        ValueError if the workspace file is not in the format above
+        '''
+        with open(self.path, 'r') as file:
+            data = json.load(file)
+        try:
+            papers = dict(data["papers"])
+        except (KeyError, TypeError) as e:
+            raise ValueError("Invalid workspace file {}".format(
+                self.path)) from e
+        base = os.path.dirname(os.path.abspath(self.path))
+        for name in papers:
+            self.add(name, os.path.join(base, papers[name]))
+        if papers:
+            self.current = next(iter(papers))
+
+    def add(self, name, cfg_path):
+        '''
+        Load config file `cfg_path` as paper `name` (replacing any paper of
+        that name)
+
+        Returns
+        -------
+        MarkingConfig loaded
+
+        Raises
+        ------
+        OSError if the config cannot be read
+        '''
+        cfg = mhsm.MarkingConfig(cfg_path)
+        cfg.load()
+        self.papers[name] = cfg
+        if not self.current:
+            self.current = name
+        return cfg
+
+    def save(self):
+        '''
+        Write the workspace file (if it has a path)
+
+        Raises
+        ------
+        OSError if file cannot be written
+        '''
+        if not self.path:
+            return
+        base = os.path.dirname(os.path.abspath(self.path))
+        data = {"papers": {name: os.path.relpath(
+            os.path.abspath(self.papers[name].path), base)
+            for name in self.papers}}
+        with open(self.path + ".tmp", 'w') as file:
+            json.dump(data, file, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def _digest(path):
+    try:
+        mh_hash.g_hash_cache.digest(path)
+    except OSError:
+        pass  # reported when the paper is checked
+
+
+def scan_all(papers, questions, final_assert=True, match_outhash=False,
+             workers=1):
+    '''
+    Check the marking state of every script of every paper as one batch:
+    all script files are first hashed together by a pool of `workers`
+    threads (filling the shared hash cache), then the papers are checked at
+    once (see mh_script_management.check_marking_state)
+
+    Parameters
+    ----------
+    papers : {name: MarkingConfig}
+
+    questions, final_assert, match_outhash : as for check_marking_state
+
+    workers : number of threads
+
+    Returns
+    -------
+    {name: [to_mark, done_mark] or None if the paper could not be checked}
+    '''
+    paths = []
+    for name in papers:
+        cfg = papers[name]
+        if cfg.integrity_mode() == 'fast':
+            mh_hash.g_hash_cache.load(cfg.hash_cache_path())
+        try:
+            scripts = mhsm.get_script_list(cfg)
+        except OSError:
+            continue  # reported when the paper is checked
+        paths += [os.path.join(cfg.script_dir(), f)
+                  for tag in scripts for f in scripts[tag]]
+    ret = {}
+    with cf.ThreadPoolExecutor(max(1, workers)) as pool:
+        list(pool.map(mh_perf.bind(_digest), paths))
+        futures = {pool.submit(mh_perf.bind(mhsm.check_marking_state),
+                               papers[name], questions, final_assert,
+                               match_outhash): name
+                   for name in papers}
+        for future in cf.as_completed(futures):
+            name = futures[future]
+            try:
+                ret[name] = future.result()
+            except Exception:
+                loghelper.print_and_log(logger, "Failed to check marking " +
+                                        "state of {}".format(name))
+                ret[name] = None
+    return {name: ret[name] for name in papers}